@@ -24,6 +24,7 @@ EXACT = 'E'
 LOPQ = 'L'
 RAW = 'R'
 LMDB = 'L'
+NPY = 'N'
 ANNOTATION = 'A'
 SEGMENTATION = 'S'
 TRANSFORM = 'T'
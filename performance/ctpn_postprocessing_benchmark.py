@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+"""
+Checks that the vectorized NMS and text proposal graph builder used by the CTPN text detector produce the same
+output as the reference loop implementations and measures their speed on synthetic text proposals.
+
+usage: ./ctpn_postprocessing_benchmark.py --proposals 300,1000,3000 --trials 5 [--output r.json]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../repos/tf_ctpn_cpu/'))
+from lib.fast_rcnn.nms_wrapper import py_cpu_nms, vectorized_nms
+from lib.text_connector.text_connect_cfg import Config as TextLineCfg
+from lib.text_connector.text_proposal_graph_builder import TextProposalGraphBuilder, LoopTextProposalGraphBuilder
+
+
+def synthetic_proposals(count, width=1200, height=900, seed=0):
+    """
+    Fixed width proposals arranged along text lines like the ones produced by the CTPN network.
+    """
+    rng = np.random.RandomState(seed)
+    lines = max(count // 40, 1)
+    line_y = rng.uniform(0, height - 60, lines)
+    line_h = rng.uniform(12, 50, lines)
+    line = rng.randint(0, lines, count)
+    x1 = (rng.randint(0, (width - TextLineCfg.TEXT_PROPOSALS_WIDTH) // 16, count) * 16).astype(np.float32)
+    y1 = (line_y[line] + rng.normal(0, 3, count)).clip(0, height - 1).astype(np.float32)
+    y2 = (y1 + line_h[line] * rng.uniform(0.8, 1.2, count)).clip(0, height - 1).astype(np.float32)
+    proposals = np.stack([x1, y1, x1 + TextLineCfg.TEXT_PROPOSALS_WIDTH - 1, y2], axis=1)
+    scores = rng.uniform(0.7, 1.0, (count, 1)).astype(np.float32)
+    return proposals, scores, (height, width)
+
+
+def check_graph(proposals, scores, size):
+    reference_graph = LoopTextProposalGraphBuilder().build_graph(proposals, scores, size).graph
+    graph = TextProposalGraphBuilder().build_graph(proposals, scores, size).graph
+    if not np.array_equal(reference_graph, graph):
+        raise ValueError("Text proposal graph differs for {} proposals".format(len(proposals)))
+
+
+def check_integer_proposals():
+    """
+    Integer valued proposals whose heights have a size similarity of exactly MIN_SIZE_SIM (21 / 30).
+    """
+    proposals = np.array([[100, 100, 115, 120], [16, 9, 31, 38], [200, 9, 215, 30], [8, 20, 23, 40]], np.float32)
+    check_graph(proposals, np.array([[0.9], [0.8], [0.7], [0.95]], np.float32), (300, 380))
+    proposals, scores, size = synthetic_proposals(3000)
+    check_graph(np.round(proposals), scores, size)
+
+
+def timed(function, trials):
+    start = time.time()
+    for _ in range(trials):
+        result = function()
+    return result, (time.time() - start) / trials
+
+
+def benchmark(count, trials):
+    proposals, scores, size = synthetic_proposals(count)
+    dets = np.hstack((proposals, scores))
+    reference_keep, reference_nms = timed(lambda: py_cpu_nms(dets, TextLineCfg.TEXT_PROPOSALS_NMS_THRESH), trials)
+    keep, nms = timed(lambda: vectorized_nms(dets, TextLineCfg.TEXT_PROPOSALS_NMS_THRESH), trials)
+    if list(reference_keep) != list(keep):
+        raise ValueError("NMS output differs for {} proposals".format(count))
+    reference_graph, reference_build = timed(
+        lambda: LoopTextProposalGraphBuilder().build_graph(proposals, scores, size).graph, trials)
+    graph, build = timed(lambda: TextProposalGraphBuilder().build_graph(proposals, scores, size).graph, trials)
+    if not np.array_equal(reference_graph, graph):
+        raise ValueError("Text proposal graph differs for {} proposals".format(count))
+    return {'proposals': count, 'kept': len(keep), 'edges': int(graph.sum()),
+            'reference_nms_seconds': reference_nms, 'nms_seconds': nms,
+            'reference_graph_seconds': reference_build, 'graph_seconds': build}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--proposals', default='300,1000,3000', help='comma separated number of proposals')
+    parser.add_argument('--trials', type=int, default=5)
+    parser.add_argument('--output', default=None, help='optional path to write results as JSON')
+    args = parser.parse_args()
+    check_integer_proposals()
+    results = []
+    for count in args.proposals.split(','):
+        results.append(benchmark(int(count), args.trials))
+        print(json.dumps(results[-1]))
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(results, fh, indent=2)
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""
+Measures the cost of segmenting, probing, decoding and optionally indexing a video as a function of segment length.
+Mirrors the ffmpeg / ffprobe commands used by dvaapp.operations.decoding.VideoDecoder.
+
+usage: ./segmentation_benchmark.py video.mp4 --lengths 1,2,5,10,30 --rate 30 [--indexer network.pb] [--output r.json]
+"""
+import argparse
+import json
+import os
+import shlex
+import shutil
+import subprocess as sp
+import sys
+import tempfile
+import time
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+
+def run(command, cwd=None):
+    return sp.check_output(shlex.split(command), cwd=cwd, stderr=sp.STDOUT)
+
+
+def segment(video_path, segments_dir, segment_time):
+    run('ffmpeg -loglevel panic -i {} -c copy -map 0 -segment_time {} -f segment -segment_list_type csv '
+        '-segment_list {}/segments.csv {}/%d.mp4'.format(video_path, segment_time, segments_dir, segments_dir))
+    with open('{}/segments.csv'.format(segments_dir)) as fh:
+        return [line.strip().split(',')[0] for line in fh if line.strip()]
+
+
+def probe(segments_dir, segment_file_name):
+    run('ffprobe -select_streams v -show_streams -print_format json {}'.format(segment_file_name), cwd=segments_dir)
+    run('ffprobe -show_frames -select_streams v:0 -print_format csv {}'.format(segment_file_name), cwd=segments_dir)
+
+
+def decode(segments_dir, frames_dir, segment_file_name, rate):
+    segment_index = segment_file_name.split('.')[0]
+    run('ffmpeg -fflags +igndts -loglevel panic -i {}/{} -vf "select=not(mod(n\,{}))+eq(pict_type\,PICT_TYPE_I)" '
+        '-vsync 0 {}/segment_{}_%d_b.jpg'.format(segments_dir, segment_file_name, rate, frames_dir, segment_index))
+
+
+def directory_size(dirname):
+    return sum(os.path.getsize(os.path.join(dirname, f)) for f in os.listdir(dirname))
+
+
+def benchmark(video_path, segment_time, rate, workers, indexer=None):
+    root = tempfile.mkdtemp()
+    segments_dir = os.path.join(root, 'segments')
+    frames_dir = os.path.join(root, 'frames')
+    os.mkdir(segments_dir)
+    os.mkdir(frames_dir)
+    pool = ThreadPool(workers)
+    try:
+        result = {'segment_time': segment_time}
+        start = time.time()
+        segment_files = segment(video_path, segments_dir, segment_time)
+        result['segment_seconds'] = time.time() - start
+        result['segments'] = len(segment_files)
+        result['segments_bytes'] = directory_size(segments_dir)
+        start = time.time()
+        pool.map(lambda f: probe(segments_dir, f), segment_files)
+        result['probe_seconds'] = time.time() - start
+        start = time.time()
+        pool.map(lambda f: decode(segments_dir, frames_dir, f, rate), segment_files)
+        result['decode_seconds'] = time.time() - start
+        frame_paths = sorted(os.path.join(frames_dir, f) for f in os.listdir(frames_dir))
+        result['frames'] = len(frame_paths)
+        if indexer is not None and frame_paths:
+            start = time.time()
+            indexer.index_paths(frame_paths)
+            result['index_seconds'] = time.time() - start
+        result['total_seconds'] = sum(v for k, v in result.items() if k.endswith('_seconds'))
+        return result
+    finally:
+        pool.close()
+        pool.join()
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('video')
+    parser.add_argument('--lengths', default='1,2,5,10,30', help='comma separated segment lengths in seconds')
+    parser.add_argument('--rate', type=int, default=30, help='decode 1 in every rate frames and all keyframes')
+    parser.add_argument('--workers', type=int, default=cpu_count())
+    parser.add_argument('--indexer', default=None, help='optional path to an inception network.pb')
+    parser.add_argument('--output', default=None, help='optional path to write results as JSON')
+    args = parser.parse_args()
+    visual_indexer = None
+    if args.indexer:
+        sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../server/'))
+        from dvalib.indexer import InceptionIndexer
+        visual_indexer = InceptionIndexer(args.indexer)
+        visual_indexer.load()
+    results = []
+    for length in args.lengths.split(','):
+        results.append(benchmark(os.path.abspath(args.video), float(length), args.rate, args.workers,
+                                 visual_indexer))
+        print json.dumps(results[-1])
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(results, fh, indent=2)
@@ -11,10 +11,103 @@ def nms(dets, thresh):
         return []
     if pure_python_nms:
         # print("Fall back to pure python nms")
-        return py_cpu_nms(dets, thresh)
+        return vectorized_nms(dets, thresh)
     return cython_nms(dets, thresh)
 
 
+def vectorized_nms(dets, thresh, chunk_pairs=1 << 20):
+    """
+    Same greedy NMS as py_cpu_nms. Overlaps are only computed for pairs of boxes whose horizontal extents intersect,
+    found by sorting boxes on x1 and evaluated chunk_pairs at a time, the greedy pass then only visits suppression
+    edges of kept boxes. Falls back to blocked_nms for boxes with non-positive areas.
+    """
+    n = dets.shape[0]
+    x1, x2 = dets[:, 0], dets[:, 2]
+    areas = (x2 - x1 + 1) * (dets[:, 3] - dets[:, 1] + 1)
+    if n == 0 or not (areas > 0).all():
+        return blocked_nms(dets, thresh)
+    by_x1 = np.argsort(x1, kind='mergesort')
+    # boxes starting after x2 + 1 cannot intersect, one extra pixel of slack guards against rounding
+    end = np.searchsorted(x1[by_x1], x2[by_x1] + 2, side='right')
+    counts = np.maximum(end - np.arange(1, n + 1), 0)
+    cumulative = np.cumsum(counts)
+    order = dets[:, 4].argsort()[::-1]
+    rank = np.empty(n, dtype=np.int64)
+    rank[order] = np.arange(n)
+    sources, targets = [], []
+    start = 0
+    while start < n:
+        # positions whose pairs fit in a chunk, at least one position is processed
+        stop = max(np.searchsorted(cumulative, cumulative[start] - counts[start] + chunk_pairs, side='right'),
+                   start + 1)
+        chunk_counts = counts[start:stop]
+        total = chunk_counts.sum()
+        first = np.repeat(np.arange(start, stop), chunk_counts)
+        second = first + 1 + np.arange(total) - np.repeat(np.cumsum(chunk_counts) - chunk_counts, chunk_counts)
+        first, second = by_x1[first], by_x1[second]
+        suppresses = suppression_matrix(dets[first, :4], areas[first], dets[second, :4], areas[second], thresh,
+                                        pairwise=True)
+        first, second = rank[first[suppresses]], rank[second[suppresses]]
+        sources.append(np.minimum(first, second))
+        targets.append(np.maximum(first, second))
+        start = stop
+    source, target = np.concatenate(sources), np.concatenate(targets)
+    edges = np.argsort(source, kind='mergesort')
+    source, target = source[edges], target[edges]
+    starts = np.searchsorted(source, np.arange(n + 1))
+    suppressed = np.zeros(n, dtype=np.bool_)
+    keep = []
+    for r in range(n):
+        if not suppressed[r]:
+            keep.append(r)
+            suppressed[target[starts[r]:starts[r + 1]]] = True
+    return list(order[keep])
+
+
+def blocked_nms(dets, thresh, block_size=128):
+    """
+    Same greedy NMS as py_cpu_nms, boxes are processed in blocks of block_size sorted by score. Overlaps within a
+    block and against boxes kept from earlier blocks are computed as matrices.
+    """
+    order = dets[:, 4].argsort()[::-1]
+    boxes = dets[order, :4]
+    areas = (boxes[:, 2] - boxes[:, 0] + 1) * (boxes[:, 3] - boxes[:, 1] + 1)
+    keep = []
+    for start in range(0, boxes.shape[0], block_size):
+        end = min(start + block_size, boxes.shape[0])
+        if keep:
+            kept = np.asarray(keep)
+            suppressed = suppression_matrix(boxes[kept], areas[kept], boxes[start:end], areas[start:end],
+                                            thresh).any(axis=0)
+        else:
+            suppressed = np.zeros(end - start, dtype=np.bool_)
+        within = suppression_matrix(boxes[start:end], areas[start:end], boxes[start:end], areas[start:end], thresh)
+        for k in range(end - start):
+            if not suppressed[k]:
+                keep.append(start + k)
+                suppressed[k + 1:] |= within[k, k + 1:]
+    return list(order[keep])
+
+
+def suppression_matrix(boxes, areas, other_boxes, other_areas, thresh, pairwise=False):
+    """
+    Whether each of boxes suppresses each of other_boxes (or only the box at the same position when pairwise).
+    """
+    if pairwise:
+        b, a = boxes, areas
+    else:
+        b, a = boxes[:, None, :], areas[:, None]
+    xx1 = np.maximum(b[..., 0], other_boxes[:, 0])
+    yy1 = np.maximum(b[..., 1], other_boxes[:, 1])
+    xx2 = np.minimum(b[..., 2], other_boxes[:, 2])
+    yy2 = np.minimum(b[..., 3], other_boxes[:, 3])
+    inter = np.maximum(0.0, xx2 - xx1 + 1) * np.maximum(0.0, yy2 - yy1 + 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ovr = inter / (a + other_areas - inter)
+    # negated comparison so that NaN overlaps suppress boxes exactly like py_cpu_nms
+    return ~(ovr <= thresh)
+
+
 def py_cpu_nms(dets, thresh):
     x1 = dets[:, 0]
     y1 = dets[:, 1]
@@ -4,6 +4,59 @@ import numpy as np
 
 
 class TextProposalGraphBuilder:
+    """
+        Build Text proposals into a graph, vectorized equivalent of LoopTextProposalGraphBuilder. Proposals are sorted
+        by left and processed in blocks of block_size rows, each compared only with proposals within
+        MAX_HORIZONTAL_GAP of the block, so that memory does not grow with the square of the number of proposals.
+    """
+    def build_graph(self, text_proposals, scores, im_size, block_size=512):
+        # ratios are compared with the thresholds in float64, as in LoopTextProposalGraphBuilder
+        text_proposals=text_proposals.astype(np.float64)
+        scores=scores.ravel()
+        n=text_proposals.shape[0]
+        if n==0:
+            return Graph(np.zeros((0, 0), np.bool_))
+        left=text_proposals[:, 0].astype(np.int64)
+        heights=text_proposals[:, 3]-text_proposals[:, 1]+1
+        gap=TextLineCfg.MAX_HORIZONTAL_GAP
+        # stable so that proposals with equal left stay in index order and ties are broken by the lowest index
+        order=np.argsort(left, kind='mergesort')
+        sorted_left=left[order]
+        window_start=np.searchsorted(sorted_left, sorted_left-gap, 'left')
+        window_end=np.searchsorted(sorted_left, sorted_left+gap, 'right')
+        succession_index=np.full(n, -1, np.int64)
+        max_precursor_scores=np.empty(n, scores.dtype)
+        for start in range(0, n, block_size):
+            end=min(start+block_size, n)
+            rows=order[start:end]
+            cols=order[window_start[start]:window_end[end-1]]
+            y0=np.maximum(text_proposals[rows, 1][:, None], text_proposals[cols, 1][None, :])
+            y1=np.minimum(text_proposals[rows, 3][:, None], text_proposals[cols, 3][None, :])
+            min_heights=np.minimum(heights[rows][:, None], heights[cols][None, :])
+            meet=(np.maximum(0, y1-y0+1)/min_heights>=TextLineCfg.MIN_V_OVERLAPS) & \
+                 (min_heights/np.maximum(heights[rows][:, None], heights[cols][None, :])>=TextLineCfg.MIN_SIZE_SIM)
+            # dx[i, j] is the horizontal offset of proposal cols[j] from proposal rows[i]
+            dx=left[cols][None, :]-left[rows][:, None]
+            successions=meet & (dx>=1) & (dx<=gap) & (left[cols][None, :]<im_size[1])
+            precursors=meet & (dx<=-1) & (dx>=-gap)
+            # only proposals at the nearest offset which has any match are successions / precursors
+            nearest=np.where(successions, dx, gap+1).min(axis=1)
+            successions&=dx==nearest[:, None]
+            nearest=np.where(precursors, -dx, gap+1).min(axis=1)
+            precursors&=-dx==nearest[:, None]
+            # best succession of each proposal
+            best=np.where(successions, scores[cols][None, :], -np.inf).argmax(axis=1)
+            has_succession=successions.any(axis=1)
+            succession_index[rows[has_succession]]=cols[best[has_succession]]
+            max_precursor_scores[rows]=np.where(precursors, scores[cols][None, :], -np.inf).max(axis=1)
+        indexes=np.flatnonzero(succession_index>=0)
+        indexes=indexes[scores[indexes]>=max_precursor_scores[succession_index[indexes]]]
+        graph=np.zeros((n, n), np.bool_)
+        graph[indexes, succession_index[indexes]]=True
+        return Graph(graph)
+
+
+class LoopTextProposalGraphBuilder:
     """
         Build Text proposals into a graph.
     """
@@ -54,7 +107,8 @@ class TextProposalGraphBuilder:
                size_similarity(index1, index2)>=TextLineCfg.MIN_SIZE_SIM
 
     def build_graph(self, text_proposals, scores, im_size):
-        self.text_proposals=text_proposals
+        # float64 so that ratios at the thresholds do not depend on the input dtype
+        self.text_proposals=text_proposals=text_proposals.astype(np.float64)
         self.scores=scores
         self.im_size=im_size
         self.heights=text_proposals[:, 3]-text_proposals[:, 1]+1
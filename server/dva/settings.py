@@ -247,6 +247,7 @@ TASK_NAMES_TO_QUEUE = {
     "perform_model_import":Q_EXTRACTOR,
     "perform_video_segmentation":Q_EXTRACTOR,
     "perform_video_decode":Q_EXTRACTOR,
+    "perform_frame_deduplication":Q_EXTRACTOR,
     "perform_frame_download": Q_EXTRACTOR,
     "perform_dataset_extraction":Q_EXTRACTOR,
     "perform_transformation":Q_EXTRACTOR,
@@ -262,7 +263,7 @@ TASK_NAMES_TO_QUEUE = {
 }
 
 RESTARTABLE_TASKS = {'perform_video_segmentation', 'perform_indexing', 'perform_detection', 'perform_analysis',
-                     'perform_frame_download', 'perform_video_decode', 'perform_test'}
+                     'perform_frame_download', 'perform_video_decode', 'perform_frame_deduplication', 'perform_test'}
 
 NON_PROCESSING_TASKS = {'perform_training','perform_training_set_creation','perform_deletion', 'perform_export'}
 
@@ -274,12 +275,48 @@ KUBE_MODE = 'KUBE_MODE' in os.environ
 DEFAULT_SEGMENTS_BATCH_SIZE = int(os.environ.get('DEFAULT_SEGMENTS_BATCH_SIZE',10))
 # How many frames/images in a dataset should we process at a time?
 DEFAULT_FRAMES_BATCH_SIZE = int(os.environ.get('DEFAULT_FRAMES_BATCH_SIZE',500))
+# Default segment duration in seconds, can be overridden per video with segment_time, segment_frames or
+# segment_keyframes arguments to perform_video_segmentation
+DEFAULT_SEGMENT_TIME = float(os.environ.get('DEFAULT_SEGMENT_TIME', 1))
+# Probe each segment in parallel ("segments") or probe the source video once and split frames by segment ("source")
+SEGMENT_PROBE_MODE = os.environ.get('SEGMENT_PROBE_MODE', 'segments')
+# Number of concurrent ffprobe processes used to probe segments, by default the number of cores
+SEGMENT_PROBE_WORKERS = int(os.environ.get('SEGMENT_PROBE_WORKERS', 0))
+# Number of segments decoded concurrently by perform_video_decode, can be overridden with the workers argument
+DECODE_WORKERS = int(os.environ.get('DECODE_WORKERS', 1))
+# Defaults for adaptive frame sampling (adaptive argument to perform_video_decode), frames are kept when the mean
+# absolute difference (0-1) of downsampled frames accumulated since the last kept frame exceeds the threshold
+ADAPTIVE_MIN_FPS = float(os.environ.get('ADAPTIVE_MIN_FPS', 0.2))
+ADAPTIVE_MAX_FPS = float(os.environ.get('ADAPTIVE_MAX_FPS', 4))
+ADAPTIVE_SCENE_THRESHOLD = float(os.environ.get('ADAPTIVE_SCENE_THRESHOLD', 0.05))
+# Frames whose perceptual hashes differ by at most this many bits (out of 64) from the representative of the current
+# run are marked as near-duplicates, "phash" (DCT) or "ahash" (block average) hashes can be used
+DEDUP_MAX_DISTANCE = int(os.environ.get('DEDUP_MAX_DISTANCE', 6))
+DEDUP_HASH = os.environ.get('DEDUP_HASH', 'phash')
+# Pack decoded frames of each segment into a single file which is uploaded instead of one object per frame,
+# workers fetch the pack once and extract frames locally.
+ENABLE_FRAME_PACKS = 'ENABLE_FRAME_PACKS' in os.environ
+# Live inference during stream capture: number of decoded frames buffered before the oldest are dropped and how
+# often (in seconds) detected regions are committed.
+LIVE_BUFFER_SIZE = int(os.environ.get('LIVE_BUFFER_SIZE', 8))
+LIVE_COMMIT_INTERVAL = float(os.environ.get('LIVE_COMMIT_INTERVAL', 1.0))
 # Default video decoding 1 frame per 30 frames AND all i-frames
 DEFAULT_RATE = int(os.environ.get('DEFAULT_RATE',30))
 # Max task attempts
 MAX_TASK_ATTEMPTS = 5
 # FAISS
 ENABLE_FAISS = 'DISABLE_FAISS' not in os.environ
+# Persist vectors loaded by exact retrievers in a memory mapped file under MEDIA_ROOT/retrievers/
+ENABLE_PERSISTENT_RETRIEVER = 'ENABLE_PERSISTENT_RETRIEVER' in os.environ
+# Minimum number of uncompacted FAISS index entries merged into a new shard by refresh_retriever, 0 disables shards
+FAISS_SHARD_MIN_ENTRIES = int(os.environ.get('FAISS_SHARD_MIN_ENTRIES', 100))
+# Seconds between retrievers comparing their loaded entries with all IndexEntries, which picks up entries committed
+# below the watermark by slow transactions. Deleted entries are picked up as soon as they are deleted.
+RETRIEVER_RECONCILE_INTERVAL = int(os.environ.get('RETRIEVER_RECONCILE_INTERVAL', 600))
+# Number of region id -> (video, frame index) mappings cached by each retriever worker, 0 disables the cache
+REGION_CACHE_SIZE = int(os.environ.get('REGION_CACHE_SIZE', 100000))
+# Maximum number of IndexEntries LMDB environments (and memory mapped entry arrays) kept open by each worker
+MAX_OPENED_LMDB = int(os.environ.get('MAX_OPENED_LMDB', 256))
 # Serializer version
 SERIALIZER_VERSION = "0.1"
 
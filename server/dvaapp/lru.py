@@ -0,0 +1,42 @@
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    Bounded mapping which evicts the least recently used key, on_evict(key, value) is called for evicted entries.
+    """
+
+    def __init__(self, max_size, on_evict=None):
+        self.max_size = max_size
+        self.on_evict = on_evict
+        self.data = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        if key not in self.data:
+            return default
+        value = self.data.pop(key)
+        self.data[key] = value
+        return value
+
+    def put(self, key, value):
+        if key in self.data:
+            self.data.pop(key)
+        elif self.max_size <= 0:
+            return
+        self.data[key] = value
+        while len(self.data) > self.max_size:
+            evicted_key, evicted_value = self.data.popitem(last=False)
+            if self.on_evict:
+                self.on_evict(evicted_key, evicted_value)
+
+    def clear(self):
+        while self.data:
+            key, value = self.data.popitem(last=False)
+            if self.on_evict:
+                self.on_evict(key, value)
@@ -3,13 +3,17 @@ import os, json, gzip, sys, shutil, zipfile, uuid, hashlib, logging
 
 sys.path.append(os.path.join(os.path.dirname(__file__),
                              "../../client/"))  # This ensures that the constants are same between client and server
-from django.db import models
+from django.db import models, connection
 from django.contrib.auth.models import User
 from django.contrib.postgres.fields import JSONField
 from django.conf import settings
 from django.utils import timezone
 from dvaclient import constants
+from django.urls import reverse
 from . import fs
+from .lru import LRUCache
+from dvalib.frame_pack import FramePack
+from dva.in_memory import redis_client
 from PIL import Image
 import time
 import lmdb
@@ -22,7 +26,31 @@ from uuid import UUID
 from json import JSONEncoder
 
 JSONEncoder_old = JSONEncoder.default
-OPENED_DBS = {}
+
+
+def _close_lmdb(pk, opened):
+    env, txn = opened
+    txn.abort()
+    env.close()
+
+
+# IndexEntries pk -> (LMDB environment, read transaction), least recently used environments are closed
+OPENED_DBS = LRUCache(settings.MAX_OPENED_LMDB, on_evict=_close_lmdb)
+# IndexEntries pk -> memory mapped entries array
+OPENED_ARRAYS = LRUCache(settings.MAX_OPENED_LMDB)
+# Incremented whenever completed events make new IndexEntries visible to retrievers or entries are deleted
+INDEX_ENTRIES_VERSION_KEY = "index_entries_version"
+# Incremented when IndexEntries are deleted, retrievers then compare their loaded entries with the database
+INDEX_ENTRIES_DELETED_KEY = "index_entries_deleted"
+# Postgres sequence numbering IndexEntries in order of creation, independent of worker clocks
+# created by scripts/custom_migration.py
+INDEX_ENTRIES_SEQUENCE = "dvaapp_indexentries_sequence"
+
+def next_index_entries_sequence(count):
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT nextval(%s) FROM generate_series(1, %s)", [INDEX_ENTRIES_SEQUENCE, count])
+        return sorted(row[0] for row in cursor.fetchall())
+
 
 def JSONEncoder_new(self, o):
     if isinstance(o, UUID): return str(o)
@@ -243,6 +271,8 @@ class TEvent(models.Model):
                     frame_indexes.add(d.min_frame_index)
                 d.id = '{}_{}'.format(self.id, i)
                 temp.append(d)
+            for d, sequence in zip(temp, next_index_entries_sequence(len(temp))):
+                d.sequence = sequence
             created_index_entries = IndexEntries.objects.bulk_create(temp, batch_size=1000)
             self.results['created_objects']['IndexEntries'] = len(created_index_entries)
         if 'Region' in bulk_create:
@@ -356,7 +386,14 @@ class TEvent(models.Model):
             created_type_count = 0
             if self.results and 'created_objects' in self.results:
                 if 'Frame' in self.results['created_objects']:
-                    fnames += [k.path(media_root="") for k in Frame.objects.filter(event_id=self.pk)]
+                    packs = set()
+                    for k in Frame.objects.filter(event_id=self.pk):
+                        if k.packed:
+                            packs.add(k.pack_path(media_root=""))
+                        elif os.path.isfile(k.path()):
+                            # frames decoded in memory without saving their JPEG only exist in the database
+                            fnames.append(k.path(media_root=""))
+                    fnames += sorted(packs)
                     created_type_count += 1
                 if 'Segment' in self.results['created_objects']:
                     fnames += [k.path(media_root="") for k in Segment.objects.filter(event_id=self.pk)]
@@ -388,6 +425,9 @@ class TEvent(models.Model):
         if self.start_ts:
             self.duration = (timezone.now() - self.start_ts).total_seconds()
         self.save()
+        if self.operation == 'perform_import' or (self.results and 'IndexEntries' in self.results.get(
+                'created_objects', {})):
+            redis_client.incr(INDEX_ENTRIES_VERSION_KEY)
 
 
 class TrainedModel(models.Model):
@@ -576,6 +616,65 @@ class Retriever(models.Model):
     created = models.DateTimeField('date created', auto_now_add=True)
 
 
+def frame_pack_path(video_id, segment_index, media_root=None):
+    if media_root is None:
+        media_root = settings.MEDIA_ROOT
+    return "{}/{}/frames/segment_{}.pack".format(media_root, video_id, segment_index)
+
+
+def frame_media_url(video_id, frame_index):
+    """
+    Packed frames are not uploaded as individual images, with a remote fs they are served by the frame_image view.
+    """
+    if settings.ENABLE_FRAME_PACKS and settings.ENABLE_CLOUDFS:
+        return reverse('frame_image', args=[video_id, frame_index])
+    return "{}{}/frames/{}.jpg".format(settings.MEDIA_URL, video_id, frame_index)
+
+
+def ensure_frame(video_id, frame_index, segment_index=None, packed=None, dirnames=None, packs=None):
+    """
+    Ensures the image of a frame is available locally and returns its path. Packed frames are extracted from the
+    frame pack of their segment, packs maps pack paths to opened packs so that each pack is fetched once.
+    packed is looked up when None.
+    """
+    local_path = "{}/{}/frames/{}.jpg".format(settings.MEDIA_ROOT, video_id, frame_index)
+    if os.path.isfile(local_path):
+        return local_path
+    if packed is None:
+        packed = False
+        if settings.ENABLE_FRAME_PACKS:
+            packed, segment_index = Frame.objects.filter(video_id=video_id, frame_index=frame_index).values_list(
+                'packed', 'segment_index').first() or (False, None)
+    if packed:
+        pack_path = frame_pack_path(video_id, segment_index, media_root='')
+        if packs is None:
+            fs.ensure(pack_path, dirnames)
+            with FramePack(frame_pack_path(video_id, segment_index)) as pack:
+                pack.extract(frame_index, local_path)
+        else:
+            if pack_path not in packs:
+                fs.ensure(pack_path, dirnames)
+                packs[pack_path] = FramePack(frame_pack_path(video_id, segment_index)).open()
+            packs[pack_path].extract(frame_index, local_path)
+    else:
+        fs.ensure("/{}/frames/{}.jpg".format(video_id, frame_index), dirnames)
+    return local_path
+
+
+def crop_region_arrays(regions, frames):
+    """
+    Crops regions as arrays with Region.crop_array, regions are expected in frame order. frames only holds the decoded
+    frame of the last region and can be carried across calls so that a frame spanning two batches is decoded once.
+    Crops are copied so that they do not keep evicted frames in memory.
+    """
+    crops = []
+    for dr in regions:
+        if dr.frame_path() not in frames:
+            frames.clear()
+        crops.append(np.array(dr.crop_array(frames)))
+    return crops
+
+
 class Frame(models.Model):
     video = models.ForeignKey(Video)
     event = models.ForeignKey(TEvent)
@@ -586,6 +685,9 @@ class Frame(models.Model):
     t = models.FloatField(null=True)  # time in seconds for keyframes
     keyframe = models.BooleanField(default=False)  # is this a key frame for a video?
     segment_index = models.IntegerField(null=True)
+    phash = models.BigIntegerField(null=True)  # 64 bit perceptual hash
+    duplicate_of = models.IntegerField(null=True)  # frame_index of the representative of a near-duplicate group
+    packed = models.BooleanField(default=False)  # stored remotely in the frame pack of its segment
 
     class Meta:
         unique_together = (("video", "frame_index"),)
@@ -599,6 +701,13 @@ class Frame(models.Model):
         else:
             return "{}/{}/frames/{}.jpg".format(settings.MEDIA_ROOT, self.video_id, self.frame_index)
 
+    def pack_path(self, media_root=None):
+        return frame_pack_path(self.video_id, self.segment_index, media_root)
+
+    @property
+    def media_url(self):
+        return frame_media_url(self.video_id, self.frame_index)
+
     def original_path(self):
         return self.name
 
@@ -705,8 +814,7 @@ class Region(models.Model):
             with open(region_path, 'wb') as out:
                 out.write(cached_data)
         else:
-            fs.ensure(self.frame_path(""))
-            frame_path = self.frame_path()
+            frame_path = ensure_frame(self.video_id, self.frame_index)
             if frame_path not in images:
                 images[frame_path] = Image.open(frame_path)
             img2 = images[frame_path].crop((self.x, self.y, self.x + self.w, self.y + self.h))
@@ -715,6 +823,28 @@ class Region(models.Model):
                 fs.cache_path(bare_path, payload=fr.read())
         return region_path
 
+    def crop_array(self, frames):
+        """
+        Crop as an RGB array without writing a JPEG, frames maps frame paths to decoded arrays so that each frame is
+        decoded once. The crop is a view into the frame unless it extends beyond it, then it is padded with black
+        like PIL crop.
+        """
+        frame_path = ensure_frame(self.video_id, self.frame_index)
+        if frame_path not in frames:
+            frames[frame_path] = np.asarray(Image.open(frame_path).convert('RGB'))
+        frame = frames[frame_path]
+        if self.full_frame:
+            return frame
+        x, y, w, h = self.x, self.y, self.w, self.h
+        if x >= 0 and y >= 0 and x + w <= frame.shape[1] and y + h <= frame.shape[0]:
+            return frame[y:y + h, x:x + w]
+        crop = np.zeros((h, w, 3), dtype=frame.dtype)
+        left, top = max(x, 0), max(y, 0)
+        right, bottom = min(x + w, frame.shape[1]), min(y + h, frame.shape[0])
+        if right > left and bottom > top:
+            crop[top - y:bottom - y, left - x:right - x] = frame[top:bottom, left:right]
+        return crop
+
     def global_frame_path(self):
         if self.video.dataset:
             df = Frame.objects.get(video=self.video, frame_index=self.frame_index)
@@ -768,9 +898,11 @@ class IndexEntries(models.Model):
     uuid = models.UUIDField(default=uuid.uuid4, null=True)
     LMDB = constants.LMDB
     RAW = constants.RAW
+    NPY = constants.NPY
     STORAGE_TYPES = (
         (LMDB, 'LMDB database'),
         (RAW, 'Entries'),
+        (NPY, 'NumPy array'),
     )
     storage_type = models.CharField(max_length=1, choices=STORAGE_TYPES, db_index=True, default=RAW)
     entries = JSONField(blank=True, null=True)
@@ -783,6 +915,7 @@ class IndexEntries(models.Model):
     count = models.IntegerField()
     approximate = models.BooleanField(default=False)
     created = models.DateTimeField('date created', auto_now_add=True)
+    sequence = models.BigIntegerField(null=True, db_index=True)
     per_event_index = models.IntegerField()
     event = models.ForeignKey(TEvent)
     min_frame_index = models.IntegerField(null=True)
@@ -791,6 +924,11 @@ class IndexEntries(models.Model):
     def __unicode__(self):
         return "{} in {} index by {}".format(self.target, self.algorithm, self.video.name)
 
+    def save(self, *args, **kwargs):
+        if self.sequence is None:
+            self.sequence = next_index_entries_sequence(1)[0]
+        super(IndexEntries, self).save(*args, **kwargs)
+
     def npy_path(self, media_root=None):
         if media_root is None:
             media_root = settings.MEDIA_ROOT
@@ -805,7 +943,21 @@ class IndexEntries(models.Model):
                   {}, media_root)
         return "{}{}".format(dirname, str(self.uuid).replace('-', '_'))
 
-    def get_vectors(self, media_root=None):
+    def entries_npy_path(self, media_root=None):
+        if media_root is None:
+            media_root = settings.MEDIA_ROOT
+        fname = "{}.entries.npy".format(str(self.uuid).replace('-', '_'))
+        fs.ensure("{}{}".format(self.event.get_dir(media_root=""), fname), {}, media_root)
+        return "{}{}".format(self.event.get_dir(), fname)
+
+    def entries_array(self, media_root=None):
+        entries = OPENED_ARRAYS.get(self.pk)
+        if entries is None:
+            entries = np.load(self.entries_npy_path(media_root), mmap_mode='r')
+            OPENED_ARRAYS.put(self.pk, entries)
+        return entries
+
+    def get_vectors(self, media_root=None, mmap_mode=None):
         if media_root is None:
             media_root = settings.MEDIA_ROOT
         video_dir = "{}/{}".format(media_root, self.video_id)
@@ -818,21 +970,32 @@ class IndexEntries(models.Model):
         if self.features:
             fs.ensure(self.npy_path(media_root=''), dirnames, media_root)
             if self.features.endswith('npy'):
-                vectors = np.load(self.npy_path(media_root))
+                vectors = np.load(self.npy_path(media_root), mmap_mode=mmap_mode)
             else:
                 vectors = self.npy_path(media_root)
         else:
             return self.entries
         return vectors
 
+    def lmdb_txn(self, media_root=None):
+        opened = OPENED_DBS.get(self.pk)
+        if opened is None:
+            env = lmdb.open(self.lmdb_path(media_root), max_dbs=0, subdir=False, readonly=True)
+            opened = (env, env.begin(buffers=True))
+            OPENED_DBS.put(self.pk, opened)
+        return opened[1]
+
     def get_entry(self, offset, media_root=None):
+        return self.get_entries([offset], media_root)[0]
+
+    def get_entries(self, offsets, media_root=None):
         if self.storage_type == self.LMDB:
-            if self.pk not in OPENED_DBS:
-                entries_fname = self.lmdb_path(media_root)
-                OPENED_DBS[self.pk] = lmdb.open(entries_fname, max_dbs=0, subdir=False, readonly=True).begin(buffers=True)
-            return json.loads(str(OPENED_DBS[self.pk].get(str(offset))))
+            txn = self.lmdb_txn(media_root)
+            return [json.loads(str(txn.get(str(offset)))) for offset in offsets]
+        elif self.storage_type == self.NPY:
+            return self.entries_array(media_root)[np.asarray(offsets, dtype=np.int64)].tolist()
         else:
-            return self.entries[offset]
+            return [self.entries[offset] for offset in offsets]
 
     def copy_entries(self, other_index_entries, event, media_root=None):
         other_index_entries.storage_type = self.storage_type
@@ -841,6 +1004,11 @@ class IndexEntries(models.Model):
             this_entries_fname = self.lmdb_path(media_root)
             other_entries_fname = "{}{}".format(event.get_dir(), str(other_index_entries.uuid).replace('-', '_'))
             shutil.copy(this_entries_fname,other_entries_fname)
+        elif self.storage_type == self.NPY:
+            event.create_dir()
+            other_entries_fname = "{}{}.entries.npy".format(event.get_dir(),
+                                                            str(other_index_entries.uuid).replace('-', '_'))
+            shutil.copy(self.entries_npy_path(media_root), other_entries_fname)
         else:
             other_index_entries.entries = self.entries
 
@@ -854,6 +1022,8 @@ class IndexEntries(models.Model):
                     for k,v in curs:
                         entries.append((int(k),json.loads(str(v))))
             return [e for i,e in sorted(entries)]
+        elif self.storage_type == self.NPY:
+            return self.entries_array(media_root).tolist()
         else:
             return self.entries
 
@@ -870,11 +1040,20 @@ class IndexEntries(models.Model):
         with open(feat_fname, 'w') as feats:
             np.save(feats, np.array(features))
 
-    def store_entries(self, entries, event, use_lmdb=True):
+    def store_entries(self, entries, event, use_lmdb=True, use_npy=True):
+        """
+        Frame indexes / region ids are stored as a NumPy array, other entries fall back to LMDB or JSON.
+        """
         event.create_dir()
         dirname = event.get_dir()
         entries_fname = "{}/{}".format(dirname, str(self.uuid).replace('-', '_'))
-        if use_lmdb and entries:
+        if use_npy and entries and all(type(e) in (int, long) for e in entries):
+            self.storage_type = self.NPY
+            np.save("{}.entries.npy".format(entries_fname), np.array(entries, dtype=np.int64))
+        elif use_npy and entries and all(isinstance(e, basestring) for e in entries):
+            self.storage_type = self.NPY
+            np.save("{}.entries.npy".format(entries_fname), np.array([str(e) for e in entries]))
+        elif use_lmdb and entries:
             self.storage_type = self.LMDB
             env = lmdb.open(entries_fname, max_dbs=0, subdir=False)
             with env.begin(write=True) as txn:
@@ -40,23 +40,40 @@ class Approximators(object):
         return Approximators._index_approximator[di.pk]
 
     @classmethod
-    def approximate_queryset(cls,approx,da,queryset,event):
+    def approximate_queryset(cls,approx,da,queryset,event,batch_size=4096):
+        if da.algorithm == 'LOPQ':
+            # worker processes are started once for all entries instead of for every batch
+            approx.open_pool()
+            try:
+                return cls.approximate_index_entries(approx,da,queryset,event,batch_size)
+            finally:
+                approx.close_pool()
+        return cls.approximate_index_entries(approx,da,queryset,event,batch_size)
+
+    @classmethod
+    def approximate_index_entries(cls,approx,da,queryset,event,batch_size):
         new_approx_indexes = []
         for index_entry in queryset:
             approx_ind = IndexEntries()
-            vectors = index_entry.get_vectors()
             if da.algorithm == 'LOPQ':
-                new_entries = []
-                for i, e in enumerate(index_entry.iter_entries()):
-                    new_entries.append((e,approx.approximate(vectors[i, :])))
-                approx_ind.entries = new_entries
+                vectors = index_entry.get_vectors(mmap_mode='r')
+                vectors = vectors.reshape((vectors.shape[0], -1))
+                codes = []
+                for start in range(0, vectors.shape[0], batch_size):
+                    codes.extend(approx.approximate_batch(vectors[start:start + batch_size]))
+                approx_ind.entries = zip(index_entry.iter_entries(), codes)
             elif da.algorithm == 'PCA':
-                # TODO optimize this by doing matmul rather than calling for each entry
                 event.create_dir()
-                approx_vectors = np.array([approx.approximate(vectors[i, :]) for i in range(index_entry.count)])
+                vectors = index_entry.get_vectors(mmap_mode='r')
+                vectors = vectors.reshape((vectors.shape[0], -1))
+                approx_vectors = np.empty((vectors.shape[0], approx.components), dtype=np.float32)
+                for start in range(0, vectors.shape[0], batch_size):
+                    block = vectors[start:start + batch_size]
+                    approx_vectors[start:start + block.shape[0]] = approx.approximate_batch(block)
                 approx_ind.store_numpy_features(approx_vectors,event)
                 index_entry.copy_entries(approx_ind, event)
             elif da.algorithm == "FAISS":
+                vectors = index_entry.get_vectors()
                 feat_fname = approx_ind.store_faiss_features(event)
                 approx.approximate_batch(np.atleast_2d(vectors.squeeze()),feat_fname)
                 index_entry.copy_entries(approx_ind, event)
@@ -1,8 +1,110 @@
 import time
 import shlex,json,os, logging
 import subprocess as sp
+from bisect import bisect_right
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+from django.conf import settings
+from django.db import connection
+import numpy as np
 from PIL import Image
-from ..models import Frame, Segment
+from ..models import Frame, Segment, frame_pack_path
+
+try:
+    from dvalib.frame_stream import FrameStream
+    from dvalib.frame_pack import FramePack
+except ImportError:
+    logging.warning("Could not import dvalib.frame_stream, streaming decode is unavailable")
+
+
+def probe_segment(segments_dir, segment_file_name):
+    """
+    Returns stream json, frame list csv and time taken to probe a segment.
+    """
+    start = time.time()
+    command = 'ffprobe -select_streams v -show_streams  -print_format json {}  '.format(segment_file_name)
+    segment_json = sp.check_output(shlex.split(command), cwd=segments_dir)
+    command = 'ffprobe -show_frames -select_streams v:0 -print_format csv {}'.format(segment_file_name)
+    framelist = sp.check_output(shlex.split(command), cwd=segments_dir)
+    return segment_json, framelist, time.time() - start
+
+
+def split_source_frames(frames, starts):
+    """
+    Splits the frame list of the source, {index: (pict_type, t)}, into one frame list per segment using segment start
+    times. Timestamps are shifted so that the first frame lines up with the first segment.
+    """
+    segment_frames = [{} for _ in starts]
+    offset = None
+    for findex in range(len(frames)):
+        pict_type, t = frames[findex]
+        if offset is None:
+            # source timestamps may not start at zero unlike the segment list
+            offset = t - starts[0]
+        position = max(bisect_right(starts, t - offset + 1e-6) - 1, 0)
+        segment_frames[position][len(segment_frames[position])] = (pict_type, t - offset)
+    return segment_frames
+
+
+def segment_stream_json(source_json, start_time, end_time, frame_count):
+    """
+    Stream json of a segment derived from the stream json of the source, the video stream gets the segment's
+    start time, duration and number of frames while values only valid for the whole source are dropped.
+    """
+    metadata = json.loads(source_json)
+    for stream in metadata.get('streams', []):
+        for key in ('duration_ts', 'nb_read_frames', 'nb_read_packets', 'bit_rate', 'start_pts'):
+            stream.pop(key, None)
+        stream['start_time'] = "{:.6f}".format(start_time)
+        stream['duration'] = "{:.6f}".format(end_time - start_time)
+        if stream.get('codec_type') == 'video':
+            stream['nb_frames'] = str(frame_count)
+        else:
+            stream.pop('nb_frames', None)
+    return json.dumps(metadata)
+
+
+class AdaptiveSampler(object):
+    """
+    Picks frames when the mean absolute difference of a downsampled frame accumulated since the last selected frame
+    exceeds threshold, at most max_fps and at least min_fps. Rate limits use a grid of absolute timestamps so that
+    segments decoded independently sample on the same grid as the whole video, only scene changes detected within
+    the first max_fps slot of a segment can differ since the sampler has no history there.
+    """
+
+    def __init__(self, min_fps=None, max_fps=None, threshold=None, size=32):
+        self.min_fps = float(min_fps or settings.ADAPTIVE_MIN_FPS)
+        self.max_fps = float(max_fps or settings.ADAPTIVE_MAX_FPS)
+        self.threshold = float(threshold or settings.ADAPTIVE_SCENE_THRESHOLD)
+        if self.min_fps > self.max_fps:
+            raise ValueError("min_fps {} is greater than max_fps {}".format(self.min_fps, self.max_fps))
+        self.size = size
+        self.previous = None
+        self.change = 0.0
+        self.last_slot = None
+
+    def thumbnail(self, image):
+        step_y, step_x = max(image.shape[0] // self.size, 1), max(image.shape[1] // self.size, 1)
+        return image[::step_y, ::step_x].mean(axis=-1, dtype=np.float32) / 255.0
+
+    def update(self, t, image):
+        """
+        Returns True if the frame at time t should be kept.
+        """
+        thumbnail = self.thumbnail(image)
+        if self.previous is not None:
+            self.change += float(np.abs(thumbnail - self.previous).mean())
+        self.previous = thumbnail
+        slot = int(t * self.max_fps + 1e-6)
+        if slot == self.last_slot:
+            return False
+        # a frame is forced in the max_fps slot which contains a boundary of the min_fps grid
+        boundary = int(t * self.min_fps + 1e-6) / self.min_fps
+        if boundary >= slot / self.max_fps - 1e-6 or self.change >= self.threshold:
+            self.last_slot = slot
+            self.change = 0.0
+            return True
+        return False
 
 
 class VideoDecoder(object):
@@ -22,6 +124,7 @@ class VideoDecoder(object):
         self.metadata = {}
         self.segment_frames_dict = {}
         self.csv_format = None
+        self.streamed_frames = []
 
     def detect_csv_segment_format(self):
         format_path = "{}format.txt".format(self.segments_dir)
@@ -80,14 +183,23 @@ class VideoDecoder(object):
         self.dvideo.width = self.width
         self.dvideo.save()
 
-    def decode_segment(self,ds,event_id, denominator=None,frame_indexes=None):
+    def decode_segment(self,ds,event_id, denominator=None,frame_indexes=None, keyframes_only=False, adaptive=None):
         existing_frame_indexes = { f.frame_index
                                    for f in Frame.objects.filter(video_id=ds.video_id,segment_index=ds.segment_index)}
         existing_count = len(existing_frame_indexes)
         output_dir = "{}/{}/{}/".format(self.media_dir, self.primary_key, 'frames')
         input_segment = ds.path()
         df_list = []
-        if denominator:
+        if adaptive:
+            df_list = self.decode_adaptive(ds, event_id, output_dir, existing_frame_indexes,
+                                           adaptive if isinstance(adaptive, dict) else {})
+            if settings.ENABLE_FRAME_PACKS:
+                self.pack_segment(ds, output_dir, df_list)
+            return df_list
+        if keyframes_only:
+            ordered_frames = self.select_frames(ds, denominator, keyframes_only=True)
+            self.decode_keyframes(ds, output_dir, len(ordered_frames))
+        elif denominator:
             # Alternative to igndts is setting vsync vfr
             ffmpeg_command = 'ffmpeg -fflags +igndts -loglevel panic -i {} -vf'.format(input_segment)
             filter_command = '"select=not(mod(n\,{}))+eq(pict_type\,PICT_TYPE_I)" -vsync 0'.format(denominator)
@@ -98,9 +210,7 @@ class VideoDecoder(object):
                 _ = sp.check_output(shlex.split(command), stderr=sp.STDOUT)
             except:
                 raise ValueError,"for {} could not run {}".format(self.dvideo.name,command)
-            segment_frames_dict = ds.framelist
-            ordered_frames = sorted([(int(k),v) for k,v in segment_frames_dict.iteritems()
-                                     if int(k) % denominator == 0 or v[0] == 'I'])
+            ordered_frames = self.select_frames(ds, denominator)
         elif frame_indexes:
             denominator = 1
             ffmpeg_command = 'ffmpeg -fflags +igndts -loglevel panic -i {} -vf'.format(input_segment)
@@ -141,13 +251,252 @@ class VideoDecoder(object):
                 df.event_id = event_id
                 df.w = frame_width
                 df_list.append(df)
+        if settings.ENABLE_FRAME_PACKS:
+            self.pack_segment(ds, output_dir, df_list)
         return df_list
 
-    def segment_video(self,event_id):
+    def pack_segment(self, ds, output_dir, df_list):
+        """
+        Packs newly decoded frames of a segment into a single file, JPEGs are kept as a local copy.
+        """
+        if df_list:
+            pack_path = frame_pack_path(self.dvideo.pk, ds.segment_index, self.media_dir)
+            frame_indexes = {df.frame_index for df in df_list}
+            if os.path.isfile(pack_path):
+                # keep frames packed by an earlier decode of the same segment
+                with FramePack(pack_path) as previous:
+                    for frame_index in previous.frame_indexes:
+                        if frame_index not in frame_indexes:
+                            if not os.path.isfile("{}/{}.jpg".format(output_dir, frame_index)):
+                                previous.extract(frame_index, "{}/{}.jpg".format(output_dir, frame_index))
+                            frame_indexes.add(frame_index)
+            FramePack.write(pack_path, [(i, "{}/{}.jpg".format(output_dir, i)) for i in sorted(frame_indexes)])
+            for df in df_list:
+                df.packed = True
+
+    def probe_segments(self, segments_dir, segments):
+        """
+        Probes segments using a pool of threads each running ffprobe, returns (stream json, frames) per segment.
+        """
+        pool = ThreadPool(settings.SEGMENT_PROBE_WORKERS or cpu_count())
+        try:
+            probes = pool.map(lambda segment: probe_segment(segments_dir, segment[1]), segments)
+        finally:
+            pool.close()
+            pool.join()
+        timings = [t for _, _, t in probes]
+        if timings:
+            slowest = max(range(len(timings)), key=lambda i: timings[i])
+            logging.info("Probed {} segments, mean {:.3f}s max {:.3f}s (segment {})".format(
+                len(timings), sum(timings) / len(timings), timings[slowest], segments[slowest][0]))
+        return [(segment_json, self.parse_segment_framelist(segment[0], framelist))
+                for segment, (segment_json, framelist, _) in zip(segments, probes)]
+
+    def probe_source(self, segments):
+        """
+        Probes the source video once and splits its frame list using segment start times, since segments are cut
+        at keyframes without re-encoding frames of a segment are contiguous in the source.
+        """
+        command = ['ffprobe', '-select_streams', 'v', '-show_streams', '-print_format', 'json', self.local_path]
+        source_json = sp.check_output(command)
+        command = ['ffprobe', '-show_frames', '-select_streams', 'v:0', '-print_format', 'csv', self.local_path]
+        frames = self.parse_segment_framelist('source', sp.check_output(command))
+        segment_frames = split_source_frames(frames, [segment[2] for segment in segments])
+        return [(segment_stream_json(source_json, start_time, end_time, len(f)), f)
+                for (_, _, start_time, end_time), f in zip(segments, segment_frames)]
+
+    def get_frame_rate(self):
+        for stream in self.metadata.get('streams', []):
+            if stream.get('codec_type') == 'video':
+                num, den = stream['avg_frame_rate'].split('/')
+                if float(den) and float(num):
+                    return float(num) / float(den)
+        raise ValueError("Could not determine frame rate of {}".format(self.local_path))
+
+    def get_keyframe_times(self):
+        command = ['ffprobe', '-v', 'quiet', '-skip_frame', 'nokey', '-select_streams', 'v:0', '-show_entries',
+                   'frame=best_effort_timestamp_time', '-print_format', 'csv=p=0', self.local_path]
+        return [float(line.strip().split(',')[0]) for line in sp.check_output(command).splitlines()
+                if line.strip() and line.strip().split(',')[0] != 'N/A']
+
+    def segment_options(self, segment_time=None, segment_frames=None, segment_keyframes=None):
+        """
+        Segment muxer options: target a duration in seconds, a number of frames or split every N keyframes.
+        Since streams are copied, segments always begin at a keyframe.
+        """
+        if segment_keyframes:
+            keyframe_times = self.get_keyframe_times()[::int(segment_keyframes)][1:]
+            if keyframe_times:
+                return '-segment_times {}'.format(','.join('{:.6f}'.format(t) for t in keyframe_times))
+            segment_time = self.duration or 1
+        elif segment_frames:
+            segment_time = float(segment_frames) / self.get_frame_rate()
+        return '-segment_time {}'.format(segment_time or settings.DEFAULT_SEGMENT_TIME)
+
+    def select_frames(self, ds, denominator, keyframes_only=False):
+        """
+        Frames of a segment kept when decoding one in every denominator frames as well as all I-frames.
+        """
+        if keyframes_only:
+            return sorted([(int(k),v) for k,v in ds.framelist.iteritems() if v[0] == 'I'])
+        return sorted([(int(k),v) for k,v in ds.framelist.iteritems() if int(k) % denominator == 0 or v[0] == 'I'])
+
+    def decode_keyframes(self, ds, output_dir, expected_count):
+        """
+        Decodes only keyframes by skipping all other frames in the decoder rather than decoding and then dropping
+        them with a select filter. If the decoder emits a different number of frames than the I-frames in the
+        framelist (e.g. I-frames which are not keyframes) the slower select filter is used instead.
+        """
+        output_command = "{}/segment_{}_%d_b.jpg".format(output_dir,ds.segment_index)
+        commands = ['ffmpeg -fflags +igndts -loglevel panic -skip_frame nokey -i {} -vsync 0 {}'.format(
+                        ds.path(), output_command),
+                    'ffmpeg -fflags +igndts -loglevel panic -i {} -vf "select=eq(pict_type\,PICT_TYPE_I)" -vsync 0 '
+                    '{}'.format(ds.path(), output_command)]
+        for command in commands:
+            logging.info(command)
+            try:
+                _ = sp.check_output(shlex.split(command), stderr=sp.STDOUT)
+            except:
+                raise ValueError,"for {} could not run {}".format(self.dvideo.name,command)
+            decoded = 0
+            while os.path.isfile(output_command % (decoded + 1)):
+                decoded += 1
+            if decoded == expected_count:
+                return
+            logging.warning("{} decoded {} keyframes, expected {}".format(ds.path(), decoded, expected_count))
+            for i in range(decoded):
+                os.remove(output_command % (i + 1))
+        raise ValueError("for {} could not decode {} I-frames of segment {}".format(self.dvideo.name, expected_count,
+                                                                                   ds.segment_index))
+
+    def decode_adaptive(self, ds, event_id, output_dir, existing_frame_indexes, options):
+        """
+        Decodes every frame of a segment into memory and only writes frames chosen by AdaptiveSampler, options
+        may contain min_fps, max_fps and threshold.
+        """
+        sampler = AdaptiveSampler(options.get('min_fps'), options.get('max_fps'), options.get('threshold'))
+        ordered_frames = sorted([(int(k), v) for k, v in ds.framelist.iteritems()])
+        stream = FrameStream(ds.path(), self.dvideo.width, self.dvideo.height)
+        df_list = []
+        decoded, kept = 0, 0
+        try:
+            for i, image in enumerate(stream):
+                if i >= len(ordered_frames):
+                    raise ValueError("{} decoded more frames than expected {}".format(ds.path(), len(ordered_frames)))
+                decoded += 1
+                frame_index, frame_data = ordered_frames[i]
+                if not sampler.update(float(frame_data[1]), image):
+                    continue
+                kept += 1
+                findex = int(frame_index + ds.start_index)
+                Image.fromarray(image).save("{}/{}.jpg".format(output_dir, findex))
+                if findex not in existing_frame_indexes:
+                    df = Frame()
+                    df.frame_index = findex
+                    df.video_id = self.dvideo.pk
+                    df.keyframe = frame_data[0] == 'I'
+                    df.t = float(frame_data[1])
+                    df.segment_index = ds.segment_index
+                    df.h, df.w = image.shape[:2]
+                    df.event_id = event_id
+                    df_list.append(df)
+        finally:
+            stream.close()
+        if decoded != len(ordered_frames):
+            raise ValueError("{} decoded {} frames, expected {}".format(ds.path(), decoded, len(ordered_frames)))
+        logging.info("Adaptive sampling kept {} of {} frames of segment {}".format(kept, decoded, ds.segment_index))
+        return df_list
+
+    def stream_segment(self, ds, event_id, denominator, keyframes_only=False):
+        """
+        Decodes frames of a segment straight into memory instead of writing JPEGs, yields (Frame, RGB array). Frames
+        are indexed exactly as decode_segment would, they are not saved to the database.
+        """
+        ordered_frames = self.select_frames(ds, denominator, keyframes_only)
+        if keyframes_only:
+            stream = FrameStream(ds.path(), self.dvideo.width, self.dvideo.height, input_options='-skip_frame nokey')
+        else:
+            video_filter = 'select=not(mod(n\,{}))+eq(pict_type\,PICT_TYPE_I)'.format(denominator)
+            stream = FrameStream(ds.path(), self.dvideo.width, self.dvideo.height, video_filter=video_filter)
+        decoded = 0
+        try:
+            for i, image in enumerate(stream):
+                if i >= len(ordered_frames):
+                    raise ValueError("{} decoded more frames than expected {}".format(ds.path(), len(ordered_frames)))
+                frame_index, frame_data = ordered_frames[i]
+                df = Frame()
+                df.frame_index = int(frame_index + ds.start_index)
+                df.video_id = self.dvideo.pk
+                df.keyframe = frame_data[0] == 'I'
+                df.t = float(frame_data[1])
+                df.segment_index = ds.segment_index
+                df.h, df.w = image.shape[:2]
+                df.event_id = event_id
+                decoded += 1
+                yield df, image
+        finally:
+            stream.close()
+        if decoded != len(ordered_frames):
+            raise ValueError("{} decoded {} frames, expected {}".format(ds.path(), decoded, len(ordered_frames)))
+
+    def stream_segments(self, segments, event_id, denominator, batch_size, save_frames=False, keyframes_only=False):
+        """
+        Yields batches of (Frames, RGB arrays) across segments. Frames which do not exist yet are collected in
+        self.streamed_frames for finalize like decode_segments would create them, their JPEGs are only written when
+        save_frames is set.
+        """
+        self.streamed_frames = []
+        frames, images = [], []
+        for ds in segments:
+            existing_frame_indexes = set(Frame.objects.filter(video_id=ds.video_id, segment_index=ds.segment_index)
+                                         .values_list('frame_index', flat=True))
+            for df, image in self.stream_segment(ds, event_id, denominator, keyframes_only):
+                if df.frame_index not in existing_frame_indexes:
+                    if save_frames:
+                        Image.fromarray(image).save(df.path())
+                    self.streamed_frames.append(df)
+                frames.append(df)
+                images.append(image)
+                if len(images) == batch_size:
+                    yield frames, images
+                    frames, images = [], []
+        if images:
+            yield frames, images
+
+    def decode_segments(self, segments, event_id, denominator=None, frame_indexes=None, workers=1,
+                        keyframes_only=False, adaptive=None):
+        """
+        Decodes segments using up to workers concurrent ffmpeg processes, returns Frames of all segments in order.
+        """
+        if workers <= 1 or len(segments) <= 1:
+            df_list = []
+            for ds in segments:
+                df_list += self.decode_segment(ds, event_id, denominator=denominator, frame_indexes=frame_indexes,
+                                               keyframes_only=keyframes_only, adaptive=adaptive)
+            return df_list
+
+        def decode(ds):
+            try:
+                return self.decode_segment(ds, event_id, denominator=denominator, frame_indexes=frame_indexes,
+                                           keyframes_only=keyframes_only, adaptive=adaptive)
+            finally:
+                # each thread opens its own database connection
+                connection.close()
+
+        pool = ThreadPool(min(workers, len(segments)))
+        try:
+            return [df for df_list in pool.map(decode, segments) for df in df_list]
+        finally:
+            pool.close()
+            pool.join()
+
+    def segment_video(self,event_id, segment_time=None, segment_frames=None, segment_keyframes=None):
         segments_dir = "{}/{}/{}/".format(self.media_dir, self.primary_key, 'segments')
-        command = 'ffmpeg -loglevel panic -i {} -c copy -map 0 -segment_time 1 -f segment ' \
+        command = 'ffmpeg -loglevel panic -i {} -c copy -map 0 {} -f segment ' \
                   '-segment_list_type csv -segment_list {}/segments.csv ' \
-                  '{}/%d.mp4'.format(self.local_path, segments_dir, segments_dir)
+                  '{}/%d.mp4'.format(self.local_path, self.segment_options(segment_time, segment_frames,
+                                                                           segment_keyframes),
+                                     segments_dir, segments_dir)
         logging.info(command)
         segmentor = sp.Popen(shlex.split(command))
         segmentor.wait()
@@ -156,20 +505,19 @@ class VideoDecoder(object):
             raise ValueError
         else:
             timer_start = time.time()
-            start_index = 0
+            segments = []
             for line in file('{}/segments.csv'.format(segments_dir)):
                 segment_file_name, start_time, end_time = line.strip().split(',')
-                segment_id = int(segment_file_name.split('.')[0])
-                command = 'ffprobe -select_streams v -show_streams  -print_format json {}  '.format(segment_file_name)
-                # logging.info(command)
-                segment_json = sp.check_output(shlex.split(command), cwd=segments_dir)
-                command = 'ffprobe -show_frames -select_streams v:0 -print_format csv {}'.format(segment_file_name)
-                # logging.info(command)
-                framelist= sp.check_output(shlex.split(command), cwd=segments_dir)
-                self.segment_frames_dict[segment_id] = self.parse_segment_framelist(segment_id,framelist)
-                logging.warning("Processing line {}".format(line))
-                start_time = float(start_time)
-                end_time = float(end_time)
+                segments.append((int(segment_file_name.split('.')[0]), segment_file_name, float(start_time),
+                                 float(end_time)))
+            self.detect_csv_segment_format()
+            if settings.SEGMENT_PROBE_MODE == 'source':
+                probes = self.probe_source(segments)
+            else:
+                probes = self.probe_segments(segments_dir, segments)
+            start_index = 0
+            for (segment_id, _, start_time, end_time), (segment_json, frames) in zip(segments, probes):
+                self.segment_frames_dict[segment_id] = frames
                 ds = Segment()
                 ds.segment_index = segment_id
                 ds.framelist = self.segment_frames_dict[segment_id]
@@ -186,5 +534,4 @@ class VideoDecoder(object):
         self.dvideo.frames = sum([len(c) for c in self.segment_frames_dict.itervalues()])
         self.dvideo.segments = len(self.segment_frames_dict)
         self.dvideo.save()
-        self.detect_csv_segment_format() # detect and save
         return segments_batch
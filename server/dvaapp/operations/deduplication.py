@@ -0,0 +1,47 @@
+import logging
+from itertools import groupby
+from django.db import transaction
+from dvalib import phash
+
+
+def hash_frames(frames, hash_type, batch_size=256):
+    hashes = []
+    for i in range(0, len(frames), batch_size):
+        grayscale = phash.load_grayscale([df.path() for df in frames[i:i + batch_size]])
+        if hash_type == 'ahash':
+            hashes.append(phash.average_hashes(grayscale))
+        elif hash_type == 'phash':
+            hashes.append(phash.perceptual_hashes(grayscale))
+        else:
+            raise ValueError("Unknown hash {}, expected phash or ahash".format(hash_type))
+    return [h for batch in hashes for h in batch]
+
+
+def deduplicate_frames(frames, max_distance, hash_type='phash'):
+    """
+    Sets phash and duplicate_of on Frames (saved or not), frames of a video are grouped in order of frame_index and
+    every frame except the representative of a group links to it via duplicate_of. Downstream operations with
+    skip_duplicates only process representatives.
+    """
+    duplicates = 0
+    frames = sorted(frames, key=lambda df: (df.video_id, df.frame_index))
+    for _, video_frames in groupby(frames, key=lambda df: df.video_id):
+        video_frames = list(video_frames)
+        hashes = hash_frames(video_frames, hash_type)
+        representatives = phash.group_near_duplicates(hashes, max_distance)
+        for df, h, representative in zip(video_frames, phash.to_signed(hashes), representatives):
+            df.phash = int(h)
+            if video_frames[representative] is df:
+                df.duplicate_of = None
+            else:
+                df.duplicate_of = video_frames[representative].frame_index
+                duplicates += 1
+    logging.info("Marked {} out of {} frames as near-duplicates".format(duplicates, len(frames)))
+    return frames
+
+
+def deduplicate_queryset(queryset, max_distance, hash_type='phash'):
+    frames = deduplicate_frames(list(queryset), max_distance, hash_type)
+    with transaction.atomic():
+        for df in frames:
+            df.save(update_fields=['phash', 'duplicate_of'])
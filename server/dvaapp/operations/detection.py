@@ -1,4 +1,4 @@
-from ..models import TrainedModel
+from ..models import TrainedModel, Region
 from dvalib import detector
 
 
@@ -20,4 +20,25 @@ class Detectors(object):
             elif cd.name == 'textbox':
                 Detectors._detectors[cd.pk] = detector.TextBoxDetector(model_path=cd.get_model_path())
             else:
-                raise ValueError,"{}".format(cd.pk)
\ No newline at end of file
+                raise ValueError,"{}".format(cd.pk)
+
+    @classmethod
+    def fill_region(cls, detector_name, d, dd):
+        """
+        Copies a detection returned by a detector into a Region / QueryRegion.
+        """
+        dd.region_type = Region.DETECTION
+        if detector_name == 'textbox':
+            dd.object_name = 'TEXTBOX'
+            dd.confidence = 100.0 * d['score']
+        elif detector_name == 'face':
+            dd.object_name = 'MTCNN_face'
+            dd.confidence = 100.0
+        else:
+            dd.object_name = d['object_name']
+            dd.confidence = 100.0 * d['score']
+        dd.x = d['x']
+        dd.y = d['y']
+        dd.w = d['w']
+        dd.h = d['h']
+        return dd
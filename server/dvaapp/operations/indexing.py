@@ -9,7 +9,8 @@ except ImportError:
     np = None
     logging.warning("Could not import indexer / clustering assuming running in front-end mode")
 
-from ..models import IndexEntries, TrainedModel
+from ..models import IndexEntries, TrainedModel, crop_region_arrays
+from .decoding import VideoDecoder
 
 
 class Indexers(object):
@@ -66,26 +67,74 @@ class Indexers(object):
             else:
                 entry = df.pk
                 frame_indexes.add(df.frame_index)
-                if df.full_frame:
+                if visual_index.array_support:
+                    # regions are cropped in memory when indexed below
+                    paths.append(df)
+                elif df.full_frame:
                     paths.append(df.frame_path())
                 else:
                     paths.append(df.crop_and_get_region_path(images,temp_root))
             entries.append(entry)
         if entries:
-            logging.info(paths)  # adding temporary logging to check whether s3:// paths are being correctly used.
             # TODO Ensure that "full frame"/"regions" are not repeatedly indexed.
-            features = visual_index.index_paths(paths)
-            i = IndexEntries()
-            i.store_numpy_features(features,event)
-            i.store_entries(entries,event)
-            i.video_id = event.video_id
-            i.count = len(entries)
-            i.min_frame_index = min(frame_indexes)
-            i.max_frame_index = max(frame_indexes)
-            i.target = target
-            i.algorithm = di.name
-            i.indexer_shasum = di.shasum
-            i.event_id = event.pk
-            i.source_filter_json = event.arguments
-            index_entries.append(i)
+            if target == 'regions' and visual_index.array_support:
+                features = cls.index_regions(visual_index, paths)
+            else:
+                logging.info(paths)  # adding temporary logging to check whether s3:// paths are being correctly used.
+                features = visual_index.index_paths(paths)
+            index_entries.append(cls.create_index_entries(di, event, target, entries, features, frame_indexes))
         event.finalize({'IndexEntries':index_entries})
+
+    @classmethod
+    def index_regions(cls, visual_index, regions, chunk_size=512):
+        """
+        Indexes regions from crops sliced out of decoded frames instead of temporary JPEGs. Regions are cropped in
+        frame order so that each frame is decoded once and only one frame is kept in memory, features are returned in
+        the order of regions.
+        """
+        order = sorted(range(len(regions)), key=lambda k: (regions[k].video_id, regions[k].frame_index))
+        features = [None] * len(regions)
+        frames = {}
+        for start in range(0, len(order), chunk_size):
+            chunk = order[start:start + chunk_size]
+            crops = crop_region_arrays([regions[k] for k in chunk], frames)
+            for k, f in zip(chunk, visual_index.index_crops(crops)):
+                features[k] = f
+        return features
+
+    @classmethod
+    def index_segments(cls, di, visual_index, event, queryset, denominator, save_frames=False, keyframes_only=False):
+        """
+        Indexes frames decoded in memory from segments, Frames are created for indexed frames which do not exist yet
+        while their JPEGs are only written when save_frames is set.
+        """
+        visual_index.load()
+        decoder = VideoDecoder(dvideo=event.video, media_dir=settings.MEDIA_ROOT)
+        entries, features = [], []
+        for frames, images in decoder.stream_segments(queryset, event.pk, denominator, visual_index.batch_size,
+                                                      save_frames, keyframes_only):
+            features += visual_index.apply_images(images)
+            entries += [df.frame_index for df in frames]
+        bulk_create = {'IndexEntries': []}
+        if entries:
+            bulk_create['IndexEntries'].append(cls.create_index_entries(di, event, 'frames', entries, features,
+                                                                        set(entries)))
+        if decoder.streamed_frames:
+            bulk_create['Frame'] = decoder.streamed_frames
+        event.finalize(bulk_create)
+
+    @classmethod
+    def create_index_entries(cls, di, event, target, entries, features, frame_indexes):
+        i = IndexEntries()
+        i.store_numpy_features(features,event)
+        i.store_entries(entries,event)
+        i.video_id = event.video_id
+        i.count = len(entries)
+        i.min_frame_index = min(frame_indexes)
+        i.max_frame_index = max(frame_indexes)
+        i.target = target
+        i.algorithm = di.name
+        i.indexer_shasum = di.shasum
+        i.event_id = event.pk
+        i.source_filter_json = event.arguments
+        return i
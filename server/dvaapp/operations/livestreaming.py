@@ -1,15 +1,28 @@
 import subprocess as sp
-import os, time, logging, shlex
-from ..models import Segment
+import os, time, logging, shlex, re, io, struct, threading, bisect
+from collections import deque
+from ..models import Segment, Region, TrainedModel, Frame
 from ..fs import upload_file_to_remote
 from django.conf import settings
+from django.db import connection, transaction, IntegrityError
 from ..processing import process_next
+from ..watcher import DirectoryWatcher, IN_CREATE, IN_MOVED_TO
+from .detection import Detectors
+from .decoding import segment_stream_json
+from PIL import Image
+
+VSTATS_PATTERN = re.compile(r'time=\s*([\d.]+).*type=\s*([A-Z])')
 
 try:
     import psutil
 except ImportError:
     pass
 
+try:
+    import numpy as np
+except ImportError:
+    pass
+
 
 def kill(proc_pid):
     process = psutil.Process(proc_pid)
@@ -18,6 +31,218 @@ def kill(proc_pid):
     process.kill()
 
 
+def split_encoded_frames(frames, start_time, end_time):
+    """
+    Frames of a segment from (time, picture type) reported by the encoder. Segments begin at keyframes, so the
+    segment spans from the I-frame nearest to its start time to the I-frame nearest to its end time. Returns
+    (framelist, index after the last frame) or None if the encoder has not reported frames past the end yet.
+    """
+    if len(frames) < 2:
+        return None
+    interval = (frames[-1][0] - frames[0][0]) / (len(frames) - 1)
+    if frames[-1][0] < end_time + interval:
+        return None
+    keyframes = [i for i, (_, pict_type) in enumerate(frames) if pict_type == 'I']
+    if not keyframes:
+        return None
+    first = min(keyframes, key=lambda i: abs(frames[i][0] - start_time))
+    last = min(keyframes, key=lambda i: abs(frames[i][0] - end_time))
+    tolerance = 1.5 * interval
+    if last <= first or abs(frames[first][0] - start_time) > tolerance or abs(frames[last][0] - end_time) > tolerance:
+        return None
+    offset = start_time - frames[first][0]
+    return {k: (frames[i][1], frames[i][0] + offset) for k, i in enumerate(range(first, last))}, last
+
+
+def live_frame_position(stream_frame, segments):
+    """
+    Locates the stream_frame-th encoded frame in archived segments, given in order as (number of the first encoded
+    frame, segment_index, start_index, framelist). Returns (segment_index, frame_index, (pict_type, time)) or None
+    if the frame is not part of any segment.
+    """
+    k = bisect.bisect_right([s[0] for s in segments], stream_frame) - 1
+    if k < 0:
+        return None
+    first, segment_index, start_index, framelist = segments[k]
+    offset = stream_frame - first
+    if offset >= len(framelist):
+        return None
+    return segment_index, start_index + offset, framelist[offset]
+
+
+class LiveInference(object):
+    """
+    Runs a resident detector on frames decoded in-process from the live stream alongside segment archival. Frames
+    are read from a pipe into a bounded ring buffer, when the detector falls behind the oldest frames are dropped so
+    that results stay close to real time and the capture process is never blocked. Regions are committed in
+    micro-batches every commit_interval seconds, once the segment containing their frame has been archived.
+    """
+
+    def __init__(self, event, video_id, fifo_path, options):
+        self.event = event
+        self.video_id = video_id
+        self.fifo_path = fifo_path
+        self.rate = options.get('rate', settings.DEFAULT_RATE)
+        self.batch_size = options.get('batch_size', 1)
+        self.min_score = options.get('min_score', 0.2)
+        self.commit_interval = options.get('commit_interval', settings.LIVE_COMMIT_INTERVAL)
+        self.buffer = deque(maxlen=options.get('buffer_size', settings.LIVE_BUFFER_SIZE))
+        self.condition = threading.Condition()
+        self.reading = False
+        self.decoded = 0
+        self.dropped = 0
+        self.committed = 0
+        self.frames_created = 0
+        self.pending = []
+        self.unmapped = []
+        self.segments = []
+        self.last_commit = time.time()
+        cd = TrainedModel.objects.get(**options['trainedmodel_selector'])
+        self.detector_name = cd.name
+        Detectors.load_detector(cd)
+        self.detector = Detectors._detectors[cd.pk]
+        if not hasattr(self.detector, 'detect_images'):
+            raise NotImplementedError("{} cannot detect decoded frames".format(cd.name))
+        if self.detector.session is None:
+            self.detector.load()
+        self.reader = threading.Thread(target=self.read_frames)
+        self.reader.daemon = True
+        self.worker = threading.Thread(target=self.run)
+        self.worker.daemon = True
+
+    def start(self):
+        self.reading = True
+        self.reader.start()
+        self.worker.start()
+
+    def read_frames(self):
+        """
+        Reads BMP images written by ffmpeg for every rate-th frame of the stream.
+        """
+        try:
+            with open(self.fifo_path, 'rb') as fh:
+                while True:
+                    header = fh.read(14)
+                    if len(header) < 14:
+                        break
+                    size = struct.unpack('<I', header[2:6])[0]
+                    image = np.asarray(Image.open(io.BytesIO(header + fh.read(size - 14))).convert('RGB'))
+                    with self.condition:
+                        if len(self.buffer) == self.buffer.maxlen:
+                            self.dropped += 1
+                        self.buffer.append((self.decoded * self.rate, image))
+                        self.decoded += 1
+                        self.condition.notify()
+        except:
+            logging.exception("Failed to read live frames from {}".format(self.fifo_path))
+        finally:
+            with self.condition:
+                self.reading = False
+                self.condition.notify()
+
+    def next_batch(self):
+        with self.condition:
+            while not self.buffer and self.reading:
+                self.condition.wait(self.commit_interval)
+                if not self.buffer:
+                    return []
+            return [self.buffer.popleft() for _ in range(min(self.batch_size, len(self.buffer)))]
+
+    def run(self):
+        try:
+            while self.reading or self.buffer:
+                batch = self.next_batch()
+                if batch:
+                    shapes = {image.shape for _, image in batch}
+                    if len(shapes) > 1:
+                        # detect_images expects images of identical shape, e.g. when the stream resolution changes
+                        detections = [d for _, image in batch for d in self.detector.detect_images([image],
+                                                                                                   self.min_score)]
+                    else:
+                        detections = self.detector.detect_images([image for _, image in batch], self.min_score)
+                    for (stream_frame, image), frame_detections in zip(batch, detections):
+                        for d in frame_detections:
+                            dd = Detectors.fill_region(self.detector_name, d, Region())
+                            dd.video_id = self.video_id
+                            dd.event_id = self.event.pk
+                            self.unmapped.append((stream_frame, image.shape[:2], dd))
+                if time.time() - self.last_commit >= self.commit_interval:
+                    self.commit()
+            self.commit()
+        except:
+            logging.exception("Live inference failed")
+        finally:
+            connection.close()
+
+    def add_segment(self, first, ds):
+        """
+        Called by the capture once a segment is archived, first is the number of its first encoded frame.
+        """
+        with self.condition:
+            self.segments.append((first, ds.segment_index, ds.start_index, ds.framelist))
+
+    def map_regions(self, final=False):
+        """
+        Assigns frame_index and segment_index of the archived frame to regions and creates missing Frame rows.
+        Regions on frames past the last archived segment wait for it unless final, others are dropped.
+        """
+        with self.condition:
+            segments = list(self.segments)
+        archived_end = segments[-1][0] + len(segments[-1][3]) if segments else 0
+        frames, unmapped, unarchived = {}, [], 0
+        for stream_frame, (h, w), dd in self.unmapped:
+            position = live_frame_position(stream_frame, segments)
+            if position is None:
+                if stream_frame >= archived_end and not final:
+                    unmapped.append((stream_frame, (h, w), dd))
+                else:
+                    unarchived += 1
+                continue
+            dd.segment_index, dd.frame_index, (pict_type, t) = position
+            if dd.frame_index not in frames:
+                frames[dd.frame_index] = Frame(video_id=self.video_id, event_id=self.event.pk, h=h, w=w,
+                                               frame_index=dd.frame_index, segment_index=dd.segment_index,
+                                               keyframe=pict_type == 'I', t=float(t))
+            self.pending.append(dd)
+        self.unmapped = unmapped
+        if unarchived:
+            logging.warning("Live inference dropped {} regions on frames missing from segments".format(unarchived))
+        if frames:
+            existing = set(Frame.objects.filter(video_id=self.video_id, frame_index__in=list(frames))
+                           .values_list('frame_index', flat=True))
+            new_frames = [df for frame_index, df in sorted(frames.items()) if frame_index not in existing]
+            try:
+                with transaction.atomic():
+                    Frame.objects.bulk_create(new_frames, batch_size=1000)
+                self.frames_created += len(new_frames)
+            except IntegrityError:
+                # frames created meanwhile by decoding the same segment
+                for df in new_frames:
+                    try:
+                        with transaction.atomic():
+                            df.save()
+                        self.frames_created += 1
+                    except IntegrityError:
+                        pass
+
+    def commit(self, final=False):
+        self.map_regions(final)
+        if self.pending:
+            for dd in self.pending:
+                dd.per_event_index = self.committed
+                dd.id = '{}_{}'.format(self.event.pk, self.committed)
+                self.committed += 1
+            Region.objects.bulk_create(self.pending, batch_size=1000)
+            self.pending = []
+        self.last_commit = time.time()
+        if self.dropped:
+            logging.info("Live inference dropped {} of {} frames".format(self.dropped, self.decoded))
+
+    def join(self, timeout=None):
+        self.reader.join(timeout)
+        self.worker.join(timeout)
+
+
 class LivestreamCapture(object):
 
     def __init__(self,dv,event,wait_time=3,max_time=31536000,max_wait=120,segments_batch_size=5):
@@ -41,6 +266,19 @@ class LivestreamCapture(object):
         self.segments_batch_size = event.arguments.get('segments_batch_size',segments_batch_size)
         self.segments_batch = set()
         self.last_segment_time = time.time()
+        self.use_inotify = event.arguments.get('use_inotify', True)
+        self.watcher = None
+        self.segment_list = {}
+        self.segment_list_offset = 0
+        self.encoded_frames = []
+        self.vstats_offset = 0
+        self.encoded_offset = 0
+        self.next_encoded_frame = 0
+        self.stream_json = None
+        self.live = None
+        if event.arguments.get('live'):
+            self.live = LiveInference(event, self.dv.pk, '{}live.fifo'.format(self.segments_dir),
+                                      event.arguments['live'])
 
     def detect_csv_segment_format(self):
         format_path = "{}format.txt".format(self.segments_dir)
@@ -67,9 +305,47 @@ class LivestreamCapture(object):
     def start_process(self):
         self.start_time = time.time()
         args = ['./scripts/consume_livestream.sh',self.path,self.segments_dir]
+        if self.live:
+            if not os.path.exists(self.live.fifo_path):
+                os.mkfifo(self.live.fifo_path)
+            args += [self.live.fifo_path, str(self.live.rate)]
+            self.live.start()
         logging.info(args)
         self.capture = sp.Popen(args,cwd="/root/DVA/server/")
         logging.info("Started capturing {} using process {}".format(self.path,self.capture))
+        self.watcher = DirectoryWatcher(self.segments_dir, poll_interval=self.wait_time, use_inotify=self.use_inotify)
+
+    def read_new_lines(self, path, offset):
+        """
+        Returns complete lines appended to path since offset and the new offset.
+        """
+        if not os.path.isfile(path):
+            return [], offset
+        with open(path) as fh:
+            fh.seek(offset)
+            data = fh.read()
+        complete = data[:data.rfind('\n') + 1]
+        return complete.splitlines(), offset + len(complete)
+
+    def read_segmenter_output(self):
+        """
+        Reads segments closed by the segment muxer and frames reported by the encoder since the last call.
+        """
+        lines, self.segment_list_offset = self.read_new_lines('{}segments.csv'.format(self.segments_dir),
+                                                              self.segment_list_offset)
+        for line in lines:
+            if line.strip():
+                segment_file_name, start_time, end_time = line.strip().split(',')
+                self.segment_list[int(segment_file_name.split('.')[0])] = (float(start_time), float(end_time))
+        lines, self.vstats_offset = self.read_new_lines('{}vstats.log'.format(self.segments_dir), self.vstats_offset)
+        for line in lines:
+            match = VSTATS_PATTERN.search(line)
+            if match:
+                self.encoded_frames.append((float(match.group(1)), match.group(2)))
+
+    def segment_ready(self, segment_index):
+        return segment_index in self.segment_list or \
+               os.path.isfile('{}{}.mp4'.format(self.segments_dir, segment_index + 1))
 
     def parse_segment_framelist(self,segment_id, framelist):
         if self.csv_format is None:
@@ -92,7 +368,8 @@ class LivestreamCapture(object):
         segments_processed = False
         logging.info(self.last_processed_segment_index)
         if not final:
-            while os.path.isfile('{}{}.mp4'.format(self.segments_dir,self.last_processed_segment_index+2)):
+            self.read_segmenter_output()
+            while self.segment_ready(self.last_processed_segment_index+1):
                 segment_file_name = '{}{}.mp4'.format(self.segments_dir,self.last_processed_segment_index+1)
                 segment_index = self.last_processed_segment_index + 1
                 self.process_segment(segment_index, segment_file_name)
@@ -105,17 +382,43 @@ class LivestreamCapture(object):
                 segments_processed = True
         return segments_processed
 
+    def segmenter_framelist(self, segment_index):
+        """
+        Frames of a segment from the segmenter's own output and the number of its first encoded frame, None if it
+        is not available yet.
+        """
+        if segment_index not in self.segment_list:
+            return None
+        start_time, end_time = self.segment_list[segment_index]
+        split = split_encoded_frames(self.encoded_frames, start_time, end_time)
+        if split is None:
+            return None
+        frames, end = split
+        first = self.encoded_offset + end - len(frames)
+        del self.encoded_frames[:end]
+        self.encoded_offset += end
+        return frames, first
+
     def process_segment(self, segment_index, segment_file_name):
         logging.info("processing {} {}".format(segment_index, segment_file_name))
-        command = 'ffprobe -select_streams v -show_streams  -print_format json {}  '.format(segment_file_name)
-        # logging.info(command)
-        segment_json = sp.check_output(shlex.split(command), cwd=self.segments_dir)
-        command = 'ffprobe -show_frames -select_streams v:0 -print_format csv {}'.format(segment_file_name)
-        # logging.info(command)
-        framelist = sp.check_output(shlex.split(command), cwd=self.segments_dir)
-        self.segment_frames_dict[segment_index] = self.parse_segment_framelist(segment_index, framelist)
-        start_time = 0.0
-        end_time = 0.0
+        start_time, end_time = self.segment_list.get(segment_index, (0.0, 0.0))
+        split = self.segmenter_framelist(segment_index)
+        if split is None:
+            logging.info("probing {} since the segmenter has not reported its frames".format(segment_file_name))
+            command = 'ffprobe -select_streams v -show_streams  -print_format json {}  '.format(segment_file_name)
+            segment_json = sp.check_output(shlex.split(command), cwd=self.segments_dir)
+            command = 'ffprobe -show_frames -select_streams v:0 -print_format csv {}'.format(segment_file_name)
+            framelist = sp.check_output(shlex.split(command), cwd=self.segments_dir)
+            frames = self.parse_segment_framelist(segment_index, framelist)
+            first = self.next_encoded_frame
+        else:
+            frames, first = split
+            if self.stream_json is None:
+                # probed once, metadata of later segments is derived from it
+                command = 'ffprobe -select_streams v -show_streams  -print_format json {}  '.format(segment_file_name)
+                self.stream_json = sp.check_output(shlex.split(command), cwd=self.segments_dir)
+            segment_json = segment_stream_json(self.stream_json, start_time, end_time, len(frames))
+        self.segment_frames_dict[segment_index] = frames
         ds = Segment()
         ds.segment_index = segment_index
         ds.start_time = start_time
@@ -128,6 +431,9 @@ class LivestreamCapture(object):
         ds.event_id = self.event.pk
         ds.metadata = segment_json
         ds.save()
+        self.next_encoded_frame = first + ds.frame_count
+        if self.live:
+            self.live.add_segment(first, ds)
         self.last_processed_segment_index = segment_index
         if settings.ENABLE_CLOUDFS:
             upload_file_to_remote(ds.path(""))
@@ -148,16 +454,30 @@ class LivestreamCapture(object):
                 logging.exception("Failed to upload")
                 break
             if not new_segments:
-                time.sleep(self.wait_time)
+                # wakes up as soon as a segment is created or the segment list / encoder stats are written to
+                self.watcher.wait(self.wait_time, accept=lambda name, mask: name in ('segments.csv', 'vstats.log') or
+                                  (name.endswith('.mp4') and mask & (IN_CREATE | IN_MOVED_TO)))
             if (time.time() - self.last_segment_time) > self.max_wait:
                 logging.info("no new segment found in last {} seconds".format(self.max_wait))
                 break
         logging.info("Killing capture process")
         kill(self.capture.pid)
+        self.watcher.close()
         try:
             self.upload(final=True)
         except:
             pass
 
     def finalize(self):
+        if self.live:
+            self.live.join(timeout=60)
+            # regions on frames of the final segment
+            self.live.commit(final=True)
+            results = self.event.results if self.event.results else {}
+            created_objects = results.setdefault('created_objects', {})
+            created_objects['Region'] = created_objects.get('Region', 0) + self.live.committed
+            if self.live.frames_created:
+                created_objects['Frame'] = created_objects.get('Frame', 0) + self.live.frames_created
+            self.event.results = results
+            self.event.save()
         process_next(self.event, map_filters=[{'segment_index__in': list(self.segments_batch)}])
\ No newline at end of file
@@ -1,7 +1,11 @@
-import logging
+import logging, time
+from collections import defaultdict
+from django.conf import settings
+from django.db.models import Count, Min, Sum
+from dva.in_memory import redis_client
+from ..lru import LRUCache
 from .approximation import Approximators
 from .indexing import Indexers
-from collections import defaultdict
 
 try:
     from dvalib import indexer, retriever
@@ -10,7 +14,8 @@ except ImportError:
     np = None
     logging.warning("Could not import indexer / clustering assuming running in front-end mode")
 
-from ..models import IndexEntries, QueryResult, Region, Retriever
+from ..models import IndexEntries, QueryResult, Region, Retriever, INDEX_ENTRIES_VERSION_KEY, \
+    INDEX_ENTRIES_DELETED_KEY
 
 
 class Retrievers(object):
@@ -18,7 +23,11 @@ class Retrievers(object):
     _retriever_object = {}
     _selector_to_dr = {}
     _index_entries = {}
-    _index_count = defaultdict(int)
+    _index_version = {}
+    _index_watermark = {}
+    _index_synced = {}
+    _index_reconciled = {}
+    _region_cache = LRUCache(settings.REGION_CACHE_SIZE)
 
     @classmethod
     def get_retriever(cls, args):
@@ -31,14 +40,19 @@ class Retrievers(object):
         retriever_pk = dr.pk
         if retriever_pk not in cls._visual_retriever:
             cls._retriever_object[retriever_pk] = dr
+            store_path = None
+            if settings.ENABLE_PERSISTENT_RETRIEVER:
+                store_path = "{}/retrievers/{}_{}_{}.vectors".format(settings.MEDIA_ROOT, dr.pk, dr.indexer_shasum,
+                                                                     dr.approximator_shasum)
             if dr.algorithm == Retriever.EXACT and dr.approximator_shasum and dr.approximator_shasum.strip():
                 approximator, da = Approximators.get_trained_model(
                     {"trainedmodel_selector": {"shasum": dr.approximator_shasum}})
                 da.ensure()
                 approximator.load()
-                cls._visual_retriever[retriever_pk] = retriever.SimpleRetriever(name=dr.name, approximator=approximator)
+                cls._visual_retriever[retriever_pk] = retriever.SimpleRetriever(name=dr.name, approximator=approximator,
+                                                                                store_path=store_path)
             elif dr.algorithm == Retriever.EXACT:
-                cls._visual_retriever[retriever_pk] = retriever.SimpleRetriever(name=dr.name)
+                cls._visual_retriever[retriever_pk] = retriever.SimpleRetriever(name=dr.name, store_path=store_path)
             elif dr.algorithm == Retriever.FAISS and dr.approximator_shasum is None:
                 _, di = Indexers.get_trained_model({"trainedmodel_selector": {"shasum": dr.indexer_shasum}})
                 cls._visual_retriever[retriever_pk] = retriever.FaissFlatRetriever(name=dr.name,
@@ -51,6 +65,9 @@ class Retrievers(object):
                 approximator.load()
                 cls._visual_retriever[retriever_pk] = retriever.FaissApproximateRetriever(name=dr.name,
                                                                                           approximator=approximator)
+                if settings.FAISS_SHARD_MIN_ENTRIES:
+                    # Start from compacted shards, remaining entries are merged one by one in update_index
+                    cls.get_shards(dr).load_into(cls._visual_retriever[retriever_pk])
             elif dr.algorithm == Retriever.LOPQ:
                 approximator, da = Approximators.get_trained_model(
                     {"trainedmodel_selector": {"shasum": dr.approximator_shasum}})
@@ -64,31 +81,116 @@ class Retrievers(object):
 
     @classmethod
     def refresh_index(cls, dr):
-        # TODO improve this by either having a separate broadcast queues or using redis
-        last_count = cls._index_count[dr.pk]
-        current_count = IndexEntries.objects.count()
+        # A single GET replaces counting the whole IndexEntries table, the version is incremented by
+        # TEvent.mark_as_completed whenever new entries become visible and when videos are deleted.
+        current_version = redis_client.get(INDEX_ENTRIES_VERSION_KEY)
         visual_index = cls._visual_retriever[dr.pk]
-        if last_count == 0 or last_count != current_count or len(visual_index.loaded_entries) == 0:
-            cls._index_count[dr.pk] = current_count
+        if dr.pk not in cls._index_version or cls._index_version[dr.pk] != current_version or \
+                len(visual_index.loaded_entries) == 0:
+            cls._index_version[dr.pk] = current_version
             cls.update_index(dr)
         return len(visual_index.loaded_entries), visual_index.findex
 
     @classmethod
-    def update_index(cls, dr):
+    def get_source_filters(cls, dr):
         source_filters = dr.source_filters.copy()
-        # Only select entries with completed events, otherwise indexes might not be synced or complete.
-        source_filters['event__completed'] = True
         if dr.indexer_shasum:
             source_filters['indexer_shasum'] = dr.indexer_shasum
         if dr.approximator_shasum:
             source_filters['approximator_shasum'] = dr.approximator_shasum
         else:
             source_filters['approximator_shasum'] = None  # Required otherwise approximate index entries are selected
-        index_entries = IndexEntries.objects.filter(**source_filters)
+        return source_filters
+
+    @classmethod
+    def get_shards(cls, dr):
+        return retriever.FaissShards("{}/retrievers/{}_{}.faiss".format(settings.MEDIA_ROOT, dr.pk,
+                                                                        dr.approximator_shasum))
+
+    @classmethod
+    def compact_shards(cls, dr):
+        """
+        Merges FAISS index files of completed IndexEntries not yet covered by a shard into a new shard, once at
+        least FAISS_SHARD_MIN_ENTRIES such entries exist. Returns the number of entries merged.
+        """
+        if dr.algorithm != Retriever.FAISS or not dr.approximator_shasum or not settings.FAISS_SHARD_MIN_ENTRIES:
+            return 0
+        shards = cls.get_shards(dr)
+        covered = set(pk for shard in shards.reload() for pk, _ in shard['entries'])
+        source_filters = cls.get_source_filters(dr)
+        source_filters['event__completed'] = True
+        pending = [di for di in IndexEntries.objects.filter(**source_filters).order_by('sequence')
+                   if di.pk not in covered and di.count > 0]
+        if len(pending) < settings.FAISS_SHARD_MIN_ENTRIES:
+            return 0
+        return shards.compact([(di.pk, di.count, di.get_vectors()) for di in pending],
+                              min_entries=settings.FAISS_SHARD_MIN_ENTRIES)
+
+    @classmethod
+    def update_index(cls, dr):
+        source_filters = cls.get_source_filters(dr)
+        watermark = cls._index_watermark.get(dr.pk, 0)
+        # IndexEntries pk -> sequence of entries already handled by this retriever
+        synced = cls._index_synced.setdefault(dr.pk, {})
+        # The sequence comes from the database, unlike created timestamps it does not depend on worker clocks. The
+        # watermark cannot move past entries whose events are still running since they only become visible once
+        # completed.
+        pending = IndexEntries.objects.filter(sequence__gt=watermark, event__completed=False, event__errored=False,
+                                              **source_filters).aggregate(sequence=Min('sequence'))['sequence']
+        # Only select entries with completed events, otherwise indexes might not be synced or complete.
+        completed = IndexEntries.objects.filter(event__completed=True, **source_filters)
         visual_index = cls._visual_retriever[dr.pk]
+        if visual_index.algorithm == 'EXACT':
+            # picks up vectors appended to a persistent store by other retriever processes
+            visual_index.refresh_store()
+        new_entries = list(completed.filter(sequence__gt=watermark).order_by('sequence'))
+        cls.load_index_entries(new_entries, visual_index, synced)
+        if pending is not None:
+            cls._index_watermark[dr.pk] = max(pending - 1, watermark)
+        elif new_entries:
+            cls._index_watermark[dr.pk] = new_entries[-1].sequence
+        # Comparing against every entry is expensive, it only happens when entries were deleted and occasionally to
+        # pick up entries committed below the watermark after it moved (by a slower transaction).
+        deleted = redis_client.get(INDEX_ENTRIES_DELETED_KEY)
+        last = cls._index_reconciled.get(dr.pk)
+        if last is None:
+            # everything up to the watermark has just been loaded
+            cls._index_reconciled[dr.pk] = (deleted, time.time())
+        elif last[0] != deleted or time.time() - last[1] > settings.RETRIEVER_RECONCILE_INTERVAL:
+            cls._index_reconciled[dr.pk] = (deleted, time.time())
+            cls.reconcile_index(completed, visual_index, synced)
+
+    @classmethod
+    def reconcile_index(cls, completed, visual_index, synced):
+        """
+        Loads entries missing from synced and drops deleted ones, primary keys are only compared when the count or
+        the sum of sequences differ.
+        """
+        totals = completed.aggregate(count=Count('pk'), total=Sum('sequence'))
+        if totals['count'] != len(synced) or (totals['total'] or 0) != sum(v for v in synced.values() if v):
+            current = set(completed.values_list('pk', flat=True))
+            deleted = set(synced) - current
+            if deleted and hasattr(visual_index, 'remove_entries'):
+                # exact retrievers compact their vectors, otherwise hits of deleted entries would take up results
+                visual_index.remove_entries(deleted)
+            for pk in deleted:
+                # results pointing to entries missing from _index_entries are skipped by create_query_results
+                cls._index_entries.pop(pk, None)
+                visual_index.loaded_entries.discard(pk)
+                del synced[pk]
+            missing = current.difference(synced)
+            if missing:
+                cls.load_index_entries(completed.filter(pk__in=missing).order_by('sequence'), visual_index, synced)
+
+    @classmethod
+    def load_index_entries(cls, index_entries, visual_index, synced):
         for index_entry in index_entries:
             if index_entry.pk not in visual_index.loaded_entries and index_entry.count > 0:
                 cls.add_index_entry(index_entry, visual_index)
+            elif index_entry.pk not in cls._index_entries:
+                # vectors were restored from a persistent store, only the entry itself needs to be cached
+                cls._index_entries[index_entry.pk] = index_entry
+            synced[index_entry.pk] = index_entry.sequence
 
     @classmethod
     def add_index_entry(cls, index_entry, visual_index):
@@ -116,29 +218,64 @@ class Retrievers(object):
                 logging.info("finished {} in {}".format(index_entry.pk, visual_index.name))
 
     @classmethod
-    def retrieve(cls, event, index_retriever, dr, vector, count, region_pk=None):
-        cls.refresh_index(dr)
-        if 'nprobe' in event.arguments:
-            results = index_retriever.nearest(vector=vector, n=count, nprobe=event.arguments['nprobe'])
-        else:
-            results = index_retriever.nearest(vector=vector, n=count)
-        qr_batch = []
-        for rank, r in enumerate(results):
-            if 'indexentries_pk' in r:
-                di = cls._index_entries[r['indexentries_pk']]
+    def resolve_regions(cls, region_ids):
+        """
+        Returns region id -> (video_id, frame_index), regions missing from the per worker cache are fetched with a
+        single query. Both fields never change once a region is created, so cached values never go stale.
+        """
+        resolved = {}
+        missing = []
+        for region_id in region_ids:
+            cached = cls._region_cache.get(region_id)
+            if cached is None:
+                missing.append(region_id)
+            else:
+                resolved[region_id] = cached
+        if missing:
+            for region_id, video_id, frame_index in Region.objects.filter(pk__in=missing).values_list(
+                    'pk', 'video_id', 'frame_index'):
+                resolved[region_id] = (video_id, frame_index)
+                cls._region_cache.put(region_id, (video_id, frame_index))
+        return resolved
+
+    @classmethod
+    def create_query_results(cls, event, dr, results_by_region):
+        """
+        Builds QueryResults for a list of (query region pk or None, results) with results grouped by type, so that
+        all regions are resolved at once rather than with a query per result.
+        """
+        annotated = []
+        by_index_entry = defaultdict(list)
+        for region_pk, results in results_by_region:
+            for rank, r in enumerate(results):
+                if 'indexentries_pk' in r:
+                    if r['indexentries_pk'] not in cls._index_entries:
+                        logging.warning("Skipping result from stale index entry {}".format(r['indexentries_pk']))
+                        continue
+                    by_index_entry[r['indexentries_pk']].append(r)
+                annotated.append((region_pk, rank, r))
+        # Entries are looked up with a single transaction per IndexEntries
+        for di_pk, entry_results in by_index_entry.items():
+            di = cls._index_entries[di_pk]
+            for r, entry in zip(entry_results, di.get_entries([r['offset'] for r in entry_results])):
                 r['type'] = di.target
                 r['video'] = di.video_id
-                r['id'] = di.get_entry(r['offset'])
+                r['id'] = entry
+        region_ids = set(r['id'] for _, _, r in annotated if r['type'] == 'regions')
+        regions = cls.resolve_regions(region_ids) if region_ids else {}
+        qr_batch = []
+        for region_pk, rank, r in annotated:
             qr = QueryResult()
             if region_pk:
                 qr.query_region_id = region_pk
             qr.query = event.parent_process
             qr.retrieval_event_id = event.pk
             if r['type'] == 'regions':
-                dd = Region.objects.get(pk=r['id'])
-                qr.region = dd
-                qr.frame_index = dd.frame_index
-                qr.video_id = dd.video_id
+                if r['id'] not in regions:
+                    logging.warning("Skipping result for missing region {}".format(r['id']))
+                    continue
+                qr.region_id = r['id']
+                qr.video_id, qr.frame_index = regions[r['id']]
             elif r['type'] == 'frames':
                 qr.frame_index = int(r['id'])
                 qr.video_id = r['video']
@@ -148,6 +285,16 @@ class Retrievers(object):
             qr.rank = int(r.get('rank', rank + 1))
             qr.distance = int(r.get('dist', rank + 1))
             qr_batch.append(qr)
+        return qr_batch
+
+    @classmethod
+    def retrieve(cls, event, index_retriever, dr, vector, count, region_pk=None):
+        cls.refresh_index(dr)
+        if 'nprobe' in event.arguments:
+            results = index_retriever.nearest(vector=vector, n=count, nprobe=event.arguments['nprobe'])
+        else:
+            results = index_retriever.nearest(vector=vector, n=count)
+        qr_batch = cls.create_query_results(event, dr, [(region_pk, results)])
         if region_pk:
             event.finalize_query({"QueryResult": qr_batch},
                                  results={region_pk: {"retriever_state": index_retriever.findex}})
@@ -156,3 +303,24 @@ class Retrievers(object):
         event.parent_process.results_available = True
         event.parent_process.save()
         return 0
+
+    @classmethod
+    def retrieve_batch(cls, event, index_retriever, dr, region_pk_vectors, count):
+        """
+        Retrieve results for several query regions with a single nearest_batch call, all QueryResults are created
+        with one bulk_create.
+        """
+        cls.refresh_index(dr)
+        region_pks = list(region_pk_vectors.keys())
+        vectors = np.vstack([np.atleast_2d(region_pk_vectors[pk].squeeze()) for pk in region_pks])
+        if 'nprobe' in event.arguments:
+            results_batch = index_retriever.nearest_batch(vectors=vectors, n=count, nprobe=event.arguments['nprobe'])
+        else:
+            results_batch = index_retriever.nearest_batch(vectors=vectors, n=count)
+        qr_batch = cls.create_query_results(event, dr, [(region_pk, results_batch[i])
+                                                        for i, region_pk in enumerate(region_pks)])
+        retriever_state = {region_pk: {"retriever_state": index_retriever.findex} for region_pk in region_pks}
+        event.finalize_query({"QueryResult": qr_batch}, results=retriever_state)
+        event.parent_process.results_available = True
+        event.parent_process.save()
+        return 0
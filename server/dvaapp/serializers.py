@@ -2,10 +2,11 @@ from rest_framework import serializers
 from django.contrib.auth.models import User
 from models import Video, Frame, Region, DVAPQL, QueryResult, TEvent, IndexEntries, Tube, Segment, TrainedModel, \
     Retriever, SystemState, QueryRegion, Worker, TrainingSet, RegionRelation, TubeRegionRelation, TubeRelation, \
-    Export, HyperRegionRelation, HyperTubeRegionRelation, TaskRestart
+    Export, HyperRegionRelation, HyperTubeRegionRelation, TaskRestart, frame_media_url
 import os, glob
 from collections import defaultdict
 from django.conf import settings
+from dvalib.frame_pack import FramePack
 
 
 class UserSerializer(serializers.HyperlinkedModelSerializer):
@@ -75,7 +76,7 @@ class FrameSerializer(serializers.HyperlinkedModelSerializer):
     media_url = serializers.SerializerMethodField()
 
     def get_media_url(self, obj):
-        return "{}{}/frames/{}.jpg".format(settings.MEDIA_URL, obj.video_id, obj.frame_index)
+        return frame_media_url(obj.video_id, obj.frame_index)
 
     class Meta:
         model = Frame
@@ -99,7 +100,7 @@ class RegionSerializer(serializers.HyperlinkedModelSerializer):
     frame_media_url = serializers.SerializerMethodField()
 
     def get_frame_media_url(self, obj):
-        return "{}{}/frames/{}.jpg".format(settings.MEDIA_URL, obj.video_id, obj.frame_index)
+        return frame_media_url(obj.video_id, obj.frame_index)
 
     class Meta:
         model = Region
@@ -113,10 +114,10 @@ class RegionRelationSerializer(serializers.HyperlinkedModelSerializer):
     target_frame_media_url = serializers.SerializerMethodField()
 
     def get_source_frame_media_url(self, obj):
-        return "{}{}/frames/{}.jpg".format(settings.MEDIA_URL, obj.video_id, obj.source_region.frame_index)
+        return frame_media_url(obj.video_id, obj.source_region.frame_index)
 
     def get_target_frame_media_url(self, obj):
-        return "{}{}/frames/{}.jpg".format(settings.MEDIA_URL, obj.video_id, obj.target_region.frame_index)
+        return frame_media_url(obj.video_id, obj.target_region.frame_index)
 
     class Meta:
         model = RegionRelation
@@ -128,7 +129,7 @@ class HyperRegionRelationSerializer(serializers.HyperlinkedModelSerializer):
     frame_media_url = serializers.SerializerMethodField()
 
     def get_frame_media_url(self, obj):
-        return "{}{}/frames/{}.jpg".format(settings.MEDIA_URL, obj.video_id, obj.region.frame_index)
+        return frame_media_url(obj.video_id, obj.region.frame_index)
 
     class Meta:
         model = HyperRegionRelation
@@ -153,7 +154,7 @@ class TubeRegionRelationSerializer(serializers.HyperlinkedModelSerializer):
     region_frame_media_url = serializers.SerializerMethodField()
 
     def get_region_frame_media_url(self, obj):
-        return "{}{}/frames/{}.jpg".format(settings.MEDIA_URL, obj.video_id, obj.region.frame_index)
+        return frame_media_url(obj.video_id, obj.region.frame_index)
 
     class Meta:
         model = TubeRegionRelation
@@ -267,7 +268,8 @@ class TubeRegionRelationExportSerializer(serializers.ModelSerializer):
 class FrameExportSerializer(serializers.ModelSerializer):
     class Meta:
         model = Frame
-        fields = ('frame_index', 'keyframe', 'w', 'h', 't', 'event', 'name', 'id', 'segment_index')
+        fields = ('frame_index', 'keyframe', 'w', 'h', 't', 'event', 'name', 'id', 'segment_index', 'phash',
+                  'duplicate_of', 'packed')
 
 
 class IndexEntryExportSerializer(serializers.ModelSerializer):
@@ -509,8 +511,32 @@ class VideoImporter(object):
         for i, f in enumerate(frame_list_json):
             frames.append(self.create_frame(f))
             frame_index_to_fid[i] = f['id']
+        # duplicate_of refers to a frame_index, representatives missing from the export leave frames unmarked
+        frame_indexes = set(df.frame_index for df in frames)
+        for df in frames:
+            if df.duplicate_of is not None and df.duplicate_of not in frame_indexes:
+                df.duplicate_of = None
+        self.extract_packed_frames(frames)
         Frame.objects.bulk_create(frames)
 
+    def extract_packed_frames(self, frames):
+        """
+        Extracts images of packed frames from the exported frame packs so that the video can be used without frame
+        packs, frames remain packed only if frame packs are enabled.
+        """
+        packs = {}
+        for df in frames:
+            if df.packed:
+                frame_path = os.path.join(self.root, 'frames', '{}.jpg'.format(df.frame_index))
+                if not os.path.isfile(frame_path):
+                    pack_path = os.path.join(self.root, 'frames', 'segment_{}.pack'.format(df.segment_index))
+                    if pack_path not in packs:
+                        packs[pack_path] = FramePack(pack_path).open()
+                    packs[pack_path].extract(df.frame_index, frame_path)
+                df.packed = settings.ENABLE_FRAME_PACKS
+        for pack in packs.values():
+            pack.close()
+
     def bulk_import_regions(self, region_list_json):
         regions = []
         region_index_to_fid = {}
@@ -573,4 +599,7 @@ class VideoImporter(object):
         df.event_id = f['event']
         df.segment_index = f.get('segment_index', 0)
         df.keyframe = f.get('keyframe', False)
+        df.phash = f.get('phash', None)
+        df.duplicate_of = f.get('duplicate_of', None)
+        df.packed = f.get('packed', False)
         return df
@@ -1,5 +1,5 @@
 from django.conf import settings
-from .operations import indexing, detection, analysis, approximation, retrieval
+from .operations import indexing, detection, analysis, approximation, retrieval, decoding
 import io
 import logging
 import tempfile
@@ -41,9 +41,17 @@ def handle_perform_indexing(start):
         queryset, target = task_shared.build_queryset(args=start.arguments, video_id=start.video_id)
         task_shared.ensure_files(queryset, target)
         indexing.Indexers.index_queryset(di, visual_index, start, target, queryset)
+    elif target == 'segments':
+        # Frames are decoded in memory and fed directly to the indexer
+        queryset, target = task_shared.build_queryset(args=start.arguments, video_id=start.video_id)
+        task_shared.ensure_files(queryset, target)
+        indexing.Indexers.index_segments(di, visual_index, start, queryset,
+                                         json_args.get('rate', settings.DEFAULT_RATE),
+                                         save_frames=json_args.get('save_frames', False),
+                                         keyframes_only=json_args.get('keyframes_only', False))
     elif target == 'frames':
         queryset, target = task_shared.build_queryset(args=start.arguments, video_id=start.video_id)
-        if visual_index.cloud_fs_support and settings.ENABLE_CLOUDFS:
+        if visual_index.cloud_fs_support and settings.ENABLE_CLOUDFS and not settings.ENABLE_FRAME_PACKS:
             # if NFS is disabled and index supports cloud file systems natively (e.g. like Tensorflow)
             indexing.Indexers.index_queryset(di, visual_index, start, target, queryset, cloud_paths=True)
         else:
@@ -70,6 +78,7 @@ def handle_perform_detection(start):
     frame_detections_list = []
     dv = None
     dd_list = []
+    streamed_frames = []
     query_flow = ('target' in args and args['target'] == 'query')
     cd = models.TrainedModel.objects.get(**args['trainedmodel_selector'])
     detector_name = cd.name
@@ -87,14 +96,30 @@ def handle_perform_detection(start):
         dv = models.Video.objects.get(id=video_id)
         queryset, target = task_shared.build_queryset(args, video_id, start.parent_process_id)
         task_shared.ensure_files(queryset, target)
-        for k in queryset:
-            if target == 'frames':
-                local_path = k.path()
-            elif target == 'regions':
-                local_path = k.frame_path()
-            else:
-                raise NotImplementedError("Invalid target:{}".format(target))
-            frame_detections_list.append((k, detector.detect(local_path)))
+        if target == 'segments':
+            # Frames are decoded in memory and fed directly to the detector
+            if not hasattr(detector, 'detect_images'):
+                raise NotImplementedError("{} cannot detect decoded frames".format(detector_name))
+            decoder = decoding.VideoDecoder(dvideo=dv, media_dir=settings.MEDIA_ROOT)
+            for frames, images in decoder.stream_segments(queryset, start.pk, args.get('rate', settings.DEFAULT_RATE),
+                                                          args.get('batch_size', 8), args.get('save_frames', False),
+                                                          args.get('keyframes_only', False)):
+                frame_detections_list += zip(frames, detector.detect_images(images))
+            streamed_frames = decoder.streamed_frames
+        elif target == 'frames' and hasattr(detector, 'detect_batch'):
+            frames = list(queryset)
+            detections = detector.detect_batch([df.path() for df in frames], [(df.w, df.h) for df in frames],
+                                               batch_size=args.get('batch_size', 8))
+            frame_detections_list += zip(frames, detections)
+        else:
+            for k in queryset:
+                if target == 'frames':
+                    local_path = k.path()
+                elif target == 'regions':
+                    local_path = k.frame_path()
+                else:
+                    raise NotImplementedError("Invalid target:{}".format(target))
+                frame_detections_list.append((k, detector.detect(local_path)))
     per_event_counter = 0
     for df, detections in frame_detections_list:
         for d in detections:
@@ -104,32 +129,22 @@ def handle_perform_detection(start):
                 dd = models.Region()
                 dd.per_event_index = per_event_counter
                 per_event_counter += 1
-            dd.region_type = models.Region.DETECTION
+            detection.Detectors.fill_region(detector_name, d, dd)
             if query_flow:
                 dd.query_id = start.parent_process_id
             else:
                 dd.video_id = dv.pk
                 dd.frame_index = df.frame_index
                 dd.segment_index = df.segment_index
-            if detector_name == 'textbox':
-                dd.object_name = 'TEXTBOX'
-                dd.confidence = 100.0 * d['score']
-            elif detector_name == 'face':
-                dd.object_name = 'MTCNN_face'
-                dd.confidence = 100.0
-            else:
-                dd.object_name = d['object_name']
-                dd.confidence = 100.0 * d['score']
-            dd.x = d['x']
-            dd.y = d['y']
-            dd.w = d['w']
-            dd.h = d['h']
             dd.event_id = start.pk
             dd_list.append(dd)
     if query_flow:
         _ = models.QueryRegion.objects.bulk_create(dd_list, 1000)
     else:
-        start.finalize({"Region": dd_list})
+        if streamed_frames:
+            start.finalize({"Region": dd_list, "Frame": streamed_frames})
+        else:
+            start.finalize({"Region": dd_list})
     return query_flow
 
 
@@ -153,6 +168,7 @@ def handle_perform_analysis(start):
         task_shared.ensure_files(queryset, target)
     image_data = {}
     source_regions = []
+    paths = []
     temp_root = tempfile.mkdtemp()
     for i, f in enumerate(queryset):
         if query_regions_paths:
@@ -184,7 +200,11 @@ def handle_perform_analysis(start):
                 a.frame_index = f.frame_index
                 a.segment_index = f.segment_index
                 source_regions.append(f)
-                path = f.crop_and_get_region_path(image_data, temp_root)
+                if hasattr(analyzer, 'apply_batch'):
+                    # cropped in memory when the batch is analyzed
+                    path = f
+                else:
+                    path = f.crop_and_get_region_path(image_data, temp_root)
             elif target == 'frames':
                 a.full_frame = True
                 a.frame_index = f.frame_index
@@ -192,13 +212,30 @@ def handle_perform_analysis(start):
                 path = f.path()
             else:
                 raise NotImplementedError
-        object_name, text, metadata, _ = analyzer.apply(path)
-        a.region_type = models.Region.ANNOTATION
-        a.object_name = object_name
-        a.text = text
-        a.metadata = metadata
-        a.event_id = task_id
+        paths.append(path)
         regions_batch.append(a)
+    batch_size = args.get('batch_size', 16)
+    order = list(range(len(paths)))
+    crop_regions = target == 'regions' and hasattr(analyzer, 'apply_batch')
+    if crop_regions:
+        # regions are cropped in frame order so that each frame is decoded once and only one frame is kept in memory
+        order.sort(key=lambda k: (paths[k].video_id, paths[k].frame_index))
+    frames = {}
+    for start_index in range(0, len(order), batch_size):
+        batch = order[start_index:start_index + batch_size]
+        if crop_regions:
+            results = analyzer.apply_batch(models.crop_region_arrays([paths[k] for k in batch], frames))
+        elif hasattr(analyzer, 'apply_batch'):
+            results = analyzer.apply_batch([paths[k] for k in batch])
+        else:
+            results = [analyzer.apply(paths[k]) for k in batch]
+        for k, (object_name, text, metadata, _) in zip(batch, results):
+            a = regions_batch[k]
+            a.region_type = models.Region.ANNOTATION
+            a.object_name = object_name
+            a.text = text
+            a.metadata = metadata
+            a.event_id = task_id
     if query_regions_paths or query_path:
         models.QueryRegion.objects.bulk_create(regions_batch, 1000)
     else:
@@ -1,5 +1,6 @@
 import os, json, copy, time, subprocess, logging, shutil, zipfile, uuid
-from models import QueryRegion, DVAPQL, Region, Frame, Segment, IndexEntries, TEvent, DeletedVideo, TaskRestart, Export
+from models import QueryRegion, DVAPQL, Region, Frame, Segment, IndexEntries, TEvent, DeletedVideo, TaskRestart, Export, \
+    ensure_frame
 
 from django.conf import settings
 from PIL import Image
@@ -220,6 +221,8 @@ def build_queryset(args, video_id=None, query_id=None, target=None, filters=None
         kwargs['video_id'] = video_id
     if target == 'frames':
         queryset = Frame.objects.all().filter(**kwargs)
+        if args.get('skip_duplicates', False):
+            queryset = queryset.filter(duplicate_of__isnull=True)
     elif target == 'regions':
         queryset = Region.objects.all().filter(**kwargs)
     elif target == 'query':
@@ -301,12 +304,20 @@ def get_query_dimensions(start):
 
 def ensure_files(queryset, target):
     dirnames = {}
+    packs = {}
     if target == 'frames':
         for k in queryset:
-            ensure(k.path(media_root=''), dirnames)
+            ensure_frame(k.video_id, k.frame_index, k.segment_index, k.packed, dirnames, packs)
     elif target == 'regions':
+        packed = {}
+        if settings.ENABLE_FRAME_PACKS:
+            for video_id, frame_index, segment_index in Frame.objects.filter(
+                    video_id__in={k.video_id for k in queryset}, frame_index__in={k.frame_index for k in queryset},
+                    packed=True).values_list('video_id', 'frame_index', 'segment_index'):
+                packed[(video_id, frame_index)] = segment_index
         for k in queryset:
-            ensure(k.frame_path(media_root=''), dirnames)
+            ensure_frame(k.video_id, k.frame_index, packed.get((k.video_id, k.frame_index)),
+                         (k.video_id, k.frame_index) in packed, dirnames, packs)
     elif target == 'segments':
         for k in queryset:
             ensure(k.path(media_root=''), dirnames)
@@ -315,6 +326,8 @@ def ensure_files(queryset, target):
             ensure(k.npy_path(media_root=''), dirnames)
     else:
         raise NotImplementedError
+    for pack in packs.values():
+        pack.close()
 
 
 def import_frame_regions_json(regions_json, video, event):
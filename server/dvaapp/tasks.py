@@ -9,6 +9,7 @@ from dva.celery import app
 from . import models
 from .operations.retrieval import Retrievers
 from .operations.decoding import VideoDecoder
+from .operations import deduplication
 from .operations.dataset import DatasetCreator
 from .operations.training import train_lopq, train_faiss
 from .operations.livestreaming import LivestreamCapture
@@ -204,9 +205,13 @@ def perform_retrieval(task_id):
         Retrievers.retrieve(dt, index_retriever, dr, vector, args.get('count', 20))
     elif target == 'query_region_index_vectors':
         qr_pk_vector = redis_client.hgetall("query_region_vectors_{}".format(dt.parent_id))
-        for query_region_pk, vector in qr_pk_vector.items():
-            vector = np.load(io.BytesIO(vector))
-            Retrievers.retrieve(dt, index_retriever, dr, vector, args.get('count', 20), region_pk=query_region_pk)
+        qr_pk_vector = {query_region_pk: np.load(io.BytesIO(vector))
+                        for query_region_pk, vector in qr_pk_vector.items()}
+        if getattr(index_retriever, 'support_batching', False):
+            Retrievers.retrieve_batch(dt, index_retriever, dr, qr_pk_vector, args.get('count', 20))
+        else:
+            for query_region_pk, vector in qr_pk_vector.items():
+                Retrievers.retrieve(dt, index_retriever, dr, vector, args.get('count', 20), region_pk=query_region_pk)
     else:
         raise NotImplementedError(target)
     dt.mark_as_completed()
@@ -270,7 +275,9 @@ def perform_video_segmentation(task_id):
     dv.create_directory(create_subdirs=True)
     v = VideoDecoder(dvideo=dv, media_dir=settings.MEDIA_ROOT)
     v.get_metadata()
-    segments_batch = v.segment_video(task_id)
+    segments_batch = v.segment_video(task_id, segment_time=args.get('segment_time', None),
+                                     segment_frames=args.get('segment_frames', None),
+                                     segment_keyframes=args.get('segment_keyframes', None))
     dt.finalize({"Segment":segments_batch})
     if args.get('sync', False):
         next_args = {'rescale': args['rescale'], 'rate': args['rate']}
@@ -302,9 +309,13 @@ def perform_video_decode(task_id):
     if target != 'segments':
         raise NotImplementedError("Cannot decode target:{}".format(target))
     task_shared.ensure_files(queryset, target)
-    frame_batch = []
-    for ds in queryset:
-        frame_batch += v.decode_segment(ds,dt.pk,denominator=args.get('rate', 30))
+    frame_batch = v.decode_segments(list(queryset), dt.pk, denominator=args.get('rate', 30),
+                                    workers=args.get('workers', settings.DECODE_WORKERS),
+                                    keyframes_only=args.get('keyframes_only', False),
+                                    adaptive=args.get('adaptive', None))
+    if args.get('dedup', False):
+        deduplication.deduplicate_frames(frame_batch, args.get('max_distance', settings.DEDUP_MAX_DISTANCE),
+                                         args.get('hash', settings.DEDUP_HASH))
     dt.finalize({"Frame":frame_batch})
     process_next(dt)
     dt.mark_as_completed()
@@ -450,6 +461,24 @@ def perform_region_import(task_id):
     dt.mark_as_completed()
 
 
+@app.task(track_started=True, name="perform_frame_deduplication")
+def perform_frame_deduplication(task_id):
+    dt = get_and_check_task(task_id)
+    if dt is None:
+        return 0
+    args = dt.arguments
+    if 'target' not in args:
+        args['target'] = 'frames'
+    queryset, target = task_shared.build_queryset(args, dt.video_id, dt.parent_process_id)
+    if target != 'frames':
+        raise NotImplementedError("Cannot deduplicate target:{}".format(target))
+    task_shared.ensure_files(queryset, target)
+    deduplication.deduplicate_queryset(queryset, args.get('max_distance', settings.DEDUP_MAX_DISTANCE),
+                                       args.get('hash', settings.DEDUP_HASH))
+    process_next(dt)
+    dt.mark_as_completed()
+
+
 @app.task(track_started=True, name="perform_frame_download")
 def perform_frame_download(task_id):
     dt = get_and_check_task(task_id)
@@ -495,6 +524,9 @@ def perform_deletion(task_id):
     deleted.original_pk = video_pk
     deleted.save()
     video.delete()
+    # retrievers drop results from the deleted IndexEntries once they see a new version
+    redis_client.incr(models.INDEX_ENTRIES_DELETED_KEY)
+    redis_client.incr(models.INDEX_ENTRIES_VERSION_KEY)
     src = '{}/{}/'.format(settings.MEDIA_ROOT, int(video_pk))
     args = ['rm', '-rf', src]
     command = " ".join(args)
@@ -713,6 +745,7 @@ def refresh_retriever():
             logging.info("Starting index refresh on queue {} for retriever {}".format(W.queue_name,dr.pk))
             start_ts = time.time()
             index_entries_count,vectors_count = Retrievers.refresh_index(dr)
+            Retrievers.compact_shards(dr)
             entry = {
                 'index_entries_count':index_entries_count,
                 'vectors_count':vectors_count,
@@ -730,6 +763,7 @@ def refresh_retriever():
         start_ts = time.time()
         _, dr = Retrievers.get_retriever(args={'retriever_selector': {'pk': pk}})
         index_entries_count, vectors_count = Retrievers.refresh_index(dr)
+        Retrievers.compact_shards(dr)
         entry = {
             'index_entries_count': index_entries_count,
             'vectors_count': vectors_count,
@@ -28,4 +28,6 @@ router.register(r'workers', views.WorkerViewSet)
 router.register(r'system_state', views.SystemStateViewSet)
 router.register(r'retriever_state', views.RetrieverStateViewState, base_name='retriever_state')
 
-urlpatterns = [url(r'', include(router.urls)), ]
+urlpatterns = [url(r'^frame_image/(?P<video_id>[0-9a-f-]+)/(?P<frame_index>\d+)\.jpg$', views.frame_image,
+                   name='frame_image'),
+               url(r'', include(router.urls)), ]
@@ -2,13 +2,17 @@ from django.conf import settings
 import json
 from .models import Video, Frame, DVAPQL, QueryResult, TEvent, IndexEntries, Region, Tube, Segment, \
     TubeRegionRelation, TubeRelation, Retriever, SystemState, QueryRegion, \
-    TrainedModel, Worker, TrainingSet, RegionRelation, Export, HyperRegionRelation, HyperTubeRegionRelation, TaskRestart
+    TrainedModel, Worker, TrainingSet, RegionRelation, Export, HyperRegionRelation, HyperTubeRegionRelation, \
+    TaskRestart, ensure_frame
 import serializers
 from rest_framework import viewsets
+from rest_framework.decorators import api_view, permission_classes
 from django.contrib.auth.models import User
+from django.http import HttpResponse, Http404
 from rest_framework.permissions import IsAuthenticatedOrReadOnly, IsAuthenticated
 from rest_framework.response import Response
 from .processing import DVAPQLProcess
+from . import fs
 from dva.in_memory import redis_client
 import logging
 
@@ -27,6 +31,27 @@ def force_user_check(user):
     return user.is_authenticated
 
 
+@api_view(['GET'])
+@permission_classes((IsAuthenticatedOrReadOnly,) if settings.AUTH_DISABLED else (IsAuthenticated,))
+def frame_image(request, video_id, frame_index):
+    """
+    Serves frame images which are only stored remotely in frame packs. Extracted images are kept under MEDIA_ROOT and
+    cached like other frames so that a pack is only fetched and unpacked by the first request.
+    """
+    bare_path = "/{}/frames/{}.jpg".format(video_id, frame_index)
+    body = fs.get_from_cache(bare_path)
+    if body is None:
+        frame = Frame.objects.filter(video_id=video_id, frame_index=frame_index).first()
+        if frame is None:
+            raise Http404
+        with open(ensure_frame(frame.video_id, frame.frame_index, frame.segment_index, frame.packed), 'rb') as fh:
+            body = fh.read()
+        fs.cache_path(bare_path, payload=body)
+    response = HttpResponse(body, content_type='image/jpeg')
+    response['Cache-Control'] = 'private, max-age=86400'
+    return response
+
+
 class UserViewSet(viewsets.ReadOnlyModelViewSet):
     permission_classes = (IsAuthenticatedOrReadOnly,) if settings.AUTH_DISABLED else (IsAuthenticated,)
     queryset = User.objects.all()
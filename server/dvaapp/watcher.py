@@ -0,0 +1,97 @@
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import logging
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+EVENT = struct.Struct('iIII')
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _libc.inotify_init1
+    _libc.inotify_add_watch
+except (OSError, AttributeError, TypeError):
+    _libc = None
+
+
+class DirectoryWatcher(object):
+    """
+    Waits for files to be created or modified in a directory using inotify, falls back to sleeping poll_interval
+    seconds when inotify is unavailable (e.g. on OSX or on network file systems where use_inotify should be False).
+    """
+
+    def __init__(self, path, poll_interval=1.0, use_inotify=True,
+                 mask=IN_CREATE | IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.fd = None
+        if use_inotify and _libc is not None:
+            fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd < 0:
+                logging.warning("inotify_init1 failed with errno {}, polling {}".format(ctypes.get_errno(), path))
+            elif _libc.inotify_add_watch(fd, path.encode('utf-8'), mask) < 0:
+                logging.warning("inotify_add_watch failed with errno {}, polling {}".format(ctypes.get_errno(), path))
+                os.close(fd)
+            else:
+                self.fd = fd
+        if self.fd is None:
+            logging.info("Polling {} every {} seconds".format(path, poll_interval))
+
+    @property
+    def uses_inotify(self):
+        return self.fd is not None
+
+    def wait(self, timeout, accept=None):
+        """
+        Blocks for at most timeout seconds until an event accepted by accept(name, mask) occurs. Returns the list of
+        changed file names, when polling nothing is known about changes and None is returned after a sleep.
+        """
+        if self.fd is None:
+            time.sleep(min(timeout, self.poll_interval))
+            return None
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return []
+            try:
+                readable, _, _ = select.select([self.fd], [], [], remaining)
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if not readable:
+                return []
+            names = [name for name, mask in self.read() if accept is None or accept(name, mask)]
+            if names:
+                return names
+
+    def read(self):
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return []
+            raise
+        events = []
+        offset = 0
+        while offset + EVENT.size <= len(data):
+            _, mask, _, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            events.append((data[offset:offset + length].rstrip(b'\0').decode('utf-8'), mask))
+            offset += length
+        return events
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
@@ -33,7 +33,11 @@ Batch = namedtuple('Batch', ['data'])
 
 
 def inception_preprocess(image, central_fraction=0.875):
-    image = tf.cast(tf.image.decode_jpeg(image, channels=3), tf.float32)
+    return inception_resize(tf.image.decode_jpeg(image, channels=3))
+
+
+def inception_resize(image):
+    image = tf.cast(image, tf.float32)
     # image = tf.image.central_crop(image, central_fraction=central_fraction)
     image = tf.expand_dims(image, [0])
     # TODO try tf.image.resize_image_with_crop_or_pad and tf.image.extract_glimpse
@@ -43,6 +47,15 @@ def inception_preprocess(image, central_fraction=0.875):
     return tf.subtract(image, 1.0)
 
 
+def read_image(image, mode):
+    """
+    PIL image in mode from a path or a decoded array.
+    """
+    if isinstance(image, np.ndarray):
+        return Image.fromarray(image).convert(mode)
+    return Image.open(image).convert(mode)
+
+
 class OpenImagesAnnotator(BaseAnnotator):
 
     def __init__(self,model_path,gpu_fraction=None):
@@ -55,6 +68,10 @@ class OpenImagesAnnotator(BaseAnnotator):
         self.label_set = 'open_images_tags'
         self.graph_def = None
         self.input_image = None
+        self.processed_image = None
+        self.decoded_image = None
+        self.processed_array = None
+        self.images = None
         self.predictions = None
         self.num_classes = 6012
         self.top_n = 25
@@ -81,9 +98,13 @@ class OpenImagesAnnotator(BaseAnnotator):
             g = tf.Graph()
             with g.as_default():
                 self.input_image = tf.placeholder(tf.string)
-                processed_image = inception_preprocess(self.input_image)
+                self.processed_image = inception_preprocess(self.input_image)
+                self.decoded_image = tf.placeholder(tf.uint8, [None, None, 3])
+                self.processed_array = inception_resize(self.decoded_image)
+                # batches of images preprocessed by preprocess_batch are fed here instead of an encoded JPEG
+                self.images = tf.placeholder_with_default(self.processed_image, [None, 299, 299, 3])
                 with slim.arg_scope(inception.inception_v3_arg_scope()):
-                    logits, end_points = inception.inception_v3(processed_image, num_classes=self.num_classes, is_training=False)
+                    logits, end_points = inception.inception_v3(self.images, num_classes=self.num_classes, is_training=False)
                 self.predictions = end_points['multi_predictions'] = tf.nn.sigmoid(logits, name='multi_predictions')
                 saver = tf_saver.Saver()
                 self.session = tf.InteractiveSession(config=config)
@@ -94,6 +115,37 @@ class OpenImagesAnnotator(BaseAnnotator):
             self.load()
         img_data = tf.gfile.FastGFile(image_path).read()
         predictions_eval = np.squeeze(self.session.run(self.predictions, {self.input_image: img_data}))
+        return self.format_predictions(predictions_eval)
+
+    def apply_batch(self, paths_or_arrays, batch_size=16):
+        """
+        Tags images given as paths or RGB arrays, batch_size images are run through the network in a single
+        session.run. Returns a list of results in the format of apply.
+        """
+        if self.session is None:
+            self.load()
+        results = []
+        for start in range(0, len(paths_or_arrays), batch_size):
+            images = self.preprocess_batch(paths_or_arrays[start:start + batch_size])
+            predictions = self.session.run(self.predictions, {self.images: images})
+            results.extend(self.format_predictions(p) for p in predictions)
+        return results
+
+    def preprocess_batch(self, paths_or_arrays):
+        """
+        Images are decoded and resized one at a time by the same ops as apply so that results do not depend on
+        batching.
+        """
+        images = []
+        for image in paths_or_arrays:
+            if isinstance(image, np.ndarray):
+                images.append(self.session.run(self.processed_array, {self.decoded_image: image})[0])
+            else:
+                img_data = tf.gfile.FastGFile(image).read()
+                images.append(self.session.run(self.processed_image, {self.input_image: img_data})[0])
+        return np.stack(images)
+
+    def format_predictions(self, predictions_eval):
         results = {self.label_dict.get(self.labelmap[idx], 'unknown'):predictions_eval[idx]
                    for idx in predictions_eval.argsort()[-self.top_n:][::-1]}
         labels = [t for t,v in results.iteritems() if v > 0.1]
@@ -141,6 +193,28 @@ class CRNNAnnotator(BaseAnnotator):
         sim_pred = self.converter.decode(preds.data, preds_size.data, raw=False)
         return self.object_name,sim_pred,{},None
 
+    def apply_batch(self, paths_or_arrays, batch_size=32):
+        """
+        Recognizes text in crops given as paths or arrays, crops are resized to 100x32 by the same transformer as
+        apply and batch_size crops are run in a single forward pass. Returns a list of results in the format of apply.
+        """
+        if self.session is None:
+            self.load()
+        results = []
+        for start in range(0, len(paths_or_arrays), batch_size):
+            images = torch.stack([self.transformer(read_image(image, 'L'))
+                                  for image in paths_or_arrays[start:start + batch_size]])
+            if self.cuda:
+                images = images.cuda()
+            _, preds = self.session(Variable(images)).max(2)
+            steps, count = preds.size(0), preds.size(1)
+            preds = preds.transpose(1, 0).contiguous().view(-1)
+            texts = self.converter.decode(preds.data, torch.IntTensor([steps] * count), raw=False)
+            if count == 1:
+                texts = [texts]
+            results.extend((self.object_name, text, {}, None) for text in texts)
+        return results
+
 
 class LocationNet(BaseAnnotator):
 
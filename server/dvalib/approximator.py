@@ -4,6 +4,7 @@ import pickle
 import logging
 import os
 import sys
+import multiprocessing
 
 try:
     from sklearn.decomposition import PCA
@@ -22,6 +23,18 @@ except:
     logging.warning("Could not import faiss in approximator.py")
     pass
 
+# LOPQ model of a worker process in the pool started by LOPQApproximator.open_pool
+_pool_model = None
+
+
+def _init_pool(model):
+    global _pool_model
+    _pool_model = model
+
+
+def _predict_codes(data):
+    return [(code.coarse, code.fine) for code in (_pool_model.predict(d) for d in data)]
+
 
 class LOPQApproximator(BaseApproximator):
     """
@@ -38,6 +51,8 @@ class LOPQApproximator(BaseApproximator):
         self.mu = None
         self.model = None
         self.permuted_inds = None
+        self.pool = None
+        self.pool_size = 0
         self.model_proto_filename = "{}/model.proto".format(dirname)
         self.P_filename = self.model_proto_filename.replace('.proto', '.P.npy')
         self.entries_filename = self.model_proto_filename.replace('.proto', '.json')
@@ -58,11 +73,47 @@ class LOPQApproximator(BaseApproximator):
         codes = self.model.predict(vector)
         return codes.coarse, codes.fine
 
+    def open_pool(self, num_procs=4):
+        """
+        Starts num_procs processes holding the model which approximate_batch uses until close_pool is called, so that
+        processes are started once for many batches.
+        """
+        if self.model is None:
+            self.load()
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(num_procs, _init_pool, (self.model,))
+            self.pool_size = num_procs
+
+    def close_pool(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def approximate_batch(self, matrix, num_procs=4):
+        """
+        Returns a list of (coarse, fine) codes, one for each row of the matrix. Codes are computed by the pool started
+        with open_pool, otherwise by num_procs processes started for this call.
+        """
+        pca_matrix = self.get_pca_matrix(matrix)
+        if self.pool is None:
+            codes = compute_codes_parallel(pca_matrix, self.model, num_procs)
+            return [(code.coarse, code.fine) for code in codes]
+        codes = []
+        for chunk in self.pool.map(_predict_codes, np.array_split(pca_matrix, self.pool_size)):
+            codes.extend(chunk)
+        return codes
+
     def get_pca_vector(self, vector):
         if self.model is None:
             self.load()
         return np.dot((self.pca_reduction.transform(vector) - self.mu), self.P).transpose().squeeze()
 
+    def get_pca_matrix(self, matrix):
+        if self.model is None:
+            self.load()
+        return np.dot((self.pca_reduction.transform(np.atleast_2d(matrix)) - self.mu), self.P)
+
 
 class PCAApproximator(BaseApproximator):
     """
@@ -97,6 +148,13 @@ class PCAApproximator(BaseApproximator):
         feats /= np.sqrt(self.pca_eigenvals + 1e-4)
         return feats
 
+    def approximate_batch(self, matrix):
+        if self.pca_eigenvecs is None:
+            self.load()
+        feats = np.dot(np.atleast_2d(matrix) - self.pca_mean, self.pca_eigenvecs)
+        feats /= np.sqrt(self.pca_eigenvals + 1e-4)
+        return feats
+
 
 class FAISSApproximator(BaseApproximator):
 
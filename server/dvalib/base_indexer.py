@@ -1,4 +1,5 @@
 import logging
+import numpy as np
 
 
 class BaseIndexer(object):
@@ -9,6 +10,8 @@ class BaseIndexer(object):
         self.batch_size = 100
         self.num_parallel_calls = 3
         self.cloud_fs_support = False
+        # True when images can be indexed from arrays of any shape using index_crops
+        self.array_support = False
 
     def apply(self, path):
         raise NotImplementedError
@@ -16,6 +19,48 @@ class BaseIndexer(object):
     def apply_batch(self, paths):
         raise NotImplementedError
 
+    def apply_images(self, images):
+        """
+        Index a list of decoded RGB images (uint8 arrays of identical shape) rather than paths.
+        """
+        return self.apply_preprocessed(self.preprocess_images(images))
+
+    def preprocess_images(self, images):
+        """
+        Resizes and normalizes decoded RGB images of identical shape into the network input.
+        """
+        if self.graph_def is None or self.session is None:
+            self.load()
+        return self.session.run(self.images_preprocessed, feed_dict={self.images_placeholder: np.stack(images)})
+
+    def apply_preprocessed(self, preprocessed):
+        raise NotImplementedError
+
+    def index_images(self, images):
+        features = []
+        for start in range(0, len(images), self.batch_size):
+            features += self.apply_images(images[start:start + self.batch_size])
+        return features
+
+    def index_crops(self, crops):
+        """
+        Index RGB arrays of different shapes such as region crops, crops of identical shape are preprocessed together
+        and the network is run on batches of batch_size preprocessed crops.
+        """
+        by_shape = {}
+        for k, crop in enumerate(crops):
+            by_shape.setdefault(crop.shape, []).append(k)
+        preprocessed = [None] * len(crops)
+        for indexes in by_shape.values():
+            for start in range(0, len(indexes), self.batch_size):
+                batch = indexes[start:start + self.batch_size]
+                for k, p in zip(batch, self.preprocess_images([crops[k] for k in batch])):
+                    preprocessed[k] = p
+        features = []
+        for start in range(0, len(crops), self.batch_size):
+            features += self.apply_preprocessed(np.stack(preprocessed[start:start + self.batch_size]))
+        return features
+
     def index_paths(self, paths):
         if self.support_batching:
             logging.info("Using batching")
@@ -85,6 +85,22 @@ def pil_to_array(pilImage):
     return x
 
 
+def group_by_size(paths_or_arrays, sizes=None):
+    """
+    Groups indexes of images by (width, height), taken from arrays, from sizes or by reading image headers.
+    """
+    if sizes is None:
+        sizes = [None] * len(paths_or_arrays)
+    groups = {}
+    for k, (image, size) in enumerate(zip(paths_or_arrays, sizes)):
+        if isinstance(image, np.ndarray):
+            size = (image.shape[1], image.shape[0])
+        elif not size or not size[0] or not size[1]:
+            size = PIL.Image.open(image).size
+        groups.setdefault(tuple(size), []).append(k)
+    return groups
+
+
 class TFDetector(BaseDetector):
 
     def __init__(self, model_path, class_index_to_string, gpu_fraction=None):
@@ -96,6 +112,7 @@ class TFDetector(BaseDetector):
         self.filenames_placeholder = None
         self.image = None
         self.fname = None
+        self.image_shape = None
         if gpu_fraction:
             self.gpu_fraction = gpu_fraction
         else:
@@ -103,25 +120,52 @@ class TFDetector(BaseDetector):
 
     def detect(self, image_path, min_score=0.20):
         self.session.run(self.iterator.initializer, feed_dict={self.filenames_placeholder: [image_path, ]})
-        (fname, boxes, scores, classes, num_detections) = self.session.run(
-            [self.fname, self.boxes, self.scores, self.classes, self.num_detections])
-        detections = []
-        for i, _ in enumerate(boxes[0]):
-            plimg = PIL.Image.open(image_path)
-            frame_width, frame_height = plimg.size
-            shape = (frame_height, frame_width)
-            if scores[0][i] > min_score:
-                top, left = (int(boxes[0][i][0] * shape[0]), int(boxes[0][i][1] * shape[1]))
-                bot, right = (int(boxes[0][i][2] * shape[0]), int(boxes[0][i][3] * shape[1]))
-                detections.append({
-                    'x': left,
-                    'y': top,
-                    'w': right - left,
-                    'h': bot - top,
-                    'score': scores[0][i],
-                    'object_name': self.class_index_to_string[int(classes[0][i])]
-                })
-        return detections
+        (image_shape, boxes, scores, classes, num_detections) = self.session.run(
+            [self.image_shape, self.boxes, self.scores, self.classes, self.num_detections])
+        return self.parse_detections(boxes[0], scores[0], classes[0], image_shape[1:3], min_score)
+
+    def detect_batch(self, paths_or_arrays, sizes=None, min_score=0.20, batch_size=8):
+        """
+        Detect objects in images given as paths or RGB arrays, sizes are (width, height) of each image (e.g. from
+        Frame.w / Frame.h) used to group images of identical shape into batches without opening them first.
+        Returns a list of detections for each image.
+        """
+        results = [None] * len(paths_or_arrays)
+        for indexes in group_by_size(paths_or_arrays, sizes).values():
+            for start in range(0, len(indexes), batch_size):
+                batch = indexes[start:start + batch_size]
+                images = [paths_or_arrays[k] if isinstance(paths_or_arrays[k], np.ndarray)
+                          else np.asarray(PIL.Image.open(paths_or_arrays[k]).convert('RGB')) for k in batch]
+                if len({image.shape for image in images}) > 1:
+                    # sizes did not match the images, fall back to one image per batch
+                    detections = [self.detect_images([image], min_score)[0] for image in images]
+                else:
+                    detections = self.detect_images(images, min_score)
+                for k, d in zip(batch, detections):
+                    results[k] = d
+        return results
+
+    def detect_images(self, images, min_score=0.20):
+        """
+        Detect objects in a list of decoded RGB images (uint8 arrays of identical shape), returns a list of
+        detections for each image.
+        """
+        (boxes, scores, classes, num_detections) = self.session.run(
+            [self.boxes, self.scores, self.classes, self.num_detections], feed_dict={self.image: np.stack(images)})
+        return [self.parse_detections(boxes[k], scores[k], classes[k], images[k].shape[:2], min_score)
+                for k in range(len(images))]
+
+    def parse_detections(self, boxes, scores, classes, shape, min_score):
+        keep = np.flatnonzero(scores > min_score)
+        height, width = float(shape[0]), float(shape[1])
+        scaled = (boxes[keep] * np.array([height, width, height, width])).astype(np.int64)
+        return [{'x': int(left),
+                 'y': int(top),
+                 'w': int(right - left),
+                 'h': int(bot - top),
+                 'score': scores[i],
+                 'object_name': self.class_index_to_string[int(classes[i])]}
+                for i, (top, left, bot, right) in zip(keep, scaled)]
 
     def load(self):
         self.detection_graph = tf.Graph()
@@ -143,6 +187,7 @@ class TFDetector(BaseDetector):
             self.scores = self.detection_graph.get_tensor_by_name('detection_scores:0')
             self.classes = self.detection_graph.get_tensor_by_name('detection_classes:0')
             self.num_detections = self.detection_graph.get_tensor_by_name('num_detections:0')
+            self.image_shape = tf.shape(self.image)
 
 
 class FaceDetector():
@@ -167,36 +212,76 @@ class FaceDetector():
             with self.session.as_default():
                 self.pnet, self.rnet, self.onet = detect_face.create_mtcnn(self.session, None)
 
-    def detect(self, image_path):
-        aligned = []
+    def read_image(self, image_path):
         try:
             img = misc.imread(image_path)
         except (IOError, ValueError, IndexError) as e:
             errorMessage = '{}: {}'.format(image_path, e)
             logging.info(errorMessage)
-        else:
-            if img.ndim < 2:
-                logging.info('Unable to align "%s"' % image_path)
-                return []
-            if img.ndim == 2:
-                img = facenet.to_rgb(img)
-            img = img[:, :, 0:3]
-            bounding_boxes, _ = detect_face.detect_face(img, self.minsize, self.pnet, self.rnet, self.onet,
-                                                        self.threshold, self.factor)
-            nrof_faces = bounding_boxes.shape[0]
-            if nrof_faces > 0:
-                det_all = bounding_boxes[:, 0:4]
-                img_size = np.asarray(img.shape)[0:2]
-                for boxindex in range(nrof_faces):
-                    det = np.squeeze(det_all[boxindex, :])
-                    bb = np.zeros(4, dtype=np.int32)
-                    bb[0] = np.maximum(det[0] - self.margin / 2, 0)
-                    bb[1] = np.maximum(det[1] - self.margin / 2, 0)
-                    bb[2] = np.minimum(det[2] + self.margin / 2, img_size[1])
-                    bb[3] = np.minimum(det[3] + self.margin / 2, img_size[0])
-                    left, top, right, bottom = bb[0], bb[1], bb[2], bb[3]
-                    aligned.append({'x': left, 'y': top, 'w': right - left, 'h': bottom - top})
-            return aligned
+            return None
+        if img.ndim < 2:
+            logging.info('Unable to align "%s"' % image_path)
+            return None
+        if img.ndim == 2:
+            img = facenet.to_rgb(img)
+        return img[:, :, 0:3]
+
+    def align(self, bounding_boxes, img_shape):
+        aligned = []
+        nrof_faces = bounding_boxes.shape[0]
+        if nrof_faces > 0:
+            det_all = bounding_boxes[:, 0:4]
+            img_size = np.asarray(img_shape)[0:2]
+            for boxindex in range(nrof_faces):
+                det = np.squeeze(det_all[boxindex, :])
+                bb = np.zeros(4, dtype=np.int32)
+                bb[0] = np.maximum(det[0] - self.margin / 2, 0)
+                bb[1] = np.maximum(det[1] - self.margin / 2, 0)
+                bb[2] = np.minimum(det[2] + self.margin / 2, img_size[1])
+                bb[3] = np.minimum(det[3] + self.margin / 2, img_size[0])
+                left, top, right, bottom = bb[0], bb[1], bb[2], bb[3]
+                aligned.append({'x': left, 'y': top, 'w': right - left, 'h': bottom - top})
+        return aligned
+
+    def detect(self, image_path):
+        img = self.read_image(image_path)
+        if img is None:
+            return []
+        bounding_boxes, _ = detect_face.detect_face(img, self.minsize, self.pnet, self.rnet, self.onet,
+                                                    self.threshold, self.factor)
+        return self.align(bounding_boxes, img.shape)
+
+    def detect_batch(self, paths_or_arrays, sizes=None, batch_size=8):
+        """
+        Runs each stage of the MTCNN cascade across a batch of images of identical size using bulk_detect_face,
+        returns a list of detections for each image identical to calling detect on every image.
+        """
+        results = [[] for _ in paths_or_arrays]
+        for (width, height), indexes in group_by_size(paths_or_arrays, sizes).items():
+            # bulk_detect_face computes the minimum face size as int(ratio * min(w, h)), half a pixel is added so
+            # that rounding yields exactly self.minsize
+            ratio = (self.minsize + 0.5) / min(width, height)
+            for start in range(0, len(indexes), batch_size):
+                batch, images = [], []
+                for k in indexes[start:start + batch_size]:
+                    image = paths_or_arrays[k]
+                    img = image[:, :, 0:3] if isinstance(image, np.ndarray) else self.read_image(image)
+                    if img is not None:
+                        batch.append(k)
+                        images.append(img)
+                if len({img.shape[:2] for img in images}) > 1:
+                    # sizes did not match the images
+                    for k, img in zip(batch, images):
+                        bounding_boxes, _ = detect_face.detect_face(img, self.minsize, self.pnet, self.rnet,
+                                                                    self.onet, self.threshold, self.factor)
+                        results[k] = self.align(bounding_boxes, img.shape)
+                elif images:
+                    detections = detect_face.bulk_detect_face(images, ratio, self.pnet, self.rnet, self.onet,
+                                                              self.threshold, self.factor)
+                    for k, img, detection in zip(batch, images, detections):
+                        if detection is not None:
+                            results[k] = self.align(detection[0], img.shape)
+        return results
 
 
 class TextBoxDetector():
@@ -0,0 +1,79 @@
+import os
+import json
+import struct
+
+FOOTER = struct.Struct('<Q8s')
+MAGIC = b'DVAPACK1'
+
+
+class FramePack(object):
+    """
+    Single file holding encoded images of many frames so that a segment can be fetched with one request. Images are
+    concatenated followed by a JSON index of {frame_index: [offset, length]}, the index offset and a magic string.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.index = None
+        self.fh = None
+
+    @classmethod
+    def write(cls, path, frames):
+        """
+        Writes frames, an iterable of (frame_index, path to an encoded image), atomically to path.
+        """
+        index = {}
+        temp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(temp_path, 'wb') as out:
+            offset = 0
+            for frame_index, image_path in frames:
+                with open(image_path, 'rb') as fh:
+                    data = fh.read()
+                out.write(data)
+                index[str(frame_index)] = [offset, len(data)]
+                offset += len(data)
+            out.write(json.dumps(index).encode('utf-8'))
+            out.write(FOOTER.pack(offset, MAGIC))
+        os.rename(temp_path, path)
+        return cls(path)
+
+    def open(self):
+        if self.fh is None:
+            self.fh = open(self.path, 'rb')
+            self.fh.seek(-FOOTER.size, os.SEEK_END)
+            end = self.fh.tell()
+            index_offset, magic = FOOTER.unpack(self.fh.read(FOOTER.size))
+            if magic != MAGIC:
+                raise ValueError("{} is not a frame pack".format(self.path))
+            self.fh.seek(index_offset)
+            self.index = {int(k): v for k, v in json.loads(self.fh.read(end - index_offset).decode('utf-8')).items()}
+        return self
+
+    def close(self):
+        if self.fh is not None:
+            self.fh.close()
+            self.fh = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __contains__(self, frame_index):
+        return int(frame_index) in self.open().index
+
+    @property
+    def frame_indexes(self):
+        return sorted(self.open().index)
+
+    def get(self, frame_index):
+        offset, length = self.open().index[int(frame_index)]
+        self.fh.seek(offset)
+        return self.fh.read(length)
+
+    def extract(self, frame_index, path):
+        temp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(temp_path, 'wb') as out:
+            out.write(self.get(frame_index))
+        os.rename(temp_path, path)
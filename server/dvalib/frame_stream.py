@@ -0,0 +1,99 @@
+import logging
+import os
+import shlex
+import subprocess as sp
+import threading
+import numpy as np
+
+try:
+    from Queue import Queue, Full
+except ImportError:
+    from queue import Queue, Full
+
+
+class FrameStream(object):
+    """
+    Decodes a video with ffmpeg into raw RGB frames read from a pipe, frames are handed over through a bounded queue
+    so that decoding overlaps with inference without ever writing images to disk.
+    """
+
+    def __init__(self, path, width, height, video_filter=None, input_options=None, queue_size=32):
+        self.path = path
+        self.input_options = input_options
+        self.width = int(width)
+        self.height = int(height)
+        self.video_filter = video_filter
+        self.queue = Queue(maxsize=queue_size)
+        self.process = None
+        self.reader = None
+        self.error = None
+        self.stopped = threading.Event()
+
+    def command(self):
+        command = 'ffmpeg -fflags +igndts -loglevel panic {} -i {}'.format(self.input_options or '', self.path)
+        if self.video_filter:
+            command += ' -vf "{}" -vsync 0'.format(self.video_filter)
+        return shlex.split(command + ' -f rawvideo -pix_fmt rgb24 -')
+
+    def start(self):
+        with open(os.devnull, 'w') as devnull:
+            self.process = sp.Popen(self.command(), stdout=sp.PIPE, stderr=devnull)
+        self.reader = threading.Thread(target=self._read)
+        self.reader.daemon = True
+        self.reader.start()
+
+    def _read(self):
+        frame_size = self.width * self.height * 3
+        try:
+            while True:
+                data = self.process.stdout.read(frame_size)
+                if len(data) < frame_size or not self._put(
+                        np.frombuffer(data, dtype=np.uint8).reshape((self.height, self.width, 3))):
+                    break
+        except Exception as e:
+            self.error = e
+        finally:
+            self._put(None)
+
+    def _put(self, item):
+        """
+        Blocks until there is room in the queue, returns False without queueing the item once the stream is closed.
+        """
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def __iter__(self):
+        if self.process is None:
+            self.start()
+        while True:
+            frame = self.queue.get()
+            if frame is None:
+                break
+            yield frame
+        self.process.wait()
+        if self.error is not None:
+            raise self.error
+        if self.process.returncode != 0:
+            raise ValueError("Could not decode {} with {}".format(self.path, " ".join(self.command())))
+
+    def close(self):
+        self.stopped.set()
+        if self.process is not None:
+            if self.process.poll() is None:
+                self.process.kill()
+                logging.info("Stopped decoding {}".format(self.path))
+            if self.reader is not None:
+                # the reader stops putting frames once stopped is set, draining unblocks a put in progress
+                while self.reader.is_alive():
+                    while not self.queue.empty():
+                        self.queue.get()
+                    self.reader.join(0.1)
+            self.process.stdout.close()
+            self.process.wait()
+        while not self.queue.empty():
+            self.queue.get()
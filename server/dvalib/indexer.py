@@ -25,13 +25,23 @@ def _parse_function(filename):
     return image_decoded, filename
 
 
+def _resize_inception(image_decoded):
+    return tf.image.resize_images(image_decoded, [299, 299])
+
+
 def _parse_resize_inception_function(filename):
     image_string = tf.read_file(filename)
     image_decoded = tf.image.decode_png(image_string, channels=3)
     # Cannot use decode_image but decode_png decodes both jpeg as well as png
     # https://github.com/tensorflow/tensorflow/issues/8551
-    image_scaled = tf.image.resize_images(image_decoded, [299, 299])
-    return image_scaled, filename
+    return _resize_inception(image_decoded), filename
+
+
+def _resize_vgg(image_decoded):
+    # First convert the range to 0-1 and then scale the image otherwise
+    # https://github.com/tensorflow/tensorflow/issues/1763
+    image_ranged = tf.image.convert_image_dtype(image_decoded, dtype=tf.float32)
+    return tf.image.resize_images(image_ranged, [224, 224])
 
 
 def _parse_resize_vgg_function(filename):
@@ -42,11 +52,12 @@ def _parse_resize_vgg_function(filename):
     """
     image_string = tf.read_file(filename)
     image_decoded = tf.image.decode_png(image_string, channels=3)
-    # First convert the range to 0-1 and then scale the image otherwise
-    # https://github.com/tensorflow/tensorflow/issues/1763
-    image_ranged = tf.image.convert_image_dtype(image_decoded, dtype=tf.float32)
-    image_scaled = tf.image.resize_images(image_ranged, [224, 224])
-    return image_scaled, filename
+    return _resize_vgg(image_decoded), filename
+
+
+def _scale_standardize(image_decoded):
+    image_scaled = tf.image.resize_images(image_decoded, [160, 160])
+    return tf.image.per_image_standardization(image_scaled)
 
 
 def _parse_scale_standardize_function(filename):
@@ -54,9 +65,7 @@ def _parse_scale_standardize_function(filename):
     image_decoded = tf.image.decode_png(image_string, channels=3)
     # Cannot use decode_image but decode_png decodes both jpeg as well as png
     # https://github.com/tensorflow/tensorflow/issues/8551
-    image_scaled = tf.image.resize_images(image_decoded, [160, 160])
-    image_standardized = tf.image.per_image_standardization(image_scaled)
-    return image_standardized, filename
+    return _scale_standardize(image_decoded), filename
 
 
 
@@ -80,9 +89,12 @@ class InceptionIndexer(BaseIndexer):
         self.fname = None
         self.image = None
         self.iterator = None
+        self.images_placeholder = None
+        self.images_preprocessed = None
         self.support_batching = True
         self.batch_size = batch_size
         self.cloud_fs_support = True
+        self.array_support = True
         if gpu_fraction:
             self.gpu_fraction = gpu_fraction
         else:
@@ -97,6 +109,8 @@ class InceptionIndexer(BaseIndexer):
                 dataset = dataset.map(_parse_resize_inception_function, num_parallel_calls=self.num_parallel_calls)
                 dataset = dataset.batch(self.batch_size)
                 self.iterator = dataset.make_initializable_iterator()
+                self.images_placeholder = tf.placeholder(tf.uint8, [None, None, None, 3], name="inception_images")
+                self.images_preprocessed = _resize_inception(self.images_placeholder)
             with gfile.FastGFile(self.network_path, 'rb') as f:
                 self.graph_def = tf.GraphDef()
                 self.graph_def.ParseFromString(f.read())
@@ -135,6 +149,10 @@ class InceptionIndexer(BaseIndexer):
                 break
         return embeddings
 
+    def apply_preprocessed(self, preprocessed):
+        features = self.session.run(self.pool3, feed_dict={self.image: preprocessed})
+        return [np.atleast_2d(np.squeeze(features[i, :, :, :])) for i in range(len(preprocessed))]
+
 
 class VGGIndexer(BaseIndexer):
     """
@@ -155,8 +173,11 @@ class VGGIndexer(BaseIndexer):
         self.fname = None
         self.image = None
         self.iterator = None
+        self.images_placeholder = None
+        self.images_preprocessed = None
         self.support_batching = True
         self.cloud_fs_support = True
+        self.array_support = True
         self.batch_size = batch_size
         if gpu_fraction:
             self.gpu_fraction = gpu_fraction
@@ -173,6 +194,8 @@ class VGGIndexer(BaseIndexer):
                 dataset = dataset.map(_parse_resize_vgg_function, num_parallel_calls=self.num_parallel_calls)
                 dataset = dataset.batch(self.batch_size)
                 self.iterator = dataset.make_initializable_iterator()
+                self.images_placeholder = tf.placeholder(tf.uint8, [None, None, None, 3], name="vgg_images")
+                self.images_preprocessed = _resize_vgg(self.images_placeholder)
             with gfile.FastGFile(network_path, 'rb') as f:
                 self.graph_def = tf.GraphDef()
                 self.graph_def.ParseFromString(f.read())
@@ -211,6 +234,10 @@ class VGGIndexer(BaseIndexer):
                 break
         return embeddings
 
+    def apply_preprocessed(self, preprocessed):
+        features = self.session.run(self.conv, feed_dict={self.image: preprocessed})
+        return [np.atleast_2d(np.squeeze(features[i, :, :, :]).sum(axis=(0, 1))) for i in range(len(preprocessed))]
+
 
 class FacenetIndexer(BaseIndexer):
     def __init__(self, model_path, gpu_fraction=None):
@@ -221,6 +248,7 @@ class FacenetIndexer(BaseIndexer):
         self.input_op = "input"
         self.net = None
         self.cloud_fs_support = True
+        self.array_support = True
         self.tf = True
         self.session = None
         self.graph_def = None
@@ -228,6 +256,8 @@ class FacenetIndexer(BaseIndexer):
         self.image = None
         self.filenames_placeholder = None
         self.emb = None
+        self.images_placeholder = None
+        self.images_preprocessed = None
         self.batch_size = 32
         if gpu_fraction:
             self.gpu_fraction = gpu_fraction
@@ -242,6 +272,8 @@ class FacenetIndexer(BaseIndexer):
             dataset = dataset.map(_parse_scale_standardize_function, num_parallel_calls=self.num_parallel_calls)
             batched_dataset = dataset.batch(self.batch_size)
             self.iterator = batched_dataset.make_initializable_iterator()
+            self.images_placeholder = tf.placeholder(tf.uint8, [None, None, None, 3])
+            self.images_preprocessed = tf.map_fn(_scale_standardize, self.images_placeholder, dtype=tf.float32)
             false_phase_train = tf.constant(False)
             with gfile.FastGFile(self.network_path, 'rb') as f:
                 self.graph_def = tf.GraphDef()
@@ -282,6 +314,10 @@ class FacenetIndexer(BaseIndexer):
                 break
         return embeddings
 
+    def apply_preprocessed(self, preprocessed):
+        features = self.session.run(self.emb, feed_dict={self.image: preprocessed})
+        return [np.atleast_2d(np.squeeze(features[i])) for i in range(len(preprocessed))]
+
 
 class BaseCustomIndexer(object):
     def __init__(self):
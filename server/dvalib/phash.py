@@ -0,0 +1,91 @@
+import numpy as np
+
+try:
+    from PIL import Image
+except ImportError:
+    pass
+
+HASH_SIZE = 8
+DCT_SIZE = 32
+
+
+def dct_matrix(n):
+    """
+    Orthonormal DCT-II basis, the 2D DCT of a batch of images X is D . X . D^T
+    """
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    matrix = np.sqrt(2.0 / n) * np.cos(np.pi * (2 * i + 1) * k / (2.0 * n))
+    matrix[0] /= np.sqrt(2.0)
+    return matrix.astype(np.float32)
+
+
+_DCT = dct_matrix(DCT_SIZE)
+
+
+def pack_bits(bits):
+    """
+    Packs an (N, 64) boolean matrix into N unsigned 64 bit integers.
+    """
+    return np.packbits(bits.astype(np.uint8), axis=1).view('>u8').ravel().astype(np.uint64)
+
+
+def load_grayscale(paths, size=DCT_SIZE):
+    return np.stack([np.asarray(Image.open(path).convert('L').resize((size, size), Image.BILINEAR),
+                                dtype=np.float32) for path in paths])
+
+
+def perceptual_hashes(grayscale):
+    """
+    DCT hashes of an (N, 32, 32) batch, bits are set where the low frequency coefficients exceed their median.
+    """
+    coefficients = np.matmul(np.matmul(_DCT, grayscale), _DCT.T)[:, :HASH_SIZE, :HASH_SIZE]
+    coefficients = coefficients.reshape(len(grayscale), -1)
+    medians = np.median(coefficients[:, 1:], axis=1)
+    return pack_bits(coefficients > medians[:, None])
+
+
+def average_hashes(grayscale):
+    """
+    Cheaper alternative to perceptual_hashes, bits are set where 8x8 block means exceed the image mean.
+    """
+    n, size = grayscale.shape[0], grayscale.shape[1]
+    blocks = grayscale.reshape(n, HASH_SIZE, size // HASH_SIZE, HASH_SIZE, size // HASH_SIZE).mean(axis=(2, 4))
+    blocks = blocks.reshape(n, -1)
+    return pack_bits(blocks > blocks.mean(axis=1)[:, None])
+
+
+def hamming_distances(hashes, other):
+    """
+    Number of differing bits between each of hashes and other (a hash or an array of the same shape).
+    """
+    xor = np.bitwise_xor(np.asarray(hashes, dtype=np.uint64), np.asarray(other, dtype=np.uint64))
+    return np.unpackbits(np.atleast_1d(xor).view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+
+def group_near_duplicates(hashes, max_distance, window=1024):
+    """
+    Assigns each hash to a representative, a hash starts a new group when it is more than max_distance bits away
+    from the representative of the current run. Returns the index of the representative for every hash.
+    """
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    representatives = np.empty(len(hashes), dtype=np.int64)
+    representative, position = 0, 0
+    while position < len(hashes):
+        distances = hamming_distances(hashes[position:position + window], hashes[representative])
+        far = np.flatnonzero(distances > max_distance)
+        end = position + far[0] if len(far) else min(position + window, len(hashes))
+        representatives[position:end] = representative
+        if len(far):
+            representative = end
+            representatives[end] = end
+            end += 1
+        position = end
+    return representatives
+
+
+def to_signed(hashes):
+    """
+    Hashes as signed 64 bit integers suitable for storing in a BigIntegerField.
+    """
+    return np.asarray(hashes, dtype=np.uint64).view(np.int64)
@@ -1,8 +1,9 @@
 import numpy as np
-from scipy import spatial
 from collections import defaultdict
-from .intervaltree import IntervalTree
+from .vector_store import VectorStore, FileLock
 import uuid
+import os
+import json
 import sys
 
 import logging
@@ -23,9 +24,114 @@ except:
     logging.warning("could not import FAISS")
 
 
+def exact_search(queries, index, n, metric='L2', norms=None, chunk_size=65536):
+    """
+    Blocked exact k-NN, distances are computed chunk by chunk using matmul against precomputed norms while a running
+    top-n is kept using argpartition. Never allocates more than len(queries) x chunk_size distances.
+    :param queries: matrix with one query vector per row
+    :param index: matrix with one indexed vector per row
+    :param n: number of neighbors per query
+    :param metric: 'L2' (returns euclidean distance) or 'IP' (returns inner product, larger is closer)
+    :param norms: optional precomputed squared norms of the index rows
+    :param chunk_size: rows of the index processed at a time
+    :return: distances and ids, both of shape (len(queries), min(n, len(index)))
+    """
+    queries = np.atleast_2d(queries).astype(np.float32)
+    total = index.shape[0]
+    n = min(n, total)
+    query_count = queries.shape[0]
+    rows = np.arange(query_count)[:, np.newaxis]
+    best_dist = np.empty((query_count, 0), dtype=np.float32)
+    best_ids = np.empty((query_count, 0), dtype=np.int64)
+    if n == 0:
+        return best_dist, best_ids
+    if metric == 'L2':
+        query_norms = np.einsum('ij,ij->i', queries, queries)[:, np.newaxis]
+    elif metric != 'IP':
+        raise ValueError("Unknown metric {}".format(metric))
+    for start in range(0, total, chunk_size):
+        block = index[start:start + chunk_size]
+        scores = np.dot(queries, block.T)
+        if metric == 'L2':
+            if norms is None:
+                block_norms = np.einsum('ij,ij->i', block, block)
+            else:
+                block_norms = norms[start:start + block.shape[0]]
+            block_dist = query_norms - 2.0 * scores + block_norms[np.newaxis, :]
+        else:
+            block_dist = -scores
+        block_ids = np.arange(start, start + block.shape[0], dtype=np.int64)
+        if block.shape[0] > n:
+            part = np.argpartition(block_dist, n - 1, axis=1)[:, :n]
+            block_dist = block_dist[rows, part]
+            block_ids = block_ids[part]
+        else:
+            block_ids = np.tile(block_ids, (query_count, 1))
+        candidate_dist = np.hstack([best_dist, block_dist])
+        candidate_ids = np.hstack([best_ids, block_ids])
+        if candidate_dist.shape[1] > n:
+            part = np.argpartition(candidate_dist, n - 1, axis=1)[:, :n]
+            candidate_dist = candidate_dist[rows, part]
+            candidate_ids = candidate_ids[rows, part]
+        best_dist, best_ids = candidate_dist, candidate_ids
+    order = np.argsort(best_dist, axis=1)
+    best_dist = best_dist[rows, order]
+    best_ids = best_ids[rows, order]
+    if metric == 'L2':
+        best_dist = np.sqrt(np.maximum(best_dist, 0))
+    else:
+        best_dist = -best_dist
+    return best_dist, best_ids
+
+
+class EntryOffsets(object):
+    """
+    Maps global vector ids to (IndexEntries pk, offset). Since IndexEntries are appended as contiguous ranges, a
+    sorted array of start offsets resolves a whole batch of ids with a single np.searchsorted.
+    """
+
+    def __init__(self):
+        self.starts = []
+        self.pks = []
+        self.starts_array = None
+        self.pks_array = None
+
+    def __len__(self):
+        return len(self.pks)
+
+    def add(self, begin, count, pk):
+        if self.starts and begin < self.starts[-1]:
+            raise ValueError("Entry {} starting at {} is not appended after {}".format(pk, begin, self.starts[-1]))
+        self.starts.append(begin)
+        self.pks.append(pk)
+        self.starts_array = None
+
+    def resolve(self, ids):
+        if self.starts_array is None:
+            self.starts_array = np.array(self.starts, dtype=np.int64)
+            self.pks_array = np.empty(len(self.pks), dtype=object)
+            self.pks_array[:] = self.pks
+        positions = np.searchsorted(self.starts_array, ids, side='right') - 1
+        return self.pks_array[positions], ids - self.starts_array[positions]
+
+    def results(self, name, dist, ids):
+        """
+        Convert distances / ids returned by a search (-1 denotes a missing result) into results for each query.
+        """
+        results = defaultdict(list)
+        ids = np.atleast_2d(ids)
+        valid = ids >= 0
+        if valid.any():
+            pks, offsets = self.resolve(ids[valid])
+            for (vindex, i), pk, offset in zip(np.argwhere(valid), pks, offsets):
+                results[int(vindex)].append({'rank': int(i) + 1, 'algo': name, 'dist': float(dist[vindex, i]),
+                                             'indexentries_pk': pk, 'offset': int(offset)})
+        return results
+
+
 class SimpleRetriever(object):
 
-    def __init__(self, name, approximator=None, algorithm="EXACT"):
+    def __init__(self, name, approximator=None, algorithm="EXACT", store_path=None, metric='L2', chunk_size=65536):
         self.name = name
         self.algorithm = algorithm
         self.approximate = False
@@ -34,40 +140,73 @@ class SimpleRetriever(object):
         self.loaded_entries = set()
         self.index = None
         self.findex = 0
-        self.tree = IntervalTree()
-        self.support_batching = False
+        self.offsets = EntryOffsets()
+        self.support_batching = True
+        self.metric = metric
+        self.chunk_size = chunk_size
+        self.store = None
+        self.synced_entries = 0
+        self.synced_generation = 0
+        if store_path:
+            # Reopens vectors persisted by a previous run or by another retriever process.
+            self.store = VectorStore(path=store_path)
+            self.sync_store()
+
+    def refresh_store(self):
+        if self.store is not None:
+            self.store.refresh()
+            self.sync_store()
 
     def add_vectors(self, numpy_matrix, count, pk):
         self.loaded_entries.add(pk)
         if count:
-            self.tree.addi(self.findex, self.findex + count, pk)
-            self.findex += count
-            temp_index = [numpy_matrix, ]
-            if self.index is None:
-                self.index = np.atleast_2d(np.concatenate(temp_index).squeeze())
-                logging.info(self.index.shape)
-            else:
-                self.index = np.concatenate([self.index, np.atleast_2d(np.concatenate(temp_index).squeeze())])
-                logging.info(self.index.shape)
+            numpy_matrix = np.atleast_2d(numpy_matrix.squeeze())
+            if self.store is None:
+                self.store = VectorStore(components=numpy_matrix.shape[-1])
+            self.store.append(pk, numpy_matrix)
+            self.sync_store()
+            logging.info(self.index.shape)
 
-    def nearest(self, vector=None, n=12, nprobe=None):
-        dist = None
-        results = []
+    def remove_entries(self, pks):
+        """
+        Removes vectors of deleted IndexEntries so that searches do not return hits which cannot be resolved.
+        """
+        self.loaded_entries.difference_update(pks)
+        if self.store is not None:
+            self.store.remove(pks)
+            self.sync_store()
+
+    def sync_store(self):
+        if self.store.generation != self.synced_generation:
+            # the store was compacted, possibly by another process, offsets of all entries are rebuilt
+            self.loaded_entries -= set(self.offsets.pks) - self.store.entry_pks
+            self.offsets = EntryOffsets()
+            self.synced_entries = 0
+            self.synced_generation = self.store.generation
+        for pk, begin, count in self.store.entries[self.synced_entries:]:
+            self.offsets.add(begin, count, pk)
+            self.loaded_entries.add(pk)
+        self.synced_entries = len(self.store.entries)
+        self.findex = self.store.count
+        self.index = self.store.vectors
+
+    def search(self, vectors, n):
         if self.approximator:
-            vector = np.atleast_2d(self.approximator.approximate(vector))
-        if self.index is not None:
-            try:
-                dist = spatial.distance.cdist(vector, self.index)
-            except:
-                raise ValueError("Could not compute dist Vector {} and shape {}".format(vector.shape, self.index.shape))
-        if dist is not None:
-            ranked = np.squeeze(dist.argsort())
-            for i, k in enumerate(ranked[:n]):
-                index_entry = sorted(self.tree[k])[0]
-                temp = {'rank': i + 1, 'algo': self.name, 'dist': float(dist[0, i]),
-                        'indexentries_pk':index_entry.data, 'offset':k - index_entry.begin}
-                results.append(temp)
-        return results
+            vectors = np.vstack([np.atleast_2d(self.approximator.approximate(v)) for v in np.atleast_2d(vectors)])
+        vectors = np.atleast_2d(vectors)
+        if vectors.shape[-1] != self.index.shape[-1]:
+            raise ValueError("Could not compute dist Vector {} and shape {}".format(vectors.shape, self.index.shape))
+        return exact_search(vectors, self.index, n, metric=self.metric, norms=self.store.squared_norms,
+                            chunk_size=self.chunk_size)
+
+    def nearest(self, vector=None, n=12, nprobe=None):
+        return self.nearest_batch(vector, n, nprobe)[0]
+
+    def nearest_batch(self, vectors=None, n=12, nprobe=None):
+        if self.index is None:
+            return defaultdict(list)
+        dist, ids = self.search(vectors, n)
+        return self.offsets.results(self.name, dist, ids)
 
 
 class LOPQRetriever(object):
@@ -115,8 +254,9 @@ class FaissApproximateRetriever(object):
         self.algorithm = "FAISS"
         self.uuid = str(uuid.uuid4()).replace('-', '_')
         self.faiss_index = None
-        self.tree = IntervalTree()
+        self.offsets = EntryOffsets()
         self.loaded_entries = set()
+        self.support_batching = True
         self.findex = 0
 
     def add_vectors(self, computed_index_path, count, pk):
@@ -124,19 +264,23 @@ class FaissApproximateRetriever(object):
         if count:
             computed_index_path = str(computed_index_path).replace('//', '/')
             logging.info("Adding {}".format(computed_index_path))
-            self.tree.addi(self.findex, self.findex + count, pk)
+            self.offsets.add(self.findex, count, pk)
             self.findex += count
-
-            if self.faiss_index is None:
-                self.faiss_index = faiss.read_index(computed_index_path)
-            else:
-                index = faiss.read_index(computed_index_path)
-                if type(self.faiss_index) == faiss.swigfaiss.IndexPreTransform:
-                    faiss.merge_into(self.faiss_index,index,True)
-                else:
-                    self.faiss_index.merge_from(index, self.faiss_index.ntotal)
+            self.faiss_index = merge_faiss_index(self.faiss_index, faiss.read_index(computed_index_path))
             logging.info("Index size {}".format(self.faiss_index.ntotal))
 
+    def add_shard(self, shard_path, entries):
+        """
+        Adds a shard written by FaissShards, entries is the list of (pk, count) merged into it.
+        """
+        logging.info("Adding shard {} with {} entries".format(shard_path, len(entries)))
+        self.faiss_index = merge_faiss_index(self.faiss_index, faiss.read_index(str(shard_path)))
+        for pk, count in entries:
+            self.loaded_entries.add(pk)
+            self.offsets.add(self.findex, count, pk)
+            self.findex += count
+        logging.info("Index size {}".format(self.faiss_index.ntotal))
+
     def nearest(self, vector=None, n=12, nprobe=16):
         logging.info("Index size {} with {} loaded entries in {}".format(self.faiss_index.ntotal,
                                                                          len(self.loaded_entries), self.name))
@@ -148,31 +292,98 @@ class FaissApproximateRetriever(object):
         vector = np.atleast_2d(vector)
         if vector.shape[-1] != self.faiss_index.d:
             vector = vector.T
-        results = []
         dist, ids = self.faiss_index.search(vector, n)
-        for i, k in enumerate(ids[0]):
-            if k >= 0:
-                index_entry = sorted(self.tree[k])[0]
-                temp = {'rank': i + 1, 'algo': self.name, 'dist': float(dist[0, i]),
-                        'indexentries_pk': index_entry.data, 'offset': k - index_entry.begin}
-                results.append(temp)
-        return results
+        return self.offsets.results(self.name, dist, ids)[0]
 
     def nearest_batch(self, vectors=None, n=12, nprobe=16):
-        self.faiss_index.nprobe = nprobe
+        if type(self.faiss_index) == faiss.swigfaiss.IndexPreTransform:
+            index_ivf = faiss.downcast_index(self.faiss_index.index)
+            index_ivf.nprobe = nprobe
+        else:
+            self.faiss_index.nprobe = nprobe
         vectors = np.atleast_2d(vectors)
         if vectors.shape[-1] != self.faiss_index.d:
             vectors = vectors.T
         dist, ids = self.faiss_index.search(vectors, n)
-        results = defaultdict(list)
-        for vindex in range(ids.shape[0]):
-            for i, k in enumerate(ids[vindex]):
-                if k >= 0:
-                    index_entry = sorted(self.tree[k])[0]
-                    temp = {'rank': i + 1, 'algo': self.name, 'dist': float(dist[vindex, i]),
-                            'indexentries_pk':index_entry.data, 'offset':k - index_entry.begin}
-                    results[vindex].append(temp)
-        return results
+        return self.offsets.results(self.name, dist, ids)
+
+
+def merge_faiss_index(target, index):
+    if target is None:
+        return index
+    if type(target) == faiss.swigfaiss.IndexPreTransform:
+        faiss.merge_into(target, index, True)
+    else:
+        target.merge_from(index, target.ntotal)
+    return target
+
+
+class FaissShards(object):
+    """
+    Per event FAISS index files merged into larger shards, so that a retriever can start by reading a few shards
+    rather than every IndexEntries file. Shards are recorded along with the (pk, count) of entries they cover in a
+    JSON manifest at path + '.json'.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.shards = []
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                if not os.path.isdir(dirname):
+                    raise
+
+    @property
+    def manifest_path(self):
+        return "{}.json".format(self.path)
+
+    @property
+    def covered_entries(self):
+        return set(pk for shard in self.shards for pk, _ in shard['entries'])
+
+    def lock(self):
+        return FileLock("{}.lock".format(self.path))
+
+    def reload(self):
+        if os.path.isfile(self.manifest_path):
+            with open(self.manifest_path) as fh:
+                self.shards = json.load(fh)['shards']
+        return self.shards
+
+    def compact(self, entries, min_entries=1):
+        """
+        Merges index files of entries, a list of (pk, count, index_path), which are not yet covered by a shard into
+        a new shard. Returns the number of entries merged.
+        """
+        with self.lock():
+            self.reload()
+            covered = self.covered_entries
+            entries = [(pk, count, index_path) for pk, count, index_path in entries if pk not in covered and count]
+            if len(entries) < min_entries:
+                return 0
+            shard_path = "{}.{}.index".format(self.path, len(self.shards))
+            merged = None
+            for _, _, index_path in entries:
+                merged = merge_faiss_index(merged, faiss.read_index(str(index_path).replace('//', '/')))
+            temp_path = "{}.{}.tmp".format(shard_path, os.getpid())
+            faiss.write_index(merged, temp_path)
+            os.rename(temp_path, shard_path)
+            self.shards.append({'path': shard_path, 'entries': [[pk, count] for pk, count, _ in entries]})
+            temp_path = "{}.{}.tmp".format(self.manifest_path, os.getpid())
+            with open(temp_path, 'w') as fh:
+                json.dump({'shards': self.shards}, fh)
+            os.rename(temp_path, self.manifest_path)
+            logging.info("Merged {} entries into shard {}".format(len(entries), shard_path))
+            return len(entries)
+
+    def load_into(self, faiss_retriever):
+        with self.lock():
+            self.reload()
+        for shard in self.shards:
+            faiss_retriever.add_shard(shard['path'], shard['entries'])
 
 
 class FaissFlatRetriever(object):
@@ -180,16 +391,17 @@ class FaissFlatRetriever(object):
     def __init__(self, name, components, metric='Flat'):
         self.findex = 0
         self.name = name
-        self.tree = IntervalTree()
+        self.offsets = EntryOffsets()
         self.components = components
         self.algorithm = "FAISS_{}".format(metric)
         self.loaded_entries = set()
+        self.support_batching = True
         self.faiss_index = faiss.index_factory(components, metric)
 
     def add_vectors(self, numpy_matrix, count, pk):
         self.loaded_entries.add(pk)
         if count:
-            self.tree.addi(self.findex, self.findex + count, pk)
+            self.offsets.add(self.findex, count, pk)
             self.findex += count
             logging.info("Adding {}".format(numpy_matrix.shape))
             numpy_matrix = np.atleast_2d(numpy_matrix.squeeze())
@@ -200,27 +412,12 @@ class FaissFlatRetriever(object):
         vector = np.atleast_2d(vector)
         if vector.shape[-1] != self.components:
             vector = vector.T
-        results = []
         dist, ids = self.faiss_index.search(vector, n)
-        for i, k in enumerate(ids[0]):
-            if k >= 0:
-                index_entry = sorted(self.tree[k])[0]
-                temp = {'rank': i + 1, 'algo': self.name, 'dist': float(dist[0, i]),
-                        'indexentries_pk':index_entry.data, 'offset':k - index_entry.begin}
-                results.append(temp)
-        return results
+        return self.offsets.results(self.name, dist, ids)[0]
 
     def nearest_batch(self, vectors=None, n=12, nprobe=None):
         vectors = np.atleast_2d(vectors)
         if vectors.shape[-1] != self.components:
             vectors = vectors.T
         dist, ids = self.faiss_index.search(vectors, n)
-        results = defaultdict(list)
-        for vindex in range(ids.shape[0]):
-            for i, k in enumerate(ids[vindex]):
-                if k >= 0:
-                    index_entry = sorted(self.tree[k])[0]
-                    temp = {'rank': i + 1, 'algo': self.name, 'dist': float(dist[vindex, i]),
-                            'indexentries_pk':index_entry.data, 'offset':k - index_entry.begin}
-                    results[vindex].append(temp)
-        return results
+        return self.offsets.results(self.name, dist, ids)
@@ -0,0 +1,211 @@
+import os
+import json
+import errno
+import fcntl
+import logging
+import numpy as np
+
+
+class VectorStore(object):
+    """
+    Append-only float32 matrix which grows geometrically instead of being re-concatenated for every IndexEntries.
+    When a path is provided the matrix is backed by a memory mapped file, entries are recorded in a JSON sidecar
+    so that the store can be reopened on restart (or by other retriever processes) without re-reading .npy files.
+    """
+
+    def __init__(self, components=None, path=None, capacity=1024, growth_factor=2.0):
+        self.components = components
+        self.path = path
+        self.initial_capacity = capacity
+        self.growth_factor = growth_factor
+        self.capacity = 0
+        self.count = 0
+        self.entries = []  # list of (indexentries_pk, start, count) in order of insertion
+        self.entry_pks = set()
+        self.data = None
+        self.norms = None
+        self.normed_count = 0
+        self.generation = 0  # incremented whenever entries are removed and rows move
+        if self.path:
+            dirname = os.path.dirname(self.path)
+            if dirname and not os.path.isdir(dirname):
+                try:
+                    os.makedirs(dirname)
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+            self.refresh()
+
+    @property
+    def metadata_path(self):
+        return "{}.json".format(self.path)
+
+    @property
+    def vectors(self):
+        if self.data is None:
+            return None
+        return self.data[:self.count]
+
+    @property
+    def squared_norms(self):
+        """
+        Squared L2 norms used by exact search, only rows appended since the last call are computed.
+        """
+        if self.data is None:
+            return None
+        if self.norms is None or self.norms.shape[0] < self.capacity:
+            norms = np.empty(self.capacity, dtype=np.float32)
+            if self.normed_count:
+                norms[:self.normed_count] = self.norms[:self.normed_count]
+            self.norms = norms
+        if self.normed_count < self.count:
+            block = self.data[self.normed_count:self.count]
+            self.norms[self.normed_count:self.count] = np.einsum('ij,ij->i', block, block)
+            self.normed_count = self.count
+        return self.norms[:self.count]
+
+    def lock(self):
+        return FileLock("{}.lock".format(self.path))
+
+    def refresh(self):
+        if self.path and os.path.isfile(self.metadata_path):
+            with self.lock():
+                self.reload()
+
+    def reload(self):
+        """
+        Sync count / entries with the sidecar written by this or another process and remap the file if it grew.
+        """
+        with open(self.metadata_path) as fh:
+            metadata = json.load(fh)
+        if self.components is None:
+            self.components = metadata['components']
+        elif self.components != metadata['components']:
+            raise ValueError("{} stores vectors with {} components, expected {}".format(
+                self.path, metadata['components'], self.components))
+        if metadata.get('generation', 0) != self.generation:
+            # entries were removed by another process, rows after them have moved
+            self.generation = metadata.get('generation', 0)
+            self.entries = []
+            self.entry_pks = set()
+            self.norms = None
+            self.normed_count = 0
+        for pk, start, count in metadata['entries'][len(self.entries):]:
+            self.entries.append((pk, start, count))
+            self.entry_pks.add(pk)
+        self.count = metadata['count']
+        capacity = os.path.getsize(self.path) // (4 * self.components)
+        if self.data is None or capacity != self.capacity:
+            self.capacity = capacity
+            self.data = np.memmap(self.path, dtype=np.float32, mode='r+', shape=(self.capacity, self.components))
+
+    def reserve(self, rows):
+        required = self.count + rows
+        if required <= self.capacity:
+            return
+        capacity = max(self.capacity, self.initial_capacity)
+        while capacity < required:
+            capacity = int(capacity * self.growth_factor)
+        if self.path:
+            if self.data is not None:
+                self.data.flush()
+                self.data = None
+            with open(self.path, 'ab') as fh:
+                fh.truncate(capacity * self.components * 4)
+            self.data = np.memmap(self.path, dtype=np.float32, mode='r+', shape=(capacity, self.components))
+        else:
+            data = np.empty((capacity, self.components), dtype=np.float32)
+            if self.count:
+                data[:self.count] = self.data[:self.count]
+            self.data = data
+        logging.info("Grew vector store from {} to {} rows".format(self.capacity, capacity))
+        self.capacity = capacity
+
+    def append(self, pk, numpy_matrix):
+        """
+        Add vectors for an IndexEntries, returns False if the entry was already added (possibly by another process).
+        """
+        numpy_matrix = np.atleast_2d(numpy_matrix)
+        if self.components is None:
+            self.components = numpy_matrix.shape[-1]
+        if self.path:
+            with self.lock():
+                if os.path.isfile(self.metadata_path):
+                    self.reload()
+                return self._append(pk, numpy_matrix)
+        else:
+            return self._append(pk, numpy_matrix)
+
+    def _append(self, pk, numpy_matrix):
+        if pk in self.entry_pks:
+            return False
+        rows = numpy_matrix.shape[0]
+        self.reserve(rows)
+        self.data[self.count:self.count + rows] = numpy_matrix
+        self.entries.append((pk, self.count, rows))
+        self.entry_pks.add(pk)
+        self.count += rows
+        if self.path:
+            self.flush()
+        return True
+
+    def remove(self, pks):
+        """
+        Drops vectors of IndexEntries in pks by moving rows of later entries down, returns the number of rows removed.
+        """
+        if self.path:
+            with self.lock():
+                if os.path.isfile(self.metadata_path):
+                    self.reload()
+                return self._remove(pks)
+        else:
+            return self._remove(pks)
+
+    def _remove(self, pks):
+        pks = self.entry_pks.intersection(pks)
+        if not pks:
+            return 0
+        entries = []
+        count = 0
+        for pk, start, rows in self.entries:
+            if pk not in pks:
+                if start != count:
+                    self.data[count:count + rows] = self.data[start:start + rows]
+                entries.append((pk, count, rows))
+                count += rows
+        removed = self.count - count
+        self.entries = entries
+        self.entry_pks -= pks
+        self.count = count
+        self.norms = None
+        self.normed_count = 0
+        self.generation += 1
+        if self.path:
+            self.flush()
+        logging.info("Removed {} entries with {} rows from vector store".format(len(pks), removed))
+        return removed
+
+    def flush(self):
+        self.data.flush()
+        temp_path = "{}.{}.tmp".format(self.metadata_path, os.getpid())
+        with open(temp_path, 'w') as fh:
+            json.dump({'components': self.components, 'count': self.count, 'entries': self.entries,
+                       'generation': self.generation}, fh)
+        os.rename(temp_path, self.metadata_path)
+
+
+class FileLock(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.fh = None
+
+    def __enter__(self):
+        self.fh = open(self.path, 'a')
+        fcntl.flock(self.fh, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        fcntl.flock(self.fh, fcntl.LOCK_UN)
+        self.fh.close()
+        self.fh = None
@@ -411,7 +411,7 @@ def get_url(r):
         region_path = r.region.crop_and_get_region_path({},settings.MEDIA_ROOT)
         return "data:image/jpeg;base64, {}".format(base64.b64encode(file(region_path).read()))
     else:
-        return '{}{}/frames/{}.jpg'.format(settings.MEDIA_URL, r.video_id, r.frame_index)
+        return dvaapp.models.frame_media_url(r.video_id, r.frame_index)
 
 
 def get_sequence_name(i, r):
@@ -205,7 +205,7 @@ class FrameDetail(UserPassesTestMixin, DetailView):
                                                                  video_id=self.object.video_id,
                                                                  region_type=models.Region.ANNOTATION)
         context['video'] = self.object.video
-        context['url'] = '{}{}/frames/{}.jpg'.format(settings.MEDIA_URL, self.object.video.pk, self.object.frame_index)
+        context['url'] = self.object.media_url
         context['previous_frame'] = models.Frame.objects.filter(video=self.object.video,
                                                          frame_index__lt=self.object.frame_index).order_by(
             '-frame_index')[0:1]
@@ -225,7 +225,7 @@ class RegionDetail(UserPassesTestMixin, DetailView):
     def get_context_data(self, **kwargs):
         context = super(RegionDetail, self).get_context_data(**kwargs)
         context['video'] = self.object.video
-        context['url'] = '{}{}/frames/{}.jpg'.format(settings.MEDIA_URL, self.object.video.pk, self.object.frame_index)
+        context['url'] = models.frame_media_url(self.object.video_id, self.object.frame_index)
         return context
 
     def test_func(self):
@@ -529,11 +529,10 @@ def index(request, query_pk=None, frame_pk=None, detection_pk=None):
         context['initial_url'] = '{}queries/{}.png'.format(settings.MEDIA_URL, previous_query.uuid)
     elif frame_pk:
         frame = models.Frame.objects.get(pk=frame_pk)
-        context['initial_url'] = '{}{}/frames/{}.jpg'.format(settings.MEDIA_URL, frame.video.pk, frame.frame_index)
+        context['initial_url'] = frame.media_url
     elif detection_pk:
         detection = models.Region.objects.get(pk=detection_pk)
-        context['initial_url'] = '{}{}/frames/{}.jpg'.format(settings.MEDIA_URL, detection.video.pk,
-                                                             detection.frame_index)
+        context['initial_url'] = models.frame_media_url(detection.video_id, detection.frame_index)
     context['frame_count'] = models.Frame.objects.count()
     context['query_count'] = models.DVAPQL.objects.filter(process_type=models.DVAPQL.QUERY).count()
     context['process_count'] = models.DVAPQL.objects.filter(process_type=models.DVAPQL.PROCESS).count()
@@ -566,7 +565,7 @@ def annotate(request, frame_pk):
     context = {'frame': None, 'detection': None, 'existing': []}
     frame = models.Frame.objects.get(pk=frame_pk)
     context['frame'] = frame
-    context['initial_url'] = '{}{}/frames/{}.jpg'.format(settings.MEDIA_URL, frame.video.pk, frame.frame_index)
+    context['initial_url'] = frame.media_url
     context['previous_frame'] = models.Frame.objects.filter(video=frame.video, frame_index__lt=frame.frame_index).order_by(
         '-frame_index')[0:1]
     context['next_frame'] = models.Frame.objects.filter(video=frame.video, frame_index__gt=frame.frame_index).order_by(
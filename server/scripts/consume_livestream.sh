@@ -1,2 +1,9 @@
 #!/usr/bin/env bash
-streamlink "$1" best -O  | ffmpeg -re -i - -c:v libx264 -c:a aac -ac 1 -strict -2 -crf 18 -profile:v baseline -maxrate 3000k -bufsize 1835k -pix_fmt yuv420p -flags -global_header -f segment -segment_time 0.1 $2/%d.mp4
+# usage: consume_livestream.sh url segments_dir [live_fifo rate]
+# when live_fifo is provided every rate-th frame is also written as BMP images to the pipe for in-process inference,
+# frames are passed through (-vsync 0) to the encoder as well so that the n-th image is the (n*rate)-th encoded frame
+if [ -z "$3" ]; then
+    streamlink "$1" best -O  | ffmpeg -re -i - -c:v libx264 -c:a aac -ac 1 -strict -2 -crf 18 -profile:v baseline -maxrate 3000k -bufsize 1835k -pix_fmt yuv420p -flags -global_header -vstats_file $2/vstats.log -f segment -segment_time 0.1 -segment_list $2/segments.csv -segment_list_type csv $2/%d.mp4
+else
+    streamlink "$1" best -O  | ffmpeg -y -re -i - -c:v libx264 -c:a aac -ac 1 -strict -2 -crf 18 -profile:v baseline -maxrate 3000k -bufsize 1835k -pix_fmt yuv420p -flags -global_header -vsync 0 -vstats_file $2/vstats.log -f segment -segment_time 0.1 -segment_list $2/segments.csv -segment_list_type csv $2/%d.mp4 -map 0:v -an -vf "select=not(mod(n\,$4))" -vsync 0 -f image2pipe -vcodec bmp $3
+fi
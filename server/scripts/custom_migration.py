@@ -16,6 +16,7 @@ class Migration(migrations.Migration):
             CREATE INDEX region_text_index_text ON dvaapp_region USING GIST (to_tsvector('english', text));
             CREATE INDEX region_text_index_object_name ON dvaapp_region USING GIST (to_tsvector('english', object_name));
             CREATE INDEX frame_text_index_name ON dvaapp_frame USING GIST (to_tsvector('english', name ));
+            CREATE SEQUENCE IF NOT EXISTS dvaapp_indexentries_sequence;
             """
         ),
     ]
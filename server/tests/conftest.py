@@ -0,0 +1,11 @@
+# Unit tests for dvalib and dvaapp helpers which do not need a database, run with "python -m pytest tests" from server/
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "dva.settings")
+os.environ.setdefault("SECRET_KEY", "unit-tests")
+
+import django
+
+django.setup()
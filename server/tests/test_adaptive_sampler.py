@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+from dvaapp.operations.decoding import AdaptiveSampler
+
+
+def static_frames(fps, seconds, value=100):
+    return [(k / float(fps), np.full((64, 64, 3), value, dtype=np.uint8)) for k in range(int(fps * seconds))]
+
+
+def test_static_video_is_sampled_at_min_fps():
+    sampler = AdaptiveSampler(min_fps=0.5, max_fps=4, threshold=0.05)
+    kept = [t for t, image in static_frames(25, 10) if sampler.update(t, image)]
+    assert kept == [0.0, 2.0, 4.0, 6.0, 8.0]
+
+
+def test_scene_changes_are_kept_up_to_max_fps():
+    sampler = AdaptiveSampler(min_fps=0.5, max_fps=2, threshold=0.05)
+    # every frame is a completely different image
+    frames = [(k / 25.0, np.full((64, 64, 3), 255 * (k % 2), dtype=np.uint8)) for k in range(100)]
+    kept = [t for t, image in frames if sampler.update(t, image)]
+    # one frame in every 0.5s slot of the max_fps grid
+    assert [int(t * 2) for t in kept] == list(range(8))
+
+
+def test_single_change_is_picked_up_after_it_happens():
+    sampler = AdaptiveSampler(min_fps=0.1, max_fps=5, threshold=0.05)
+    frames = static_frames(25, 4) + static_frames(25, 4, value=200)
+    frames = [(k / 25.0, image) for k, (_, image) in enumerate(frames)]
+    kept = [t for t, image in frames if sampler.update(t, image)]
+    assert kept == [0.0, 4.0]
+
+
+def sample_segments(frames, length, **options):
+    kept = []
+    for start in range(0, len(frames), length):
+        sampler = AdaptiveSampler(**options)
+        kept += [t for t, image in frames[start:start + length] if sampler.update(t, image)]
+    return kept
+
+
+def test_static_segments_sampled_independently_match_whole_video():
+    frames = static_frames(25, 10)
+    whole = AdaptiveSampler(min_fps=0.3, max_fps=3, threshold=0.1)
+    expected = [t for t, image in frames if whole.update(t, image)]
+    assert sample_segments(frames, 37, min_fps=0.3, max_fps=3, threshold=0.1) == expected
+
+
+def test_changing_segments_only_differ_in_their_first_slot():
+    frames = [(k / 25.0, np.full((32, 32, 3), 255 * (k % 2), dtype=np.uint8)) for k in range(250)]
+    whole = AdaptiveSampler(min_fps=0.3, max_fps=3, threshold=0.1)
+    expected = [t for t, image in frames if whole.update(t, image)]
+    kept = sample_segments(frames, 37, min_fps=0.3, max_fps=3, threshold=0.1)
+    first_slots = set(int(frames[start][0] * 3 + 1e-6) for start in range(0, len(frames), 37))
+    assert [t for t in kept if int(t * 3 + 1e-6) not in first_slots] == \
+        [t for t in expected if int(t * 3 + 1e-6) not in first_slots]
+
+
+def test_min_fps_above_max_fps_is_rejected():
+    with pytest.raises(ValueError):
+        AdaptiveSampler(min_fps=5, max_fps=1, threshold=0.1)
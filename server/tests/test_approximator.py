@@ -0,0 +1,37 @@
+import os
+import numpy as np
+from collections import namedtuple
+from dvalib.approximator import LOPQApproximator
+
+Code = namedtuple('Code', ['coarse', 'fine'])
+
+
+class FakeModel(object):
+
+    def predict(self, x):
+        return Code((int(x[0]), os.getpid()), (int(x[1]),))
+
+
+class IdentityLOPQ(LOPQApproximator):
+
+    def load(self):
+        self.model = FakeModel()
+
+    def get_pca_matrix(self, matrix):
+        return np.atleast_2d(matrix)
+
+
+def test_pool_is_reused_across_batches():
+    approx = IdentityLOPQ('test', '/tmp')
+    approx.open_pool(2)
+    try:
+        pids = set()
+        for start in (0, 10, 20):
+            matrix = np.arange(start, start + 10).repeat(2).reshape(10, 2)
+            codes = approx.approximate_batch(matrix)
+            assert [(coarse[0], fine) for coarse, fine in codes] == [(i, (i,)) for i in range(start, start + 10)]
+            pids.update(coarse[1] for coarse, _ in codes)
+    finally:
+        approx.close_pool()
+    assert len(pids) <= 2 and os.getpid() not in pids
+    assert approx.pool is None
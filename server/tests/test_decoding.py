@@ -0,0 +1,34 @@
+import json
+from dvaapp.operations.decoding import split_source_frames, segment_stream_json
+
+SOURCE_JSON = json.dumps({'streams': [
+    {'index': 0, 'codec_type': 'video', 'width': 640, 'height': 360, 'avg_frame_rate': '25/1',
+     'start_time': '1.400000', 'duration': '60.000000', 'duration_ts': 5400000, 'nb_frames': '1500',
+     'bit_rate': '800000'},
+]})
+
+
+def test_split_source_frames_by_segment_start():
+    # source timestamps start at 1.4s, segments at 0, 2 and 4 seconds
+    frames = {i: ('I' if i % 4 == 0 else 'P', 1.4 + 0.5 * i) for i in range(12)}
+    segments = split_source_frames(frames, [0.0, 2.0, 4.0])
+    assert [len(s) for s in segments] == [4, 4, 4]
+    assert [segments[1][k][0] for k in range(4)] == ['I', 'P', 'P', 'P']
+    assert [round(segments[1][k][1], 6) for k in range(4)] == [2.0, 2.5, 3.0, 3.5]
+    assert sorted(segments[2]) == [0, 1, 2, 3]
+
+
+def test_split_source_frames_tolerates_rounding():
+    frames = {0: ('I', 0.0), 1: ('P', 0.999999), 2: ('I', 1.9999995), 3: ('P', 2.5)}
+    segments = split_source_frames(frames, [0.0, 2.0])
+    assert [len(s) for s in segments] == [2, 2]
+
+
+def test_segment_stream_json_uses_segment_values():
+    metadata = json.loads(segment_stream_json(SOURCE_JSON, 10.0, 12.5, 62))
+    stream = metadata['streams'][0]
+    assert stream['start_time'] == '10.000000'
+    assert stream['duration'] == '2.500000'
+    assert stream['nb_frames'] == '62'
+    assert 'duration_ts' not in stream and 'bit_rate' not in stream
+    assert stream['width'] == 640 and stream['avg_frame_rate'] == '25/1'
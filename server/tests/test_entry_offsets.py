@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+from dvalib.retriever import EntryOffsets
+
+
+def offsets_for(ranges):
+    offsets = EntryOffsets()
+    for pk, (begin, count) in ranges:
+        offsets.add(begin, count, pk)
+    return offsets
+
+
+def test_resolve_at_boundaries():
+    offsets = offsets_for([('a', (0, 3)), ('b', (3, 1)), ('c', (4, 5))])
+    ids = np.array([0, 2, 3, 4, 8])
+    pks, positions = offsets.resolve(ids)
+    assert list(pks) == ['a', 'a', 'b', 'c', 'c']
+    assert list(positions) == [0, 2, 0, 0, 4]
+
+
+def test_resolve_after_add_invalidates_cache():
+    offsets = offsets_for([(1, (0, 2))])
+    assert list(offsets.resolve(np.array([1]))[0]) == [1]
+    offsets.add(2, 3, 2)
+    pks, positions = offsets.resolve(np.array([1, 2, 4]))
+    assert list(pks) == [1, 2, 2]
+    assert list(positions) == [1, 0, 2]
+    assert len(offsets) == 2
+
+
+def test_entries_must_be_appended_in_order():
+    offsets = offsets_for([(1, (5, 2))])
+    with pytest.raises(ValueError):
+        offsets.add(3, 1, 2)
+
+
+def test_results_skip_missing_ids():
+    offsets = offsets_for([(7, (0, 2)), (8, (2, 2))])
+    dist = np.array([[0.5, 1.5, 9.0], [0.1, 0.2, 0.3]])
+    ids = np.array([[3, 1, -1], [-1, -1, -1]])
+    results = offsets.results('exact', dist, ids)
+    assert results[0] == [{'rank': 1, 'algo': 'exact', 'dist': 0.5, 'indexentries_pk': 8, 'offset': 1},
+                          {'rank': 2, 'algo': 'exact', 'dist': 1.5, 'indexentries_pk': 7, 'offset': 1}]
+    assert 1 not in results
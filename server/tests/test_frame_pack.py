@@ -0,0 +1,60 @@
+import os
+import pytest
+from django.conf import settings
+from dvalib.frame_pack import FramePack
+from dvaapp.models import ensure_frame, frame_pack_path
+
+
+def write_images(directory, frame_indexes):
+    images = []
+    for i in frame_indexes:
+        path = str(directory.join('{}.jpg'.format(i)))
+        with open(path, 'wb') as out:
+            out.write(b'image %d ' % i * (i + 1))
+        images.append((i, path))
+    return images
+
+
+def test_round_trip(tmpdir):
+    images = write_images(tmpdir, [0, 5, 12])
+    path = str(tmpdir.join('segment_0.pack'))
+    FramePack.write(path, images)
+    assert not [name for name in os.listdir(str(tmpdir)) if name.endswith('.tmp')]
+    with FramePack(path) as pack:
+        assert pack.frame_indexes == [0, 5, 12]
+        assert 5 in pack and '12' in pack and 6 not in pack
+        for i, image_path in reversed(images):
+            with open(image_path, 'rb') as fh:
+                assert pack.get(i) == fh.read()
+        pack.extract(12, str(tmpdir.join('extracted.jpg')))
+    with open(str(tmpdir.join('extracted.jpg')), 'rb') as fh:
+        assert fh.read() == b'image 12 ' * 13
+
+
+def test_empty_pack(tmpdir):
+    path = str(tmpdir.join('empty.pack'))
+    with FramePack.write(path, []) as pack:
+        assert pack.frame_indexes == []
+
+
+def test_bad_magic(tmpdir):
+    path = str(tmpdir.join('segment_0.pack'))
+    with open(path, 'wb') as out:
+        out.write(b'\0' * 64)
+    with pytest.raises(ValueError):
+        FramePack(path).open()
+
+
+def test_ensure_frame_extracts_packed_frame(tmpdir, monkeypatch):
+    monkeypatch.setattr(settings, 'MEDIA_ROOT', str(tmpdir))
+    frames_dir = tmpdir.mkdir('video').mkdir('frames')
+    images = write_images(tmpdir, [3, 4])
+    FramePack.write(frame_pack_path('video', 1), images)
+    packs = {}
+    for i, image_path in images:
+        local_path = ensure_frame('video', i, 1, True, {}, packs)
+        assert local_path == str(frames_dir.join('{}.jpg'.format(i)))
+        with open(local_path, 'rb') as fh, open(image_path, 'rb') as expected:
+            assert fh.read() == expected.read()
+    assert list(packs) == [frame_pack_path('video', 1, media_root='')]
+    packs.popitem()[1].close()
@@ -0,0 +1,48 @@
+import sys
+import numpy as np
+from dvalib.frame_stream import FrameStream
+
+
+class GeneratedStream(FrameStream):
+    """
+    Reads frames written by a Python process instead of ffmpeg, frame k is filled with k % 256.
+    """
+
+    def __init__(self, frames, width=4, height=2, **kwargs):
+        super(GeneratedStream, self).__init__('generated', width, height, **kwargs)
+        self.frames = frames
+
+    def command(self):
+        script = ("import sys\n"
+                  "out = getattr(sys.stdout, 'buffer', sys.stdout)\n"
+                  "for k in range({}):\n"
+                  "    out.write(bytearray([k % 256] * {}))\n").format(self.frames, self.width * self.height * 3)
+        return [sys.executable, '-c', script]
+
+
+def test_reads_all_frames():
+    stream = GeneratedStream(5)
+    frames = list(stream)
+    stream.close()
+    assert len(frames) == 5
+    assert frames[0].shape == (2, 4, 3)
+    assert [int(f[0, 0, 0]) for f in frames] == [0, 1, 2, 3, 4]
+
+
+def test_close_while_reader_is_blocked_stops_reader_and_process():
+    stream = GeneratedStream(10000, width=64, height=64, queue_size=2)
+    frames = iter(stream)
+    first = next(frames)
+    assert np.all(first == 0)
+    stream.close()
+    assert not stream.reader.is_alive()
+    assert stream.process.returncode is not None
+    assert stream.queue.empty()
+
+
+def test_close_after_the_process_exited():
+    stream = GeneratedStream(3, queue_size=1)
+    stream.start()
+    stream.process.wait()
+    stream.close()
+    assert not stream.reader.is_alive()
@@ -0,0 +1,66 @@
+from dvaapp.operations.livestreaming import split_encoded_frames, live_frame_position
+
+
+def encoded(count, fps=10.0, gop=10, start=0.0):
+    return [(start + i / fps, 'I' if i % gop == 0 else 'P') for i in range(count)]
+
+
+def test_needs_frames_past_the_end():
+    assert split_encoded_frames([], 0.0, 1.0) is None
+    assert split_encoded_frames(encoded(1), 0.0, 1.0) is None
+    assert split_encoded_frames(encoded(10), 0.0, 1.0) is None
+    assert split_encoded_frames(encoded(12), 0.0, 1.0) is not None
+
+
+def test_segment_spans_keyframes():
+    frames, end = split_encoded_frames(encoded(25), 0.0, 1.0)
+    assert end == 10
+    assert sorted(frames) == list(range(10))
+    assert frames[0] == ('I', 0.0)
+    assert [pict_type for pict_type, _ in frames.values()].count('I') == 1
+    assert round(frames[9][1], 6) == 0.9
+
+
+def test_times_are_aligned_to_segment_start():
+    frames, end = split_encoded_frames(encoded(25, start=1.0), 1.04, 2.04)
+    assert end == 10
+    assert round(frames[0][1], 6) == 1.04
+    assert round(frames[5][1], 6) == 1.54
+
+
+def test_consecutive_segments_tile_the_stream():
+    pending = encoded(45)
+    frame_count = 0
+    for start_time in (0.0, 1.0, 2.0):
+        frames, end = split_encoded_frames(pending, start_time, start_time + 1.0)
+        assert round(frames[0][1], 6) == start_time
+        frame_count += len(frames)
+        del pending[:end]
+    assert frame_count == 30
+    assert pending[0] == (3.0, 'I')
+
+
+def test_missing_keyframes():
+    assert split_encoded_frames([(i / 10.0, 'P') for i in range(20)], 0.0, 1.0) is None
+    # keyframes too far from the requested boundaries
+    assert split_encoded_frames(encoded(40, gop=30), 0.0, 1.0) is None
+
+
+def test_live_frames_map_to_segment_frames():
+    # the first keyframe near 0.5s starts the first segment, earlier frames are not archived
+    pending = encoded(45, gop=5)
+    segments, offset, start_index = [], 0, 0
+    for segment_index, start_time in enumerate((0.5, 1.5, 2.5)):
+        frames, end = split_encoded_frames(pending, start_time, start_time + 1.0)
+        segments.append((offset + end - len(frames), segment_index, start_index, frames))
+        start_index += len(frames)
+        offset += end
+        del pending[:end]
+    assert [s[0] for s in segments] == [5, 15, 25]
+    assert live_frame_position(0, segments) is None
+    assert live_frame_position(4, segments) is None
+    assert live_frame_position(5, segments) == (0, 0, ('I', 0.5))
+    segment_index, frame_index, (pict_type, t) = live_frame_position(22, segments)
+    assert (segment_index, frame_index, pict_type, round(t, 6)) == (1, 17, 'P', 2.2)
+    assert live_frame_position(34, segments)[:2] == (2, 29)
+    assert live_frame_position(35, segments) is None
@@ -0,0 +1,52 @@
+import numpy as np
+from PIL import Image
+from django.conf import settings
+from dvaapp import models
+from dvaapp.models import Region, crop_region_arrays
+from dvaapp.operations.indexing import Indexers
+
+
+def write_frames(tmpdir, monkeypatch, count):
+    monkeypatch.setattr(settings, 'MEDIA_ROOT', str(tmpdir))
+    frames_dir = tmpdir.mkdir('video').mkdir('frames')
+    for i in range(count):
+        # lossless so that crops can be identified by their pixel values
+        Image.fromarray(np.full((20, 30, 3), i * 10, np.uint8)).save(str(frames_dir.join('{}.jpg'.format(i))), 'PNG')
+    opened = []
+    image_open = models.Image.open
+
+    def counting_open(path):
+        opened.append(path)
+        return image_open(path)
+
+    monkeypatch.setattr(models.Image, 'open', counting_open)
+    return opened
+
+
+def region(frame_index, x=0):
+    return Region(video_id='video', frame_index=frame_index, x=x, y=2, w=5, h=4)
+
+
+def test_frames_are_decoded_once_across_batches(tmpdir, monkeypatch):
+    opened = write_frames(tmpdir, monkeypatch, 3)
+    regions = [region(0), region(0, 3), region(1), region(1, 5), region(2)]
+    frames = {}
+    crops = crop_region_arrays(regions[:3], frames) + crop_region_arrays(regions[3:], frames)
+    assert len(opened) == 3
+    assert list(frames) == [regions[-1].frame_path()]
+    assert [int(c[0, 0, 0]) for c in crops] == [0, 0, 10, 10, 20]
+    assert all(c.base is None and c.shape == (4, 5, 3) for c in crops)
+
+
+class FakeIndex(object):
+
+    def index_crops(self, crops):
+        return [int(c[0, 0, 0]) for c in crops]
+
+
+def test_index_regions_keeps_region_order(tmpdir, monkeypatch):
+    opened = write_frames(tmpdir, monkeypatch, 3)
+    regions = [region(2), region(0), region(1), region(0, 7), region(2, 1), region(1, 2)]
+    features = Indexers.index_regions(FakeIndex(), regions, chunk_size=4)
+    assert features == [20, 0, 10, 0, 20, 10]
+    assert len(opened) == 3
@@ -0,0 +1,93 @@
+import numpy as np
+import pytest
+from dvalib.retriever import exact_search, SimpleRetriever
+
+
+def brute_force(queries, index, n, metric):
+    if metric == 'L2':
+        dist = np.sqrt(((queries[:, None, :] - index[None, :, :]) ** 2).sum(axis=-1))
+        ids = np.argsort(dist, axis=1, kind='mergesort')[:, :n]
+    else:
+        dist = np.dot(queries, index.T)
+        ids = np.argsort(-dist, axis=1, kind='mergesort')[:, :n]
+    return dist[np.arange(len(queries))[:, None], ids], ids
+
+
+@pytest.mark.parametrize('metric', ['L2', 'IP'])
+@pytest.mark.parametrize('total,n,chunk_size', [
+    (100, 10, 65536),
+    (100, 10, 7),  # chunks smaller than n
+    (100, 10, 10),  # chunks exactly n
+    (101, 10, 25),  # last chunk shorter than n
+    (64, 10, 32),  # index size is a multiple of the chunk size
+    (5, 10, 2),  # n larger than the index
+    (1, 3, 1),
+])
+def test_exact_search_matches_brute_force(metric, total, n, chunk_size):
+    rng = np.random.RandomState(total * 31 + chunk_size)
+    index = rng.rand(total, 16).astype(np.float32)
+    queries = rng.rand(4, 16).astype(np.float32)
+    dist, ids = exact_search(queries, index, n, metric=metric, chunk_size=chunk_size)
+    expected_dist, expected_ids = brute_force(queries, index, n, metric)
+    assert ids.shape == (4, min(n, total))
+    np.testing.assert_array_equal(ids, expected_ids)
+    np.testing.assert_allclose(dist, expected_dist, rtol=1e-4, atol=1e-4)
+
+
+def test_exact_search_with_precomputed_norms():
+    rng = np.random.RandomState(3)
+    index = rng.rand(50, 8).astype(np.float32)
+    queries = rng.rand(2, 8).astype(np.float32)
+    norms = np.einsum('ij,ij->i', index, index)
+    dist, ids = exact_search(queries, index, 5, norms=norms, chunk_size=16)
+    expected_dist, expected_ids = brute_force(queries, index, 5, 'L2')
+    np.testing.assert_array_equal(ids, expected_ids)
+    np.testing.assert_allclose(dist, expected_dist, rtol=1e-4, atol=1e-4)
+
+
+def test_exact_search_empty_index_and_unknown_metric():
+    dist, ids = exact_search(np.ones((2, 4)), np.empty((0, 4), dtype=np.float32), 5)
+    assert dist.shape == ids.shape == (2, 0)
+    with pytest.raises(ValueError):
+        exact_search(np.ones((2, 4)), np.ones((3, 4), dtype=np.float32), 2, metric='cosine')
+
+
+@pytest.mark.parametrize('metric', ['L2', 'IP'])
+def test_nearest_batch_matches_brute_force(metric):
+    rng = np.random.RandomState(5)
+    blocks = [rng.rand(rows, 6).astype(np.float32) for rows in (4, 9, 1, 13)]
+    retriever = SimpleRetriever('test', metric=metric, chunk_size=5)
+    for pk, block in zip((101, 102, 103, 104), blocks):
+        retriever.add_vectors(block, len(block), pk)
+    index = np.vstack(blocks)
+    starts = np.cumsum([0] + [len(b) for b in blocks])
+    queries = rng.rand(3, 6).astype(np.float32)
+    for n in (1, 7, 100):
+        results = retriever.nearest_batch(queries, n)
+        expected_dist, expected_ids = brute_force(queries, index, n, metric)
+        for q in range(len(queries)):
+            assert [r['rank'] for r in results[q]] == list(range(1, min(n, len(index)) + 1))
+            for r, i, d in zip(results[q], expected_ids[q], expected_dist[q]):
+                block = np.searchsorted(starts, i, side='right') - 1
+                assert r['indexentries_pk'] == 101 + block
+                assert r['offset'] == i - starts[block]
+                assert abs(r['dist'] - d) < 1e-4
+
+
+def test_nearest_batch_without_vectors():
+    assert SimpleRetriever('test').nearest_batch(np.ones((1, 4)), 3) == {}
+
+
+def test_removed_entries_do_not_take_up_results(tmpdir):
+    path = str(tmpdir.join('vectors.f32'))
+    retriever = SimpleRetriever('test', store_path=path)
+    retriever.add_vectors(np.zeros((5, 2), np.float32), 5, 'deleted')
+    retriever.add_vectors(np.arange(6, dtype=np.float32).reshape(3, 2) + 1, 3, 'kept')
+    other = SimpleRetriever('test', store_path=path)
+    retriever.remove_entries({'deleted'})
+    assert retriever.loaded_entries == {'kept'}
+    results = retriever.nearest_batch(np.zeros((1, 2), np.float32), 3)[0]
+    assert [(r['indexentries_pk'], r['offset']) for r in results] == [('kept', 0), ('kept', 1), ('kept', 2)]
+    other.refresh_store()
+    assert other.loaded_entries == {'kept'}
+    assert [r['offset'] for r in other.nearest_batch(np.zeros((1, 2), np.float32), 2)[0]] == [0, 1]
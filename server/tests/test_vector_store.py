@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+from dvalib.vector_store import VectorStore
+
+
+def test_append_grows_and_keeps_vectors():
+    rng = np.random.RandomState(0)
+    store = VectorStore(capacity=4)
+    blocks = [rng.rand(rows, 8).astype(np.float32) for rows in (3, 1, 5, 9)]
+    for pk, block in enumerate(blocks):
+        assert store.append(pk, block)
+    expected = np.vstack(blocks)
+    assert store.count == len(expected)
+    assert store.capacity == 32
+    np.testing.assert_array_equal(store.vectors, expected)
+    assert store.entries == [(0, 0, 3), (1, 3, 1), (2, 4, 5), (3, 9, 9)]
+    np.testing.assert_allclose(store.squared_norms, (expected ** 2).sum(axis=1), rtol=1e-5)
+
+
+def test_duplicate_entry_is_ignored():
+    store = VectorStore(components=4)
+    assert store.append(7, np.ones(4))
+    assert not store.append(7, np.zeros(4))
+    assert store.count == 1
+
+
+def test_squared_norms_follow_appends():
+    store = VectorStore(capacity=2)
+    store.append(0, np.full((2, 3), 2.0))
+    np.testing.assert_allclose(store.squared_norms, [12.0, 12.0])
+    store.append(1, np.ones((3, 3)))
+    np.testing.assert_allclose(store.squared_norms, [12.0, 12.0, 3.0, 3.0, 3.0])
+
+
+def test_memmap_store_reopens(tmpdir):
+    path = str(tmpdir.join('store', 'vectors.f32'))
+    rng = np.random.RandomState(1)
+    first, second = rng.rand(3, 5).astype(np.float32), rng.rand(1500, 5).astype(np.float32)
+    store = VectorStore(path=path, capacity=4)
+    store.append(10, first)
+    store.append(11, second)
+    reopened = VectorStore(path=path)
+    assert reopened.components == 5
+    assert reopened.count == 1503
+    assert [tuple(e) for e in reopened.entries] == [(10, 0, 3), (11, 3, 1500)]
+    np.testing.assert_array_equal(reopened.vectors, np.vstack([first, second]))
+
+
+def test_memmap_store_sees_appends_from_another_instance(tmpdir):
+    path = str(tmpdir.join('vectors.f32'))
+    writer = VectorStore(path=path, capacity=2)
+    writer.append(1, np.ones((2, 4)))
+    reader = VectorStore(path=path)
+    writer.append(2, np.full((3, 4), 2.0))
+    assert reader.count == 2
+    reader.refresh()
+    assert reader.count == 5
+    assert [e[0] for e in reader.entries] == [1, 2]
+    np.testing.assert_array_equal(reader.vectors[2:], np.full((3, 4), 2.0))
+    assert not reader.append(2, np.zeros((3, 4)))
+
+
+def test_memmap_store_rejects_other_dimensions(tmpdir):
+    path = str(tmpdir.join('vectors.f32'))
+    VectorStore(path=path).append(1, np.ones((1, 4)))
+    with pytest.raises(ValueError):
+        VectorStore(path=path, components=8)
+
+
+def test_remove_compacts_rows(tmpdir):
+    path = str(tmpdir.join('vectors.f32'))
+    store = VectorStore(path=path, capacity=2)
+    blocks = [np.full((rows, 3), pk, np.float32) for pk, rows in ((1, 2), (2, 3), (3, 1), (4, 2))]
+    for pk, block in enumerate(blocks, 1):
+        store.append(pk, block)
+    reader = VectorStore(path=path)
+    np.testing.assert_allclose(reader.squared_norms[:2], [3.0, 3.0])
+    assert store.remove([2, 4, 7]) == 5
+    assert store.count == 3
+    assert store.entries == [(1, 0, 2), (3, 2, 1)]
+    np.testing.assert_array_equal(store.vectors, np.vstack([blocks[0], blocks[2]]))
+    np.testing.assert_allclose(store.squared_norms, [3.0, 3.0, 27.0])
+    assert store.remove([2]) == 0
+    # other instances start over from the compacted entries
+    reader.refresh()
+    assert [tuple(e) for e in reader.entries] == [(1, 0, 2), (3, 2, 1)]
+    np.testing.assert_allclose(reader.squared_norms, [3.0, 3.0, 27.0])
+    assert reader.append(2, np.full((1, 3), 5.0))
+    store.refresh()
+    assert store.count == 4
+    np.testing.assert_array_equal(store.vectors[3], [5.0, 5.0, 5.0])